@@ -1,31 +1,33 @@
 #!/usr/bin/env python3
 
+import asyncio
 import os
-import pickle
 import socket
 import time
 
 import redis
 
-from tools import diode_utils
+from tools import (async_receiver, batching, compression, datagram_reader, decode_pool, dedup, diode_utils,
+                   file_transfer, integrity, metrics, reassembly, redis_output, spool, timer_wheel, wire_format)
 
 """
 This programs listens to a UDP port, receives data and validates it.
 
-Data comes in the form of a tuple: 
-(total_packets, packet_nr, redundant_copies_sent, nr_of_copy, md5sum[-6:], bytes)
+Data comes in the form of a binary frame, see tools/wire_format.py, that is parsed to a tuple: 
+(total_packets, packet_nr, redundant_copies_sent, nr_of_copy, item_id, chunk_checksum, bytes, fec_info, stream_id, flags)
 
 Data is stored in a dictionary, when all packets of a session has been received, the receiver puts all items in the redis queue.
 
-It is recommended to use one sender and receiver per port.
+Several Redis queues can share one port, the stream id of a frame picks the queue its item is put on.
+Items of file transfers are written to file_output_directory instead, see tools/file_transfer.py
 
 
 Program flow:
 start_udp_server ->     # Checks that Redis is up, starts server
-process_frame ->        # Sends data to UDP_frame_to_dict, if returned status is 0, adds to redis
-UDP_frame_to_dict  -    # Unpacks the tuple, creates a key in the queue dict based on md5sum of data. 
-                        creates a list in the queue_dict and adds all recieved data. 
-                        When complete, return list and status of 0
+process_frame ->        # Sends data to UDP_frame_to_dict, if returned status is 0, adds to the redis output stage
+UDP_frame_to_dict  -    # Unpacks the tuple, creates a key in the queue dict based on the item id. 
+                        creates an ItemReassembly in the queue_dict and writes all recieved data into it. 
+                        When complete, return status of 0
                         
 
 """
@@ -33,9 +35,50 @@ UDP_frame_to_dict  -    # Unpacks the tuple, creates a key in the queue dict bas
 # This gets the current directory of the program and the config file.
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 CONFIG_FILE = os.path.join(__location__, "diode_receiver.conf")
-SEEN_DICT = {}  # md5: timestamp
+SEEN_ITEMS = dedup.SeenItems()  # Completed item ids, replaced from the settings in start_udp_server
+EXPIRY_WHEEL = timer_wheel.TimerWheel(now=time.monotonic())  # In-flight item ids by idle deadline
+IDLE_TIMEOUT_SECONDS = 3.0  # In-flight items without a new packet for this long are dropped
+IDLE_TIMEOUT_PER_PACKET_SECONDS = 0.002  # Added to the idle timeout for every packet of the item
+MAX_ITEM_BYTES = 536870912  # Items announced larger are dropped before a buffer is allocated for them
+STREAM_QUEUES = {0: None}  # stream_id: Redis queue (None is the queue of the output), set in start_udp_server
+UNKNOWN_STREAMS = set()  # Stream ids without a queue that were already reported
+FILE_WRITER = None  # Writes file transfers to file_output_directory, set in start_udp_server
+DROPPED_FILE_ITEMS = 0  # File items received without a FILE_WRITER
 DEBUG = False
 
+# Optional settings in the config file, see diode_receiver.conf
+DEFAULT_SETTINGS = {
+    "accept_legacy_pickle": False,  # Accept pickled tuples from old senders, only on trusted networks
+    "redis_flush_items": 100,  # Completed items pushed to Redis per RPUSH
+    "redis_flush_seconds": 0.05,  # Max time a completed item waits before it is pushed
+    "redis_max_backlog_items": 100000,  # Completed items kept in memory while Redis is slow or down
+    "redis_retry_seconds": 1.0,  # Wait between retries when Redis is down
+    "receive_buffer_datagrams": 4096,  # SO_RCVBUF in datagrams of the size the sender announces
+    "asyncio_receiver": False,  # Read the socket from an event loop, decode in a separate stage
+    "async_ring_datagrams": 65536,  # Datagrams waiting for the decode stage, the oldest are dropped when full
+    "async_batch_datagrams": 256,  # Datagrams handed to the decode stage at a time
+    "async_stats_seconds": 10.0,  # Seconds between queue depth reports, 0 disables them
+    "metrics_port": 0,  # Prometheus metrics on http://127.0.0.1:metrics_port/metrics, 0 = off
+    "metrics_json_file": "",  # JSON stats file rewritten every metrics_json_seconds, empty = off
+    "metrics_json_seconds": 10.0,
+    "decode_workers": 0,  # Processes that decode and validate frames, 0 does everything in one thread
+    "decode_batch_datagrams": 64,  # Datagrams handed to a decode worker at a time
+    "dedup_ttl_seconds": 3.0,  # How long a completed item id is remembered to drop its duplicates
+    "dedup_max_items": 1000000,  # Max remembered item ids
+    "dedup_bloom_bits": 0,  # Fixed memory Bloom filter of this many bits per generation instead, 0 = exact
+    "dedup_bloom_hashes": 7,
+    "idle_timeout_seconds": IDLE_TIMEOUT_SECONDS,
+    "idle_timeout_per_packet_seconds": IDLE_TIMEOUT_PER_PACKET_SECONDS,
+    "max_item_bytes": MAX_ITEM_BYTES,  # Items announced larger are dropped, the largest Redis value by default
+    "file_output_directory": "",  # Where files sent with diode_sender.py --send-files go, empty drops them
+    "file_timeout_seconds": 60.0,  # Files without a new block for this long are reported incomplete
+    "file_max_bytes": 0,  # Larger files are dropped, 0 only drops files larger than the free disk space
+    "file_max_block_bytes": 67108864,  # Files sent in larger blocks are dropped
+    "spool_directory": "",  # Completed items wait for Redis in segment files in this directory, empty = in memory
+    "spool_segment_bytes": 67108864,  # Size of a spool segment file, see tools/spool.py
+    "spool_max_bytes": 1073741824,  # Disk space of the spool, items are dropped once it is full
+}
+
 
 def read_config(config_file=CONFIG_FILE):
     with open(config_file, 'r') as f:
@@ -56,22 +99,43 @@ def read_config(config_file=CONFIG_FILE):
     return listener_port, listener_ip, redis_out_queue, redis_hostname, redis_port, redis_password
 
 
-def start_udp_server(ip, port, redis_hostname, redis_port, redis_password, redis_queue, buffersize=4096):
-    """
-    Listens to a port, receives pickled data over UDP.
-    Unpickles and sends to function that processes the data.
-    If processed data is OK, send it to Redis-list.
-
-    """
-    server_running = True
-    udp_server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # Start TCP/IP socket
-    udp_server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Allow reuse of socket
-
+def configure_receiver(redis_queue, settings=DEFAULT_SETTINGS, stream_queues=None):
+    """ Sets the module state from the settings, stream_queues maps stream ids to Redis lists.
+    By default everything is stream 0 and goes to redis_queue. """
+    global STREAM_QUEUES, SEEN_ITEMS, IDLE_TIMEOUT_SECONDS, IDLE_TIMEOUT_PER_PACKET_SECONDS, MAX_ITEM_BYTES
+    global FILE_WRITER
+    IDLE_TIMEOUT_SECONDS = settings["idle_timeout_seconds"]
+    IDLE_TIMEOUT_PER_PACKET_SECONDS = settings["idle_timeout_per_packet_seconds"]
+    MAX_ITEM_BYTES = settings["max_item_bytes"]
+    STREAM_QUEUES = dict(stream_queues or {})
+    STREAM_QUEUES.setdefault(0, redis_queue)
+    SEEN_ITEMS = dedup.create_seen_items(settings["dedup_ttl_seconds"], settings["dedup_max_items"],
+                                         settings["dedup_bloom_bits"], settings["dedup_bloom_hashes"])
+    if settings["file_output_directory"]:
+        FILE_WRITER = file_transfer.FileWriter(settings["file_output_directory"], settings["file_timeout_seconds"],
+                                               settings["file_max_bytes"], settings["file_max_block_bytes"])
+        print("[*] Writing received files to %s" % FILE_WRITER.output_directory)
+    integrity.warn_missing_packages()
+    metrics.METRICS.register_function("rs_corrected_chunks", diode_utils.rs_corrected_chunks)
+    for name in SEEN_ITEMS.stats():
+        # dedup_hits, dedup_misses, dedup_evictions and dedup_items
+        metrics.METRICS.register_function("dedup_" + name, lambda name=name: SEEN_ITEMS.stats()[name])
+
+
+def create_spool(settings=DEFAULT_SETTINGS):
+    """ None without spool_directory. Items aren't synced one by one, they are in the page cache once written and
+    survive a crash of the receiver, not of the machine. """
+    if not settings["spool_directory"]:
+        return None
+    return spool.Spool(settings["spool_directory"], segment_bytes=settings["spool_segment_bytes"],
+                       max_bytes=settings["spool_max_bytes"], sync=False)
+
+
+def connect_redis(redis_hostname, redis_port, redis_password):
+    """ Returns a Redis connection once Redis is up, retries until it is. """
     redis_connected = False
     redis_server = False
     timeout = 10
-    item_counter = 0
-    duplicate_item_counter = 0
     while not redis_connected:
         redis_server = diode_utils.redis_connect_server(redis_hostname, redis_port, redis_password)
         try:
@@ -85,6 +149,12 @@ def start_udp_server(ip, port, redis_hostname, redis_port, redis_password, redis
         except redis.exceptions.ConnectionError:
             print(f"[X] Error: Can't connect to redis-server, retrying in {timeout} seconds.")
             time.sleep(timeout)
+    return redis_server
+
+
+def bind_udp_socket(ip, port):
+    udp_server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # Start TCP/IP socket
+    udp_server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Allow reuse of socket
     try:
         udp_server_socket.bind((ip, port))
         print("[*] Socket created")
@@ -92,200 +162,360 @@ def start_udp_server(ip, port, redis_hostname, redis_port, redis_password, redis
         print("[x] Error creating socket. ", e)
         exit(1)
     print("[*] Socket listening on port %s " % str(port))
+    return udp_server_socket
+
+
+def start_udp_server(ip, port, redis_hostname, redis_port, redis_password, redis_queue, buffersize=4096,
+                     settings=DEFAULT_SETTINGS, stream_queues=None):
+    """
+    Listens to a port, receives binary frames over UDP.
+    Parses them and sends to function that processes the data.
+    If processed data is OK, send it to the Redis output stage that pushes it to the Redis-list in batches.
+    stream_queues maps stream ids to Redis lists, by default everything is stream 0 and goes to redis_queue.
+    Without redis_hostname, only file transfers are received and other items are dropped.
+
+    """
+    configure_receiver(redis_queue, settings, stream_queues)
+    item_counter = 0
+    duplicate_item_counter = 0
+    expired_item_counter = 0
+    redis_server = connect_redis(redis_hostname, redis_port, redis_password) if redis_hostname else None
+    udp_server_socket = bind_udp_socket(ip, port)
+
+    reader = datagram_reader.DatagramReader(udp_server_socket, buffersize, settings["receive_buffer_datagrams"])
+    if settings["decode_workers"] > 0:
+        # Started before any other thread, the pool forks its workers.
+        pool = decode_pool.DecodePool(reader, workers=settings["decode_workers"],
+                                      accept_legacy=settings["accept_legacy_pickle"],
+                                      batch_datagrams=settings["decode_batch_datagrams"])
+        frames = pool.results()
+        metrics.METRICS.register_function("rs_corrected_chunks",
+                                          lambda: diode_utils.rs_corrected_chunks() + pool.corrected_chunks)
+        metrics.METRICS.register_function("decode_pool_invalid_frames", lambda: pool.invalid_frames)
+        metrics.METRICS.register_function("decode_pool_pending_batches", pool.pending_batches)
+        print("[*] Decoding with %s worker processes" % settings["decode_workers"])
+    else:
+        pool = None
+        frames = receive_frames(reader, settings["accept_legacy_pickle"])
+    metrics.start_exporters(settings)  # Their threads start after the pool forked its workers
+
+    if redis_server:
+        output = redis_output.RedisOutput(redis_server, redis_queue,
+                                          flush_items=settings["redis_flush_items"],
+                                          flush_seconds=settings["redis_flush_seconds"],
+                                          max_backlog_items=settings["redis_max_backlog_items"],
+                                          retry_seconds=settings["redis_retry_seconds"],
+                                          spool=create_spool(settings))
+    else:
+        print("[*] No redis_hostname, only receiving files.")
+        output = redis_output.DiscardOutput()
 
     queue_dictionary = {}  # Create an empty dictionary that will hold all received items.
+    metrics.METRICS.register_function("in_flight_items", lambda: len(queue_dictionary))
+    metrics.METRICS.register_function("redis_backlog_items", output.backlog_size)
 
     try:
-        while server_running:
-            bytes_addr_recv = udp_server_socket.recvfrom(buffersize)
-            recv_bytes = pickle.loads(bytes_addr_recv[0])
-            recv_addr = bytes_addr_recv[1]
-            if DEBUG:
-                print(f"[*] Received: {len(recv_bytes)}  from: {recv_addr}")
+        for recv_bytes, byte_chunk in frames:
+            if recv_bytes.datagram_bytes > reader.datagram_bytes:
+                reader.set_datagram_size(recv_bytes.datagram_bytes)
+                print("[*] Receiving datagrams of up to %s bytes" % recv_bytes.datagram_bytes)
             # Process recieved frame
+            started = time.thread_time()
             queue_dictionary, queue_md5_key, status, item_counter, duplicate_item_counter = process_frame(recv_bytes,
                                                                                                           queue_dictionary,
-                                                                                                          redis_server,
-                                                                                                          redis_queue,
+                                                                                                          output,
                                                                                                           item_counter,
-                                                                                                          duplicate_item_counter)
-            if len(queue_dictionary) > 20:
-                clean_up_queue_dict(queue_dictionary)
+                                                                                                          duplicate_item_counter,
+                                                                                                          byte_chunk)
+            expired_item_counter += clean_up_queue_dict(queue_dictionary)
+            if FILE_WRITER:
+                FILE_WRITER.expire()
+            metrics.METRICS.observe("cpu_seconds_process_frame", time.thread_time() - started, metrics.CPU_BUCKETS)
             if status == 0:
                 if item_counter % 100 == 1:
-                    print("[*] Sent %s items to redis. Has received %s duplicates" % (
-                    item_counter, duplicate_item_counter), end="\r")
+                    print("[*] Sent %s items to redis. Has received %s duplicates, expired %s incomplete items" % (
+                    item_counter, duplicate_item_counter, expired_item_counter), end="\r")
     except KeyboardInterrupt:
         print("[*] Shutting down server")
+        if pool:
+            pool.close()
         udp_server_socket.close()
+        output.close()
+        if FILE_WRITER:
+            FILE_WRITER.close()
         exit(0)
 
 
-def process_frame(UDP_frame, queue_dict, redis_server, redis_queue, item_counter, duplicate_item_counter):
+def start_async_udp_server(ip, port, redis_hostname, redis_port, redis_password, redis_queue, buffersize=4096,
+                           settings=DEFAULT_SETTINGS, stream_queues=None):
     """
-    Will send UDP-frame to udp_frame function, if status is 0, all data has been received and will get sent to redis.
+    Same as start_udp_server, as an asyncio pipeline (see tools/async_receiver.py):
+    the event loop drains the socket into a bounded ring, a decode thread validates and reassembles batches of
+    datagrams with process_frame, and completed items are pushed with the asyncio Redis client.
+    spool_directory isn't used, completed items wait in memory.
     """
-    queue_dict, md5sum_data, status = UDP_frame_to_dict(UDP_frame, queue_dict)
+    configure_receiver(redis_queue, settings, stream_queues)
+    metrics.start_exporters(settings)
+    if settings["spool_directory"]:
+        print("[x] The asyncio receiver has no spool, completed items wait for Redis in memory.")
+    connect_redis(redis_hostname, redis_port, redis_password)
+    udp_server_socket = bind_udp_socket(ip, port)
+    # Only sizes the buffers here, the event loop reads the socket.
+    reader = datagram_reader.DatagramReader(udp_server_socket, buffersize, settings["receive_buffer_datagrams"])
+    udp_server_socket.setblocking(False)
+    accept_legacy = settings["accept_legacy_pickle"]
+    queue_dictionary = {}
+    counters = {"items": 0, "duplicates": 0, "expired": 0}
+
+    def process_datagrams(datagrams):
+        """ Runs in the decode thread, the only thread that touches queue_dictionary. """
+        completed = async_receiver.CompletedItems()
+        frames = []
+        for datagram in datagrams:
+            frame = wire_format.unpack_frame(datagram, accept_legacy)
+            if frame is None:
+                metrics.METRICS.inc("packets_invalid")
+                continue
+            if frame.datagram_bytes > reader.datagram_bytes:
+                reader.set_datagram_size(frame.datagram_bytes)
+            frames.append(frame)
+        # Reed Solomon checks the whole batch in one vectorized call.
+        for frame, byte_chunk in zip(frames, diode_utils.validate_packets(frames)):
+            _, _, _, counters["items"], counters["duplicates"] = process_frame(frame, queue_dictionary, completed,
+                                                                            counters["items"],
+                                                                            counters["duplicates"], byte_chunk)
+        counters["expired"] += clean_up_queue_dict(queue_dictionary)
+        if FILE_WRITER:
+            FILE_WRITER.expire()
+        return completed.items
+
+    receiver = async_receiver.AsyncReceiver(
+        udp_server_socket, process_datagrams,
+        diode_utils.redis_connect_async_server(redis_hostname, redis_port, redis_password), redis_queue,
+        ring_datagrams=settings["async_ring_datagrams"], batch_datagrams=settings["async_batch_datagrams"],
+        output_items=settings["redis_max_backlog_items"], flush_items=settings["redis_flush_items"],
+        retry_seconds=settings["redis_retry_seconds"], stats_seconds=settings["async_stats_seconds"],
+        stats_function=lambda: dict(counters, in_flight=len(queue_dictionary)))
+    metrics.METRICS.register_function("in_flight_items", lambda: len(queue_dictionary))
+    metrics.METRICS.register_function("ring_depth", lambda: receiver.gauges()["ring_depth"] if receiver.ring else 0)
+    metrics.METRICS.register_function("output_depth",
+                                      lambda: receiver.output_queue.qsize() if receiver.output_queue else 0)
+    print("[*] Receiving with the asyncio pipeline")
+    try:
+        asyncio.run(receiver.run())
+    except KeyboardInterrupt:
+        print("[*] Shutting down server")
+        udp_server_socket.close()
+        exit(0)
+
+
+def receive_frames(reader, accept_legacy):
+    """ Reads and parses frames in the calling thread, yields (frame, None) as validation is done later.
+    The frame payload is a view of the reader's reusable buffer, it must be used before the next frame is read. """
+    while True:
+        datagram, recv_addr = reader.read()
+        recv_bytes = wire_format.unpack_frame(datagram, accept_legacy)
+        if recv_bytes is None:
+            metrics.METRICS.inc("packets_invalid")
+            if DEBUG:
+                print(f"[x] Invalid frame from: {recv_addr}")
+            continue
+        if DEBUG:
+            print(f"[*] Received: {len(recv_bytes)}  from: {recv_addr}")
+        yield recv_bytes, None
+
+
+def process_frame(UDP_frame, queue_dict, output, item_counter, duplicate_item_counter, byte_chunk=None):
+    """
+    Will send UDP-frame to udp_frame function, if status is 0, all data has been received and will get sent to
+    the Redis output stage.
+    byte_chunk is the decoded payload when the frame was already validated by a decode worker.
+    """
+    metrics.METRICS.inc("packets_received")
+    if UDP_frame.stream_id not in STREAM_QUEUES:
+        metrics.METRICS.inc("packets_unknown_stream")
+        if UDP_frame.stream_id not in UNKNOWN_STREAMS:
+            UNKNOWN_STREAMS.add(UDP_frame.stream_id)
+            print("[x] No queue for stream %s, add a stream_%s line to the config. Dropping its items." % (
+                UDP_frame.stream_id, UDP_frame.stream_id))
+        return queue_dict, None, 2, item_counter, duplicate_item_counter
+    redis_queue = STREAM_QUEUES[UDP_frame.stream_id]
+    try:
+        queue_dict, md5sum_data, status = UDP_frame_to_dict(UDP_frame, queue_dict, byte_chunk)
+    except Exception as e:
+        # A frame that passed wire_format's checks and still doesn't fit its item, drop the item, keep receiving.
+        md5sum_data = (UDP_frame.stream_id, UDP_frame.item_id) if UDP_frame.stream_id else UDP_frame.item_id
+        queue_dict.pop(md5sum_data, None)
+        metrics.METRICS.inc("packets_failed")
+        print("[x] Dropped an item on a frame it couldn't reassemble. %r" % e)
+        return queue_dict, md5sum_data, 2, item_counter, duplicate_item_counter
+    if status == 0 and not check_item_digest(UDP_frame, queue_dict[md5sum_data]):
+        # Checked before deduplication, so a corrupted item doesn't get its good copies dropped.
+        queue_dict.pop(md5sum_data)
+        return queue_dict, md5sum_data, 2, item_counter, duplicate_item_counter
     if status == 0:
         # All data received, check if data has been received.
         item_seen, last_epoch = handle_seen_items(md5sum_data)
         if item_seen:
             duplicate_item_counter += 1
+            metrics.METRICS.inc("items_deduplicated")
+            queue_dict.pop(md5sum_data)  # Remove item
             if DEBUG:
                 print("[*] %s was seen %s seconds ago." % (md5sum_data, last_epoch))
         else:
             # If not before received, send to redis.
             if DEBUG:
                 print("[*] New data, will add %s to redis. " % md5sum_data)
-            process_queue_dict_quick(queue_dict, md5sum_data, status, redis_server, redis_queue)
-            item_counter += 1
+            item_counter += process_queue_dict_quick(queue_dict, md5sum_data, status, output, redis_queue,
+                                                     UDP_frame.flags)
+            metrics.METRICS.inc("items_completed")
+            if UDP_frame.sent_ms:
+                metrics.METRICS.observe("item_latency_seconds", wire_format.latency_seconds(UDP_frame.sent_ms))
 
     return queue_dict, md5sum_data, status, item_counter, duplicate_item_counter
 
 
-def handle_seen_items(md5sum_data):
-    """ Will check if MD5sum exists in dictionary.
-    If it exists, it will return the number of seconds ago it was seen.
-    If it has not been seen before, function will return -1
-    If dictionary is longer than 1000 items, it will remove all items older than 1h."""
-    new_epoch = int(time.time())
-
-    oldest_items = 3
-    max_items = 10
-    if len(SEEN_DICT) > max_items:
-        for item in list(SEEN_DICT.keys()):
-            item_time = SEEN_DICT[item]
-            if new_epoch - item_time > oldest_items:
-                if DEBUG:
-                    print("[*] Cleaning up old seen items.")
-                SEEN_DICT.pop(item)
-
-    if md5sum_data in SEEN_DICT:
-        old_epoch = SEEN_DICT[md5sum_data]
-        updated_epoch = new_epoch - old_epoch
-        return True, updated_epoch
-    else:
-        SEEN_DICT[md5sum_data] = new_epoch
-        return False, 0
+def check_item_digest(UDP_frame, item):
+    """ Checks a completed item against the item digest in its frames, see tools/integrity.py
+    Legacy frames only have a piece of an md5 hexdigest, they aren't checked. """
+    if isinstance(UDP_frame.item_id, str):
+        return True
+    if integrity.check_item(UDP_frame.integrity, item.payload(), UDP_frame.item_id):
+        return True
+    metrics.METRICS.inc("item_digest_failures")
+    print("[x] Dropping item %016x, it doesn't match its digest." % UDP_frame.item_id)
+    return False
 
 
-def clean_up_queue_dict(queue_dict):
-    """ If items older than 1h, remove items."""
-    new_epoch = int(time.time())
-    check_time = 3  # one hour
-    for item in list(queue_dict.keys()):
-        item_epoch = queue_dict[item]["timestamp"]
-        if new_epoch - item_epoch > check_time:
-            if DEBUG:
-                print("[*] Removing old item from queue.")
-            queue_dict.pop(item)
+def handle_seen_items(md5sum_data):
+    """ Will check if the item id has been seen before, see tools/dedup.py
+    If it exists, it will return True and the number of seconds ago it was seen (0 in Bloom filter mode).
+    If it has not been seen before, function will return False, -1 and remember it.
+    Old items expire from SEEN_ITEMS as new ones are checked."""
+    seconds_ago = SEEN_ITEMS.check(md5sum_data)
+    return seconds_ago >= 0, seconds_ago
+
+
+def item_idle_timeout(total_packets):
+    """ Large items take longer to arrive, and get a longer idle timeout. """
+    return IDLE_TIMEOUT_SECONDS + IDLE_TIMEOUT_PER_PACKET_SECONDS * total_packets
+
+
+def clean_up_queue_dict(queue_dict, now=None):
+    """ Removes in-flight items that got no packet within their idle timeout, returns how many were removed.
+    Only items whose deadline came up on the EXPIRY_WHEEL are looked at, not the whole queue. """
+    if now is None:
+        now = time.monotonic()
+    expired_items = 0
+    for item_id in EXPIRY_WHEEL.advance(now):
+        item = queue_dict.get(item_id)
+        if item is None:
+            continue  # Completed
+        deadline = item.timestamp + item_idle_timeout(item.total_packets)
+        if deadline > now:
+            EXPIRY_WHEEL.add(item_id, deadline)  # Got packets since it was added, check again later
+            continue
+        if DEBUG:
+            print("[*] Removing old item from queue.")
+        queue_dict.pop(item_id)
+        expired_items += 1
+        metrics.METRICS.inc("items_expired")
+    return expired_items
+
+
+def process_queue_dict_quick(queue_dict, md5sum_data, status, output, redis_queue=None, flags=0):
+    """ Puts a completed item on the output, or every item of a batch in order. Returns the number of items.
+    Compressed items are decompressed first, items of file transfers go to the FILE_WRITER. """
+    global DROPPED_FILE_ITEMS
+    restored_bytes = queue_dict[md5sum_data].payload()  # A view of the reassembly buffer, no joining
+    queue_dict.pop(md5sum_data)    # Remove item
+    if flags & compression.COMPRESSION_MASK:
+        try:
+            restored_bytes = compression.decompress(restored_bytes, flags)
+        except ValueError as e:
+            print("[x] Dropping item. %s" % e)
+            return 0
+    if flags & wire_format.FLAG_FILE:
+        if FILE_WRITER:
+            FILE_WRITER.put(restored_bytes)
+        else:
+            DROPPED_FILE_ITEMS += 1
+            metrics.METRICS.inc("file_items_dropped")
+            if DROPPED_FILE_ITEMS == 1:
+                print("[x] Receiving a file, set file_output_directory to save it. Dropping its items.")
+        return 0
+    if not flags & wire_format.FLAG_BATCH:
+        output.put(restored_bytes, redis_queue)
+        return 1
+    try:
+        items = batching.unpack_batch(restored_bytes)
+    except ValueError as e:
+        print("[x] Dropping malformed batch item. %s" % e)
+        return 0
+    for item in items:
+        output.put(item, redis_queue)
+    return len(items)
 
 
-def process_queue_dict_quick(queue_dict, md5sum_data, status, redis_server, redis_queue):
-    complete_bytearray_list = queue_dict[md5sum_data]["data_list"]
-    restored_bytes = diode_utils.bytearray_joiner(complete_bytearray_list)
-    diode_utils.redis_add_item_to_list(redis_server, redis_queue, restored_bytes)
-    queue_dict.pop(md5sum_data)    # Remove item
 
+def validate_packet(rs_byte_chunk, md5sum_chunk, byte_chunk=None, integrity_byte=0):
+    """ byte_chunk is the result of a decode worker when the packet was already validated in the decode pool. """
+    if byte_chunk is not None:
+        return byte_chunk
+    return diode_utils.validate_packet(rs_byte_chunk, md5sum_chunk, integrity_byte)
 
 
-def UDP_frame_to_dict(UDP_frame, queue_dict):
+def UDP_frame_to_dict(UDP_frame, queue_dict, byte_chunk=None):
     """
-    Will take frame and add the md5sum of the data as the key to the dict.
-    The values will consist of:
+    Will take frame and add its item id as the key to the dict, (stream_id, item_id) for streams other than 0
+    so the same item sent on two streams is kept apart.
+    The value is an ItemReassembly (see tools/reassembly.py) holding:
      latest timestamp
-     list containing all the packets.
-     other stuff..
-    When list is complete, it will call on a function that processes the list
-    All bytes are encoded with the Reed Solomon error coding.
-    Format: (total_packets, packet_nr, redundant_copies_sent, nr_of_copy, md5sum_data[-6:], md5sum_bytes[-2:], bytes)
-    Status: 0:ok, 1:not full, 2: error, 3: Processing function error
+     a buffer that all the packets are written into, and a bitmap of received packets.
+    Packets are Reed Solomon decoded and checked, unless they aren't needed anymore.
+    The ItemReassembly of a new item is only created once its first packet is valid and its size is within
+    MAX_ITEM_BYTES, so frames with forged headers don't get buffers allocated for them.
+    The item is complete as soon as no packet is missing, in any arrival order, including rebuilt erasure blocks.
+    Packets of items that were completed within dedup_ttl_seconds are dropped.
+    Format: (total_packets, packet_nr, redundant_copies_sent, nr_of_copy, item_id, chunk_checksum, bytes, fec_info, stream_id, flags)
+    Status: 0:ok, 1:not full, 2: error
     """
-    status = 1
-
-    def validate_packet(rs_byte_chunk, md5sum_chunk):
-        byte_chunk = diode_utils.rs_decode(rs_byte_chunk)
-        checksum = diode_utils.md5sum_bytestring(byte_chunk)[-2:]
-        if DEBUG:
-            print("[*] Diffing checksums", checksum, md5sum_chunk)
-        if checksum == md5sum_chunk:
-            return byte_chunk
-        else:
-            return False
-
-    total_packets = UDP_frame[0]
-    packet_nr = UDP_frame[1]
-    redundant_copies = UDP_frame[2]
-    copy_nr = UDP_frame[3]
-    md5sum_data = UDP_frame[4]
-    md5sum_chunk = UDP_frame[5]
-    rs_byte_chunk = UDP_frame[6]
-    epoch_timestamp = int(time.time())
-    if md5sum_data in queue_dict:
-        data_dict = queue_dict[md5sum_data]
-        data_dict["timestamp"] = epoch_timestamp
-
-        # Check if byte_chunk already in list.
-        if data_dict["data_list"][packet_nr]:
+    total_packets, packet_nr, _, _, md5sum_data, md5sum_chunk, rs_byte_chunk, fec_info, stream_id = UDP_frame[:9]
+    if stream_id:
+        md5sum_data = (stream_id, md5sum_data)
+    timestamp = time.monotonic()
+    item = queue_dict.get(md5sum_data)
+    if item is None:
+        if SEEN_ITEMS.contains(md5sum_data):
+            # A late copy or repair packet of an item that is already complete, not the start of a new one.
+            metrics.METRICS.inc("packets_late")
+            return queue_dict, md5sum_data, 1
+        # Without erasure coding every packet but the last is full size, the buffer is at most this large.
+        item_bytes = fec_info[2] if fec_info else total_packets * len(rs_byte_chunk)
+        if item_bytes > MAX_ITEM_BYTES:
+            metrics.METRICS.inc("items_too_large")
+            return queue_dict, md5sum_data, 2
+    else:
+        item.timestamp = timestamp
+        if item.has(packet_nr):
             # Data already exists and should be valid, continue.
             if DEBUG:
                 print("[*] Valid data already exists")
-        else:
-            validated_packet = validate_packet(rs_byte_chunk, md5sum_chunk)
-            if validated_packet:
-                data_dict["data_list"][packet_nr] = validated_packet
-                status = 1
-                data_dict["status"] = status
-            else:
-                data_dict["data_list"][packet_nr] = False
-                status = 2
-                data_dict["status"] = status
-
-        # Check if final packet.
-        packet_nr += 1
-        if packet_nr == total_packets:
-            # Check everything OK:
-            for chunk in data_dict["data_list"]:
-                # Loop over data list, if any chunk is None, status = Error (2)
-                if not chunk:
-                    print("[x] Not all data chunks present, UDP error.")
-                    # Log error to some file
-                    status = 2
-                    data_dict["status"] = status
-
-            if data_dict["status"] != 2:
-                # If status is not error, return OK data.
-                try:
-                    status = 0
-                    data_dict["status"] = status
-                    # Update redis "fetched_ok_set" with MD5
-                    return queue_dict, md5sum_data, status
-                    # data_dict.pop(md5sum_data)
-                except:
-                    status = 3
-                    data_dict["status"] = status
-
-    else:  # Creating new dict item
+            return queue_dict, md5sum_data, 1
+
+    validated_packet = validate_packet(rs_byte_chunk, md5sum_chunk, byte_chunk, UDP_frame.integrity)
+    if not validated_packet:
+        metrics.METRICS.inc("checksum_failures")
+        return queue_dict, md5sum_data, 2
+    if item is None:
         if DEBUG:
             print("[*] Adding new item to queue.")
-        queue_dict[md5sum_data] = {}
-        data_dict = queue_dict[md5sum_data]
-        data_list = [None] * total_packets
-        data_dict["data_list"] = data_list
-        data_dict["timestamp"] = epoch_timestamp
-
-        validated_packet = validate_packet(rs_byte_chunk, md5sum_chunk)
-
-        if validated_packet:
-            data_dict["data_list"][packet_nr] = validated_packet
-            status = 1
-            data_dict["status"] = status
-        else:
-            data_dict["data_list"][packet_nr] = False
-            status = 2
-            data_dict["status"] = status
-
-    return queue_dict, md5sum_data, status
+        item = reassembly.ItemReassembly(total_packets, fec_info, timestamp)
+        queue_dict[md5sum_data] = item
+        EXPIRY_WHEEL.add(md5sum_data, timestamp + item_idle_timeout(total_packets))
+    if item.add(packet_nr, validated_packet):
+        return queue_dict, md5sum_data, 0
+    return queue_dict, md5sum_data, 1
 
 
 def redis_appender():
@@ -294,7 +524,16 @@ def redis_appender():
 
 def main():
     listener_port, listener_ip, redis_out_queue, redis_hostname, redis_port, redis_password = read_config()
-    start_udp_server(listener_ip, listener_port, redis_hostname, redis_port, redis_password, redis_out_queue)
+    settings = diode_utils.read_config_settings(CONFIG_FILE, DEFAULT_SETTINGS)
+    config_streams = diode_utils.read_config_streams(CONFIG_FILE)
+    stream_queues = {stream_id: queue for stream_id, (queue, _) in config_streams.items()}
+    if settings["asyncio_receiver"]:
+        start_async_udp_server(listener_ip, listener_port, redis_hostname, redis_port, redis_password,
+                               redis_out_queue, settings=settings, stream_queues=stream_queues)
+    else:
+        start_udp_server(listener_ip, listener_port, redis_hostname, redis_port, redis_password, redis_out_queue,
+                         settings=settings, stream_queues=stream_queues)
 
 
-main()
+if __name__ == "__main__":
+    main()
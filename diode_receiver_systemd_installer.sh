@@ -6,7 +6,7 @@ sudo mkdir  -p $INSTALLDIR
 
 
 # Move files
-sudo cp ./diode_receiver.py ./diode_receiver.conf ./diode_utils.py  $INSTALLDIR
+sudo cp ./diode_receiver.py ./diode_receiver.conf -r ./tools  $INSTALLDIR
 
 
 # -u implies unbuffered output
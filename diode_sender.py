@@ -1,11 +1,10 @@
 #!/usr/bin/env python3
 
-import gzip
+import argparse
 import os
-import pickle
-import socket
 import time
-from tools import diode_utils
+from tools import (batching, compression, diode_utils, erasure, file_transfer, integrity, interleave, metrics, spool,
+                   stream_scheduler, transmit, wire_format)
 
 # Todo: Check out UDT https://udt.sourceforge.io/doc.html
 
@@ -15,6 +14,48 @@ CONFIG_FILE = os.path.join(__location__, "diode_sender.conf")
 DEBUG = False
 
 SLEEP_TIME_SECONDS=2
+CHUNK_BYTES = 1024  # Chunk size of the legacy format, old receivers can't take larger datagrams
+LEGACY_REDUNDANT_COPIES = 2  # Copies of every item in the legacy format, that has no erasure coding
+ENCODE_BATCH_PACKETS = 64  # Packets Reed Solomon encoded at a time for items without erasure coding
+KEEP_ENCODED_BYTES = 4194304  # Items up to this size are encoded once for all their copies
+SPOOL_DRAIN_ROUNDS = 10  # Max Redis round trips into the spools per round of sending, so they fill faster than they empty
+SPOOL_POLL_SECONDS = 0.01  # Time between checks of empty Redis queues when spooling, items stay in Redis until spooled
+
+# Optional settings in the config file, see diode_sender.conf
+DEFAULT_SETTINGS = {
+    "drain_batch_items": 100,  # Max items popped from Redis per round trip
+    "drain_max_wait_seconds": float(SLEEP_TIME_SECONDS),  # Max time to block on an empty queue before logging status
+    "redundant_copies": 1,  # Times every item is sent
+    "fec_overhead": 0.25,  # Erasure coding repair packets per data packet, 0 disables erasure coding
+    "fec_block_packets": 32,  # Data packets per erasure coding block
+    "legacy_pickle": False,  # Send pickled tuples to receivers that predate the binary frame format
+    "send_rate_mbit": 0.0,  # Target bit rate on the diode link, 0 sends as fast as the socket accepts
+    "send_burst_bytes": 262144,  # Bytes that may be sent back to back above the target rate
+    "send_batch_packets": 64,  # Datagrams per sendmmsg call
+    "send_buffer_bytes": 8388608,  # SO_SNDBUF of the sending socket
+    "metrics_port": 0,  # Prometheus metrics on http://127.0.0.1:metrics_port/metrics, 0 = off
+    "metrics_json_file": "",  # JSON stats file rewritten every metrics_json_seconds, empty = off
+    "metrics_json_seconds": 10.0,
+    "chunk_bytes": 0,  # Item bytes per datagram, 0 fills datagrams up to the MTU
+    "mtu": 0,  # MTU of the diode link, 0 reads it from sending_interface
+    "bind_sending_interface": False,  # Bind the socket to sending_interface, needs CAP_NET_RAW on Linux
+    "batch_max_bytes": -1,  # Small items are packed into batch items of up to this size, -1 chunk_bytes, 0 disables it
+    "batch_item_max_bytes": 256,  # Items up to this size are batched
+    "batch_linger_seconds": 0.005,  # Max time a small item waits for others to fill its batch
+    "compression": "zlib",  # none, zlib, gzip, zstd or lz4 (the last two when installed)
+    "compression_level": 1,
+    "compression_min_bytes": 512,  # Smaller items are sent as they are
+    "compression_max_ratio": 0.9,  # Items are sent uncompressed unless compression gets them below this ratio
+    "file_block_bytes": 1048576,  # File transfers are sent in items of this size, see tools/file_transfer.py
+    "chunk_checksum": "crc32",  # crc32, crc32c (only when every receiver has the package) or md5, see tools/integrity.py
+    "item_digest": "xxh3",  # xxh3, blake2b or md5
+    "interleave_depth": 1,  # Items whose datagrams are sent round robin, see tools/interleave.py
+    "interleave_spread_seconds": 0.0,  # Repair packets and extra copies of an item are spread over this time
+    "spool_directory": "",  # Items go from Redis to segment files in this directory before they are sent, empty = off
+    "spool_segment_bytes": 67108864,  # Size of a spool segment file, see tools/spool.py
+    "spool_max_bytes": 1073741824,  # Disk space of the spool of every stream, items stay in Redis once it is full
+    "spool_sync": True,  # Sync items to disk before they are removed from Redis
+}
 
 
 def read_config(config_file=CONFIG_FILE):
@@ -38,90 +79,418 @@ def read_config(config_file=CONFIG_FILE):
     return diode_receiver_hostname, diode_receiver_port, sending_interface, redis_source_queue, redis_hostname, redis_port, redis_password
 
 
-def decompress_dict(zipped_dict):
+def bytearray_to_udp_frame_generator(in_bytearray, redundant_copies=2, fec_overhead=0.0, fec_block_packets=32,
+                                     stream_id=0, flags=0, chunk_bytes=CHUNK_BYTES, sent_ms=0, suite=None):
+    """ Will Reed Solomon encode data, split it up and put it in a wire_format.Frame, then yield a generator.
+    Format: (total_packets, packet_nr, redundant_copies_to_send, nr_of_copy, item_digest, chunk_checksum, bytes, fec_info)
+    The item digest and chunk checksums are made by suite, integrity.default_suite() if None,
+    integrity.LEGACY_MD5 for the legacy format.
+
+    If fec_overhead is set, every block of fec_block_packets data packets is followed by its erasure coding
+    repair packets and fec_info is (fec_block_packets, repair_packets_per_block, item_length, chunk_bytes)
+    Repair packets are numbered after the data packets: total_packets + block_nr * repair_packets_per_block + repair_nr
+    The last block can have fewer data packets, and gets fewer repair packets.
+    stream_id tells the receiver which Redis queue the item goes to, flags are extra frame flags like FLAG_BATCH.
+    sent_ms is the send time the receiver measures end to end latency from.
     """
-    Takes gzipped json data, unzips and returns dictionary
-    :param zipped_dict:
-    :return:
+    # Will send data $num if connection is crap
+    view = memoryview(in_bytearray)
+    datagram_bytes = diode_utils.max_datagram_bytes(chunk_bytes)
+    suite = suite or integrity.default_suite()
+    item_id = suite.item_digest(in_bytearray)
+    total_packets = -(-len(view) // chunk_bytes)
+    repair_count = 0
+    fec_info = None
+    if fec_overhead > 0:
+        repair_count = erasure.repair_packet_count(fec_block_packets, fec_overhead)
+        fec_info = (fec_block_packets, repair_count, len(in_bytearray), chunk_bytes)
+    # Packets are encoded a block at a time, so memory and the time to the first frame don't grow with the item.
+    # Small items are encoded once for all copies, larger ones again for every copy.
+    keep_encoded = redundant_copies > 1 and len(view) <= KEEP_ENCODED_BYTES
+    kept_groups = []
+    for copy_num in range(1, redundant_copies + 1):  # if redundant copies more than 1, send everything again.
+        if keep_encoded and copy_num > 1:
+            groups = kept_groups
+        else:
+            groups = _encoded_packet_groups(view, chunk_bytes, total_packets, fec_overhead, fec_block_packets,
+                                            repair_count, suite)
+        for group in groups:
+            if keep_encoded and copy_num == 1:
+                kept_groups.append(group)
+            for packet_num, rs_byte_chunk, checksum in zip(*group):
+                yield wire_format.Frame(total_packets, packet_num, redundant_copies, copy_num, item_id, checksum,
+                                        rs_byte_chunk, fec_info, stream_id, flags, datagram_bytes, sent_ms,
+                                        suite.header_byte)
+
+
+def _encoded_packet_groups(view, chunk_bytes, total_packets, fec_overhead, fec_block_packets, repair_count, suite):
+    """ Yields (packet numbers, Reed Solomon encoded packets, checksums) of one erasure block with its repair
+    packets at a time, or of ENCODE_BATCH_PACKETS packets without erasure coding. """
+    group_packets = fec_block_packets if fec_overhead > 0 else ENCODE_BATCH_PACKETS
+    for block_nr, block_start in enumerate(range(0, total_packets, group_packets)):
+        block_end = min(block_start + group_packets, total_packets)
+        packets = [view[packet_nr * chunk_bytes:(packet_nr + 1) * chunk_bytes]
+                   for packet_nr in range(block_start, block_end)]
+        packet_nrs = list(range(block_start, block_end))
+        if fec_overhead > 0:
+            # Only the last block can be smaller, it gets repair packets in proportion to its size.
+            block_repair_count = erasure.repair_packet_count(len(packets), fec_overhead)
+            repair_start = total_packets + block_nr * repair_count
+            packet_nrs += range(repair_start, repair_start + block_repair_count)
+            packets += erasure.encode_block(packets, block_repair_count)
+        yield packet_nrs, diode_utils.rs_encode_batch(packets), [suite.chunk_checksum(packet) for packet in packets]
+
+
+def resolve_chunk_bytes(sending_interface, settings=DEFAULT_SETTINGS):
+    """ chunk_bytes from the settings, or the largest that fits the MTU of the link without IP fragmentation. """
+    if settings["legacy_pickle"]:
+        return CHUNK_BYTES
+    if settings["chunk_bytes"] > 0:
+        return settings["chunk_bytes"]
+    mtu = settings["mtu"] or transmit.interface_mtu(sending_interface)
+    return diode_utils.chunk_bytes_for_mtu(mtu)
+
+
+def resolve_batch_max_bytes(settings=DEFAULT_SETTINGS):
+    """ batch_max_bytes from the settings, or chunk_bytes if it is -1, so a batch item fills one datagram. """
+    if settings["batch_max_bytes"] < 0:
+        return settings["chunk_bytes"] or CHUNK_BYTES
+    return settings["batch_max_bytes"]
+
+
+def create_transmitter(diode_receiver_hostname, diode_receiver_port, sending_interface, settings=DEFAULT_SETTINGS):
+    interface = sending_interface if settings["bind_sending_interface"] else None
+    return transmit.UdpTransmitter(diode_receiver_hostname, diode_receiver_port, interface=interface,
+                                   rate_bits=settings["send_rate_mbit"] * 1_000_000,
+                                   burst_bytes=settings["send_burst_bytes"],
+                                   batch_packets=settings["send_batch_packets"],
+                                   send_buffer_bytes=settings["send_buffer_bytes"])
+
+
+def create_streams(redis_source_queue, config_streams, settings=DEFAULT_SETTINGS):
+    """ One Stream per stream_<id> line in the config file, see tools/stream_scheduler.py
+    redis_source_queue is stream 0, unless the config file has a stream_0 line. """
+    config_streams = dict(config_streams)
+    config_streams.setdefault(0, (redis_source_queue, {}))
+    streams = []
+    for stream_id, (redis_queue, options) in sorted(config_streams.items()):
+        streams.append(stream_scheduler.Stream(stream_id, redis_queue, weight=options.get("weight", 1.0),
+                                               priority=int(options.get("priority", 0)),
+                                               rate_bits=options.get("rate_mbit", 0.0) * 1_000_000,
+                                               burst_bytes=settings["send_burst_bytes"]))
+    return streams
+
+
+def send_item(item, stream, scheduler, transmitter, pack_frame, settings=DEFAULT_SETTINGS, flags=0, compressor=None,
+              suite=None, interleaver=None, done=None):
+    """ Sends an item, or a batch of items, on its stream and charges the bytes sent to the stream.
+    The item is compressed first if the compressor finds it worth it.
+    suite is the integrity.IntegritySuite of the checksums, see create_integrity_suite.
+    With an interleaver the item joins the in-flight items, and is sent interleaved with them.
+    done is called once every datagram of the item is sent, see sent_callback. """
+    started = time.thread_time()
+    if compressor:
+        item, compression_flags = compressor.compress(item)
+        flags |= compression_flags
+    item_generator = bytearray_to_udp_frame_generator(item,
+                                                      redundant_copies=settings["redundant_copies"],
+                                                      fec_overhead=settings["fec_overhead"],
+                                                      fec_block_packets=settings["fec_block_packets"],
+                                                      stream_id=stream.stream_id, flags=flags,
+                                                      chunk_bytes=settings["chunk_bytes"] or CHUNK_BYTES,
+                                                      sent_ms=wire_format.timestamp_ms(), suite=suite)
+    if interleaver:
+        datagrams = []
+        spread_datagrams = []  # Repair packets and extra copies
+        for frame in item_generator:
+            redundant = frame.copy_nr > 1 or frame.packet_nr >= frame.total_packets
+            (spread_datagrams if redundant else datagrams).append(pack_frame(frame))
+        interleaver.add(datagrams, spread_datagrams, done=done)
+        scheduler.charge(stream, sum(map(len, datagrams)) + sum(map(len, spread_datagrams)))
+        send_interleaved(interleaver, transmitter)
+    else:
+        sent_bytes = transmitter.sent_bytes
+        transmitter.send(pack_frame(frame) for frame in item_generator)
+        scheduler.charge(stream, transmitter.sent_bytes - sent_bytes)
+        if done:
+            done()
+    metrics.METRICS.inc("batches_sent" if flags & wire_format.FLAG_BATCH else "items_sent")
+    metrics.METRICS.observe("cpu_seconds_send_item", time.thread_time() - started, metrics.CPU_BUCKETS)
+
+
+def send_interleaved(interleaver, transmitter, drain=False):
+    """
+    Sends the datagrams of the in-flight items as they come due, see tools/interleave.py
+    Returns once fewer than interleave_depth items are in flight so the next item can join them, with drain
+    once everything is sent, waiting for spread datagrams that aren't due yet.
     """
-    unzipped = gzip.decompress(zipped_dict).decode('utf-8')
-    return unzipped
+    while interleaver.full() or (drain and interleaver.pending_datagrams):
+        ready = interleaver.pop_ready(transmitter.batch_packets)
+        if ready:
+            transmitter.send_batch(ready)
+            interleaver.sent()
+        else:
+            time.sleep(max(0.0, interleaver.next_release() - time.monotonic()))
+
 
+def send_due_interleaved(interleaver, transmitter):
+    """ Sends every datagram that is due without waiting, for when no new item is coming. """
+    ready = interleaver.pop_ready(transmitter.batch_packets)
+    while ready:
+        transmitter.send_batch(ready)
+        interleaver.sent()
+        ready = interleaver.pop_ready(transmitter.batch_packets)
 
-def udp_send_data(data, ip="localhost", port=8888):
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    client_socket.sendto(data, (ip, port))
 
+def create_interleaver(settings=DEFAULT_SETTINGS):
+    """ None when items are sent one after another. """
+    if settings["interleave_depth"] <= 1 and settings["interleave_spread_seconds"] <= 0:
+        return None
+    return interleave.Interleaver(settings["interleave_depth"], settings["interleave_spread_seconds"])
 
-def bytearray_to_udp_frame_generator(in_bytearray, redundant_copies=2):
-    """ Will Reed Solomon encode data, split it up and put it in some weird tuple frame, then yield a generator.
-    Format: (total_packets, packet_nr, redundant_copies_to_send, nr_of_copy, md5sum_data[-6:], md5sum_bytes[-2:], bytes)
+
+def create_compressor(settings=DEFAULT_SETTINGS):
+    """ None when compression is off, the legacy format can't carry the codec. """
+    if settings["compression"] == "none" or settings["legacy_pickle"]:
+        return None
+    return compression.Compressor(settings["compression"], settings["compression_level"],
+                                  settings["compression_min_bytes"], settings["compression_max_ratio"])
+
+
+def resolve_legacy_settings(settings=DEFAULT_SETTINGS):
+    """ Receivers of the legacy format can't take repair packets, with legacy_pickle erasure coding is off and
+    every item is sent at least LEGACY_REDUNDANT_COPIES times, like before the binary format. """
+    if not settings["legacy_pickle"]:
+        return settings
+    redundant_copies = max(settings["redundant_copies"], LEGACY_REDUNDANT_COPIES)
+    if settings["fec_overhead"] > 0:
+        print("[*] The legacy format has no erasure coding, sending %s copies of every item instead." % redundant_copies)
+    return dict(settings, fec_overhead=0.0, redundant_copies=redundant_copies)
+
+
+def create_integrity_suite(settings=DEFAULT_SETTINGS):
+    """ The legacy format carries md5 hexdigests. """
+    if settings["legacy_pickle"]:
+        return integrity.LEGACY_MD5
+    return integrity.IntegritySuite(settings["chunk_checksum"], settings["item_digest"])
+
+
+def attach_spools(streams, settings=DEFAULT_SETTINGS):
+    """ Replaces the pending deque of every stream with a spool on disk, in a directory per stream,
+    see tools/spool.py """
+    for stream in streams:
+        stream.pending = spool.PendingSpool(os.path.join(settings["spool_directory"], "stream_%s" % stream.stream_id),
+                                            segment_bytes=settings["spool_segment_bytes"],
+                                            max_bytes=settings["spool_max_bytes"], sync=settings["spool_sync"])
+
+
+def sent_callback(stream, unsent_items=0):
+    """ For a spooled stream, the done function of send_item: it acknowledges every item taken from the spool so
+    far, but for the last unsent_items that aren't part of what is sent. None for streams without a spool. """
+    if not isinstance(stream.pending, spool.PendingSpool):
+        return None
+    return stream.pending.sent_callback(stream.pending.taken_records - unsent_items)
+
+
+def drain_to_spools(redis_server, streams, settings=DEFAULT_SETTINGS):
     """
-    # Will send data $num if connection is crap
-    split_bytearray = diode_utils.bytearray_splitter_by_bytes(in_bytearray)
-    md5sum_bytearray = diode_utils.md5sum_bytestring(in_bytearray)
-    total_packets = len(split_bytearray)
-    copy_num = 0
-    for copy in range(redundant_copies):
-        copy_num += 1  # if redundant copies more than 1, send everything again.
-        for packet_num in range(len(split_bytearray)):
-            # RS Encode every chunk and add to frame, then send.
-            byte_chunk = split_bytearray[packet_num]
-            rs_byte_chunk = diode_utils.rs_encode(byte_chunk)
-            md5sum_bytes = diode_utils.md5sum_bytestring(split_bytearray[packet_num])
-            md5sum_data = md5sum_bytearray
-            packet_tuple = (
-                total_packets, packet_num, redundant_copies, copy_num, md5sum_data[-6:], md5sum_bytes[-2:],
-                rs_byte_chunk)
-            yield packet_tuple
-
-
-def listen_to_redis_send_diode(redis_queue, redis_hostname, redis_password):
+    Moves items from Redis to the spools of the streams, for up to SPOOL_DRAIN_ROUNDS round trips while Redis
+    hands out full batches, so a burst waits on disk and not in Redis.
+    Items are read, put in the spool and only then removed from Redis, a crash in between sends them twice
+    instead of losing them. Only the sender takes items from its queues, so nothing else moves them in between.
+    """
+    for _ in range(SPOOL_DRAIN_ROUNDS):
+        spooling_streams = [stream for stream in streams if not stream.pending.full()]
+        if not spooling_streams:
+            return
+        started = time.perf_counter()
+        redis_queues = [stream.redis_queue for stream in spooling_streams]
+        read_items = diode_utils.redis_read_items_multi(redis_server, redis_queues, count=settings["drain_batch_items"])
+        for stream, items in zip(spooling_streams, read_items):
+            if items:
+                stream.pending.extend(items)
+        diode_utils.redis_trim_items_multi(redis_server, redis_queues, [len(items) for items in read_items])
+        metrics.METRICS.observe("redis_drain_seconds", time.perf_counter() - started)
+        if all(len(items) < settings["drain_batch_items"] for items in read_items):
+            return
+
+
+def send_files(paths, transmitter, settings=DEFAULT_SETTINGS):
+    """
+    Sends files, and everything in directories, through the diode without Redis, see tools/file_transfer.py
+    Files are read from a memory mapping one block at a time, so memory use doesn't grow with the file size.
+    Returns the number of files sent.
     """
-    This function takes every item in a redis queue and sends them through the diode.
+    if settings["legacy_pickle"]:
+        print("[x] Receivers of the legacy format can't take files, set legacy_pickle = false.")
+        return 0
+    stream = stream_scheduler.Stream(0, None, burst_bytes=settings["send_burst_bytes"])
+    scheduler = stream_scheduler.FairScheduler([stream])
+    compressor = create_compressor(settings)
+    suite = create_integrity_suite(settings)
+    interleaver = create_interleaver(settings)
+    sent_files = 0
+    for path, relative_path in file_transfer.walk_files(paths):
+        started = time.monotonic()
+        sent_bytes = transmitter.sent_bytes
+        try:
+            for item in file_transfer.file_items(path, relative_path, settings["file_block_bytes"]):
+                send_item(item, stream, scheduler, transmitter, wire_format.pack_frame, settings,
+                          wire_format.FLAG_FILE, compressor, suite, interleaver)
+        except OSError as e:
+            print("[x] Could not send %s. %s" % (path, e))
+            continue
+        sent_files += 1
+        metrics.METRICS.inc("files_sent")
+        print("[*] Sent %s, %s bytes on the wire in %.1f seconds." % (
+            relative_path, transmitter.sent_bytes - sent_bytes, time.monotonic() - started))
+    if interleaver:
+        send_interleaved(interleaver, transmitter, drain=True)
+    return sent_files
+
+
+def listen_to_redis_send_diode(streams, redis_hostname, redis_port, redis_password, transmitter,
+                               settings=DEFAULT_SETTINGS):
+    """
+    This function takes every item in the redis queues of the streams and sends them through the diode.
+    Items are popped in batches, and the function blocks on empty queues instead of polling them,
+    except with a spool, where empty queues are polled so an item is only removed from Redis once it is on disk.
+    Which stream sends the next item is decided by the fair scheduler, see tools/stream_scheduler.py
+    Small items are packed together into batch items, see tools/batching.py
+    Frames are sent in paced batches by the transmitter, see tools/transmit.py
+    With interleave_depth or interleave_spread_seconds the datagrams of several items are interleaved,
+    see tools/interleave.py
+    With spool_directory items go from Redis to a spool on disk first, and are taken from it as they are sent,
+    see drain_to_spools.
 
     """
     connected = True
-    redis_server = diode_utils.redis_connect_server(ip=redis_hostname, password=redis_password)
+    settings = resolve_legacy_settings(settings)
+    redis_server = diode_utils.redis_connect_server(ip=redis_hostname, port=redis_port, password=redis_password)
     published_items = 0
+    scheduler = stream_scheduler.FairScheduler(streams)
+    streams_by_queue = {stream.redis_queue: stream for stream in streams}
+    if settings["legacy_pickle"] and len(streams) > 1:
+        print("[x] The legacy format has no stream id, the receiver puts every stream on one queue.")
+    pack_frame = wire_format.pack_legacy_frame if settings["legacy_pickle"] else wire_format.pack_frame
+    compressor = create_compressor(settings)
+    suite = create_integrity_suite(settings)
+    interleaver = create_interleaver(settings)
+    spooled = bool(settings["spool_directory"])
+    if spooled:
+        attach_spools(streams, settings)
+        metrics.METRICS.register_function("spool_bytes", lambda: sum(stream.pending.used_bytes for stream in streams))
+    metrics.METRICS.register_function("packets_sent", lambda: transmitter.sent_packets)
+    metrics.METRICS.register_function("bytes_sent", lambda: transmitter.sent_bytes)
+    metrics.METRICS.register_function("packets_refused", lambda: transmitter.refused_packets)
+    metrics.METRICS.register_function("items_published", lambda: published_items)
+    metrics.METRICS.register_function("pending_items", lambda: sum(len(stream.pending) for stream in streams))
+    if compressor:
+        metrics.METRICS.register_function("items_compressed", lambda: compressor.compressed_items)
+        metrics.METRICS.register_function("compression_bytes_saved", lambda: compressor.bytes_in - compressor.bytes_out)
+    batcher = None
+    batch_max_bytes = resolve_batch_max_bytes(settings)
+    if batch_max_bytes > 0 and not settings["legacy_pickle"]:
+        batcher = batching.ItemBatcher(batch_max_bytes, settings["batch_linger_seconds"])
     while connected:
-        time_string = time.ctime()
-        item_to_publish = redis_server.lpop(redis_queue)
-        # item_to_publish = decompress_dict(item_to_publish)
-        if not item_to_publish:
-            print("%s:  Redis queue empty, published: %s items" % (time_string, published_items))
-            time.sleep(SLEEP_TIME_SECONDS)
-        elif len(item_to_publish) == 0:
-            time.sleep(SLEEP_TIME_SECONDS)
-            print("0byte object from redis.")
-        else:
+        if batcher:
+            for stream, batch in batcher.pop_due():
+                send_item(batch, stream, scheduler, transmitter, pack_frame, settings, wire_format.FLAG_BATCH,
+                          compressor, suite, interleaver, sent_callback(stream))
+        if spooled:
+            drain_to_spools(redis_server, streams, settings)
+        # Refills the streams that ran dry, one round trip for all of them.
+        empty_streams = [] if spooled else [stream for stream in streams if not stream.pending]
+        if empty_streams:
+            started = time.perf_counter()
+            popped_items = diode_utils.redis_pop_items_multi(redis_server,
+                                                             [stream.redis_queue for stream in empty_streams],
+                                                             count=settings["drain_batch_items"])
+            for stream, items in zip(empty_streams, popped_items):
+                stream.pending.extend(items)
+            metrics.METRICS.observe("redis_drain_seconds", time.perf_counter() - started)
+        if not any(stream.pending for stream in streams):
+            if interleaver:
+                send_due_interleaved(interleaver, transmitter)  # No new items to interleave them with
+            deadlines = [deadline for deadline in (batcher.next_deadline() if batcher else None,
+                                                   interleaver.next_release() if interleaver else None)
+                         if deadline is not None]
+            if deadlines:
+                # Open batches or spread datagrams, wait until the first one is due instead of blocking.
+                time.sleep(max(0.0, min(deadlines) - time.monotonic()))
+                continue
+            if spooled:
+                # Waits without popping, drain_to_spools moves the items once they are on disk.
+                if not diode_utils.redis_wait_items(redis_server, list(streams_by_queue),
+                                                    max_wait_seconds=settings["drain_max_wait_seconds"],
+                                                    poll_seconds=SPOOL_POLL_SECONDS):
+                    print("%s:  Redis queues empty, published: %s items" % (time.ctime(), published_items))
+                continue
+            # Every queue is empty, block until data arrives on any of them.
+            popped = diode_utils.redis_wait_item(redis_server, list(streams_by_queue),
+                                                 max_wait_seconds=settings["drain_max_wait_seconds"])
+            if popped is None:
+                print("%s:  Redis queues empty, published: %s items" % (time.ctime(), published_items))
+                continue
+            streams_by_queue[popped[0]].pending.append(popped[1])
+
+        # Sends up to a batch of items before Redis is looked at again.
+        for _ in range(settings["drain_batch_items"]):
+            stream, wait_seconds = scheduler.next_stream()
+            if stream is None:
+                if wait_seconds:
+                    time.sleep(min(wait_seconds, settings["drain_max_wait_seconds"]))  # All over their rate limit
+                break
+            item_to_publish = stream.pending.popleft()
+            if len(item_to_publish) == 0:
+                print("0byte object from redis.")
+                continue
             """ If there is data in the object from Redis, send to diode.
              First split object to chunks and add reed solomon information
              Make sure object is a bytes """
             if type(item_to_publish) != bytes:
                 item_to_publish = item_to_publish.encode()
-            item_generator = bytearray_to_udp_frame_generator(item_to_publish)
-
-            try:
-                while item_generator:
-                    send_item = pickle.dumps(next(item_generator))
-                    # send_item = next(item_generator)
-                    udp_send_data(send_item)
-                    time.sleep(0.001)  # This was necessary in one test occasion.
-            except StopIteration:
-                # Exhausted the generator containing bytes from object to send.
-                if DEBUG:
-                    print("[*] Sent item.")
+            if batcher and len(item_to_publish) <= settings["batch_item_max_bytes"] and batcher.fits(item_to_publish):
+                full_batch = batcher.add(stream, item_to_publish)
+                if full_batch:
+                    # The item that didn't fit is in the next batch.
+                    send_item(full_batch, stream, scheduler, transmitter, pack_frame, settings, wire_format.FLAG_BATCH,
+                              compressor, suite, interleaver, sent_callback(stream, unsent_items=1))
+            else:
+                open_batch = batcher.pop(stream) if batcher else None
+                if open_batch:
+                    # Sent first, so the items of a stream arrive in the order they were popped.
+                    send_item(open_batch, stream, scheduler, transmitter, pack_frame, settings, wire_format.FLAG_BATCH,
+                              compressor, suite, interleaver, sent_callback(stream, unsent_items=1))
+                send_item(item_to_publish, stream, scheduler, transmitter, pack_frame, settings, compressor=compressor,
+                          suite=suite, interleaver=interleaver, done=sent_callback(stream))
+            if DEBUG:
+                print("[*] Sent item on stream %s." % stream.stream_id)
 
             published_items += 1
             if published_items % 2000 == 1:
                 print("[*] Sent %s items." % published_items)
-                exit()
+            if not stream.pending:
+                break  # Refill it before the others get ahead of their share
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Sends the items of Redis queues through the diode.")
+    parser.add_argument("--send-files", nargs="+", metavar="PATH",
+                        help="send these files and directories instead, without Redis, then exit")
+    args = parser.parse_args()
     diode_receiver_hostname, diode_receiver_port, sending_interface, redis_source_queue, redis_hostname, redis_port, redis_password = read_config()
-    listen_to_redis_send_diode(redis_source_queue, redis_hostname, redis_password)
+    settings = diode_utils.read_config_settings(CONFIG_FILE, DEFAULT_SETTINGS)
+    settings["chunk_bytes"] = resolve_chunk_bytes(sending_interface, settings)
+    metrics.start_exporters(settings)
+    print("[*] Sending %s item bytes per datagram." % settings["chunk_bytes"])
+    transmitter = create_transmitter(diode_receiver_hostname, diode_receiver_port, sending_interface, settings)
+    if args.send_files:
+        send_files(args.send_files, transmitter, settings)
+        return
+    streams = create_streams(redis_source_queue, diode_utils.read_config_streams(CONFIG_FILE), settings)
+    listen_to_redis_send_diode(streams, redis_hostname, redis_port, redis_password, transmitter, settings)
 
 
-main()
+if __name__ == "__main__":
+    main()
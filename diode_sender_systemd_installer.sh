@@ -6,7 +6,7 @@ sudo mkdir  -p $INSTALLDIR
 
 
 # Move files
-sudo cp ./diode_sender.py ./diode_sender.conf ./diode_utils.py $INSTALLDIR
+sudo cp ./diode_sender.py ./diode_sender.conf -r ./tools $INSTALLDIR
 
 
 # -u implies unbuffered output
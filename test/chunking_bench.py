@@ -0,0 +1,63 @@
+""" Micro benchmark of the memoryview chunk splitter and joiner against the old per byte loops.
+Time per MB should stay flat as items grow, the old loops are only run on the smaller sizes.
+Run from the repository root: PYTHONPATH=. python test/chunking_bench.py """
+import os
+import timeit
+
+from tools import diode_utils
+
+
+def per_byte_splitter(in_bytes, split_bytes=1024):
+    """ The splitter this replaced, one append per byte. """
+    out_list = []
+    _bytearray = bytearray()
+    for counter, i in enumerate(in_bytes, 1):
+        _bytearray.append(i)
+        if counter % split_bytes == 0:
+            out_list.append(_bytearray)
+            _bytearray = bytearray()
+    if _bytearray:
+        out_list.append(_bytearray)
+    return tuple(out_list)
+
+
+def per_byte_joiner(sequence_of_bytearrays):
+    _bytearray = bytearray()
+    for item in sequence_of_bytearrays:
+        for item_byte in item:
+            _bytearray.append(item_byte)
+    return bytes(_bytearray)
+
+
+def _mb_per_second(function, data, repeat):
+    seconds = min(timeit.repeat(lambda: function(data), number=1, repeat=repeat))
+    return len(data) / seconds / 1_000_000 if seconds else float("inf")
+
+
+def bench_chunking(sizes=(64 * 1024, 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024),
+                   chunk_bytes=1024, per_byte_limit=1024 * 1024):
+    results = {}
+    print("%12s %14s %14s %14s %14s %10s" % ("bytes", "split MB/s", "join MB/s", "old split", "old join", "memcpy"))
+    for size in sizes:
+        data = os.urandom(size)
+        chunks = diode_utils.chunk_splitter(data, chunk_bytes)
+        assert diode_utils.chunk_joiner(chunks) == data
+        row = {
+            "split": _mb_per_second(lambda d: diode_utils.chunk_splitter(d, chunk_bytes), data, 5),
+            "join": _mb_per_second(lambda d: diode_utils.chunk_joiner(chunks), data, 5),
+            "memcpy": _mb_per_second(bytearray, data, 5),
+        }
+        if size <= per_byte_limit:
+            old_chunks = per_byte_splitter(data, chunk_bytes)
+            row["old_split"] = _mb_per_second(lambda d: per_byte_splitter(d, chunk_bytes), data, 1)
+            row["old_join"] = _mb_per_second(lambda d: per_byte_joiner(old_chunks), data, 1)
+        results[size] = row
+        print("%12s %14.0f %14.0f %14s %14s %10.0f" % (
+            size, row["split"], row["join"],
+            "%.1f" % row["old_split"] if "old_split" in row else "-",
+            "%.1f" % row["old_join"] if "old_join" in row else "-", row["memcpy"]))
+    return results
+
+
+if __name__ == "__main__":
+    bench_chunking()
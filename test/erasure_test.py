@@ -0,0 +1,92 @@
+import itertools
+import os
+import random
+
+from tools import erasure, reassembly
+
+CHUNK_BYTES = 100
+BLOCK_PACKETS = 8
+OVERHEAD = 0.25
+
+
+def erasure_packets(item):
+    """ {packet_nr: packet} and fec_info of an item, numbered like the sender does. """
+    data_packets = [item[offset:offset + CHUNK_BYTES] for offset in range(0, len(item), CHUNK_BYTES)]
+    total_packets = len(data_packets)
+    repair_count = erasure.repair_packet_count(BLOCK_PACKETS, OVERHEAD)
+    packets = dict(enumerate(data_packets))
+    for block_nr, block_start in enumerate(range(0, total_packets, BLOCK_PACKETS)):
+        block = data_packets[block_start:block_start + BLOCK_PACKETS]
+        repairs = erasure.encode_block(block, erasure.repair_packet_count(len(block), OVERHEAD))
+        for repair_nr, repair in enumerate(repairs):
+            packets[total_packets + block_nr * repair_count + repair_nr] = repair
+    return packets, total_packets, (BLOCK_PACKETS, repair_count, len(item), CHUNK_BYTES)
+
+
+def block_packet_nrs(total_packets, repair_count, block_nr):
+    """ Data and then repair packet numbers of a block. """
+    block_start = block_nr * BLOCK_PACKETS
+    data_count = min(BLOCK_PACKETS, total_packets - block_start)
+    repair_start = total_packets + block_nr * repair_count
+    return (list(range(block_start, block_start + data_count)) +
+            list(range(repair_start, repair_start + erasure.repair_packet_count(data_count, OVERHEAD))))
+
+
+def reassemble(packets, total_packets, fec_info, lost_packet_nrs):
+    item = reassembly.ItemReassembly(total_packets, fec_info)
+    received = [packet_nr for packet_nr in packets if packet_nr not in lost_packet_nrs]
+    random.Random(len(lost_packet_nrs)).shuffle(received)
+    complete = False
+    for packet_nr in received:
+        complete = item.add(packet_nr, packets[packet_nr])
+    return item, complete
+
+
+def test_decode_block_any_k_losses():
+    data_packets = [os.urandom(CHUNK_BYTES) for _ in range(7)] + [os.urandom(37)]
+    repair_packets = erasure.encode_block(data_packets, 3)
+    block = dict(enumerate(data_packets + repair_packets))
+    padded = [packet + bytes(CHUNK_BYTES - len(packet)) for packet in data_packets]
+    for lost in itertools.combinations(block, 3):
+        received = {index: packet for index, packet in block.items() if index not in lost}
+        assert erasure.decode_block(received, len(data_packets), CHUNK_BYTES) == padded
+
+
+def test_decode_block_too_many_losses():
+    data_packets = [os.urandom(CHUNK_BYTES) for _ in range(8)]
+    block = dict(enumerate(data_packets + erasure.encode_block(data_packets, 2)))
+    for lost in ((0, 1, 2), (0, 8, 9), (5, 6, 7)):
+        received = {index: packet for index, packet in block.items() if index not in lost}
+        assert erasure.decode_block(received, len(data_packets), CHUNK_BYTES) is None
+
+
+def test_reassembly_k_losses_per_block():
+    # 3 full blocks and a short last block of 5 packets, the last one 42 bytes.
+    item = os.urandom(CHUNK_BYTES * 28 + 42)
+    packets, total_packets, fec_info = erasure_packets(item)
+    repair_count = fec_info[1]
+    block_count = -(-total_packets // BLOCK_PACKETS)
+    for positions in ((0, 1), (-2, -1), (0, -1), (3, 6), (-3, -2)):
+        # Data packets at the start and the end of every block, repair packets, one of each.
+        lost_packet_nrs = set()
+        for block_nr in range(block_count):
+            block_nrs = block_packet_nrs(total_packets, repair_count, block_nr)
+            lost_packet_nrs.update(block_nrs[position] for position in positions)
+        reassembled, complete = reassemble(packets, total_packets, fec_info, lost_packet_nrs)
+        assert complete, positions
+        assert bytes(reassembled.payload()) == item
+
+
+def test_reassembly_k_plus_one_losses_never_completes():
+    item = os.urandom(CHUNK_BYTES * 20 + 1)
+    packets, total_packets, fec_info = erasure_packets(item)
+    repair_count = fec_info[1]
+    for block_nr in range(-(-total_packets // BLOCK_PACKETS)):
+        # The short last block has fewer repair packets, it fails with fewer losses.
+        block_nrs = block_packet_nrs(total_packets, repair_count, block_nr)
+        data_count = min(BLOCK_PACKETS, total_packets - block_nr * BLOCK_PACKETS)
+        lost_packet_nrs = set(block_nrs[:len(block_nrs) - data_count + 1])
+        reassembled, complete = reassemble(packets, total_packets, fec_info, lost_packet_nrs)
+        assert not complete
+        assert reassembled.missing > 0
+        assert not reassembled.has(block_nrs[0])
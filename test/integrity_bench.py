@@ -0,0 +1,51 @@
+""" Micro benchmark of chunk checksums and item digests, against the md5 hexdigests they replaced.
+"md5 hex (before)" is what every chunk and item cost before tools/integrity.py: an md5 hexdigest, cut down and
+turned back into an integer for the frame header.
+Run from the repository root: PYTHONPATH=. python test/integrity_bench.py """
+import hashlib
+import os
+import timeit
+
+from tools import diode_utils, integrity
+
+
+def md5_hex_chunk_checksum(data):
+    return int(hashlib.md5(data).hexdigest()[-8:], 16)
+
+
+def md5_hex_item_digest(data):
+    return int(hashlib.md5(data).hexdigest()[-16:], 16)
+
+
+def bench(functions, sizes, iterations):
+    for size in sizes:
+        data = os.urandom(size)
+        print("%s bytes" % size)
+        for name, function in functions.items():
+            seconds = timeit.timeit(lambda: function(data), number=iterations) / iterations
+            print("  %-18s %9.3f us %9.1f MB/s" % (name, seconds * 1_000_000, size / seconds / 1_000_000))
+
+
+def bench_integrity(iterations=20_000):
+    chunk_functions = {"md5 hex (before)": md5_hex_chunk_checksum, "md5": integrity.md5_chunk_checksum,
+                       "crc32": integrity.CHUNK_FUNCTIONS[integrity.CHUNK_CRC32]}
+    if integrity.CHUNK_FUNCTIONS[integrity.CHUNK_CRC32C] is not integrity.crc32c_python:
+        chunk_functions["crc32c"] = integrity.CHUNK_FUNCTIONS[integrity.CHUNK_CRC32C]
+    else:
+        print("crc32c package not installed, timing the Python fallback")
+        chunk_functions["crc32c (python)"] = integrity.crc32c_python
+    print("Chunk checksums")
+    bench(chunk_functions, [1024, diode_utils.chunk_bytes_for_mtu(1500), diode_utils.chunk_bytes_for_mtu(9000)],
+          iterations)
+
+    item_functions = {"md5 hex (before)": md5_hex_item_digest, "blake2b": integrity.blake2b_item_digest}
+    if integrity.ITEM_XXH3 in integrity.ITEM_FUNCTIONS:
+        item_functions["xxh3"] = integrity.ITEM_FUNCTIONS[integrity.ITEM_XXH3]
+    else:
+        print("xxhash package not installed, xxh3 not timed")
+    print("Item digests")
+    bench(item_functions, [256, 65536, 1048576], max(1, iterations // 100))
+
+
+if __name__ == "__main__":
+    bench_integrity()
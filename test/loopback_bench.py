@@ -0,0 +1,380 @@
+""" Loopback benchmark of the sender and receiver, with loss injection.
+
+Runs diode_sender and diode_receiver in one process over 127.0.0.1 against in-process Redis stand-ins,
+with a UDP proxy in between that drops datagrams (at random and in bursts), reorders and duplicates them.
+Every scenario reports items/s, MB/s, p50/p99 item latency, CPU seconds per MB and the delivery ratio,
+and all results are written to a JSON file so runs can be compared to catch regressions.
+Latency is from the push on the source queue to the RPUSH on the destination queue, all items of a scenario
+are pushed at once so it includes the time spent waiting in the source queue.
+CPU is the CPU time of the whole process: sender, proxy and receiver together.
+Every scenario runs in a process of its own: the sender, receiver and proxy threads never stop by themselves, and
+the receiver keeps its state in module globals, so in one process they would carry over into the next scenario
+and add to its CPU time.
+
+Run from the repository root: PYTHONPATH=. python test/loopback_bench.py [--quick] [--output loopback_bench.json]
+"""
+import argparse
+import collections
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+
+import diode_receiver
+import diode_sender
+from tools import diode_utils, reed_solomon
+
+ITEM_HEADER = struct.Struct("!Qd")  # Item index and push time, the rest of the item is random
+
+REDUNDANCY = {
+    "fec_25": {"fec_overhead": 0.25, "redundant_copies": 1},
+    "fec_50": {"fec_overhead": 0.5, "redundant_copies": 1},
+    "copies_2": {"fec_overhead": 0.0, "redundant_copies": 2},
+}
+
+LOSS_PROFILES = {
+    "clean": {},
+    "random_1pct": {"loss": 0.01},
+    "burst_reorder_dup": {"burst_loss": 0.002, "burst_length": 8, "reorder": 0.01, "duplicate": 0.01},
+    "burst_8": {"burst_loss": 0.005, "burst_length": 8},
+}
+
+ITEM_SIZES = {64: 20000, 4096: 2000, 262144: 40}  # Item bytes: items per scenario
+QUICK_ITEM_SIZES = {64: 2000, 4096: 200, 262144: 8}
+
+
+class FakeRedis:
+    """ The list commands the sender and the receiver use, in memory and thread safe. """
+
+    def __init__(self, on_push=None):
+        self.lists = collections.defaultdict(collections.deque)
+        self.values = {}
+        self.condition = threading.Condition()
+        self.on_push = on_push
+
+    def set(self, key, value):
+        self.values[key] = value.encode() if isinstance(value, str) else value
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def rpush(self, key, *items):
+        items = [bytes(item) for item in items]  # The receiver pushes views of its reassembly buffers
+        with self.condition:
+            self.lists[key].extend(items)
+            self.condition.notify_all()
+        if self.on_push:
+            self.on_push(key, items)
+        return len(self.lists[key])
+
+    def lpop(self, key, count=None):
+        with self.condition:
+            items = self.lists.get(key)
+            if not items:
+                return None
+            if count is None:
+                return items.popleft()
+            return [items.popleft() for _ in range(min(count, len(items)))]
+
+    def llen(self, key):
+        with self.condition:
+            return len(self.lists.get(key, ()))
+
+    def lrange(self, key, start, end):
+        with self.condition:
+            items = list(self.lists.get(key, ()))
+        return items[start:None if end == -1 else end + 1]
+
+    def ltrim(self, key, start, end):
+        with self.condition:
+            items = self.lists.get(key)
+            if items:
+                self.lists[key] = collections.deque(list(items)[start:None if end == -1 else end + 1])
+        return True
+
+    def blpop(self, keys, timeout=0):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                for key in keys:
+                    if self.lists.get(key):
+                        return key.encode(), self.lists[key].popleft()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+
+    def __init__(self, redis_server):
+        self.redis_server = redis_server
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args):
+            self.commands.append((name, args))
+            return self
+        return command
+
+    def execute(self, raise_on_error=True):
+        results = []
+        for name, args in self.commands:
+            try:
+                results.append(getattr(self.redis_server, name)(*args))
+            except Exception as e:
+                if raise_on_error:
+                    raise
+                results.append(e)
+        self.commands = []
+        return results
+
+
+class LossyProxy:
+    """
+    Forwards datagrams to 127.0.0.1:target_port.
+    loss drops a datagram at random, burst_loss starts a burst of burst_length dropped datagrams,
+    reorder holds a datagram back until up to reorder_depth later ones went through, duplicate sends it twice.
+    """
+
+    def __init__(self, target_port, loss=0.0, burst_loss=0.0, burst_length=8, reorder=0.0, reorder_depth=8,
+                 duplicate=0.0, seed=1):
+        self.loss = loss
+        self.burst_loss = burst_loss
+        self.burst_length = burst_length
+        self.reorder = reorder
+        self.reorder_depth = reorder_depth
+        self.duplicate = duplicate
+        self.random = random.Random(seed)
+        self.counters = {"received": 0, "forwarded": 0, "dropped": 0, "reordered": 0, "duplicated": 0}
+        self.burst_left = 0
+        self.held = []  # [datagrams to let through first, datagram]
+
+        self.in_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.in_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8388608)
+        self.in_socket.bind(("127.0.0.1", 0))
+        self.in_socket.settimeout(0.05)
+        self.port = self.in_socket.getsockname()[1]
+        self.out_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.out_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 8388608)
+        self.out_socket.connect(("127.0.0.1", target_port))
+        threading.Thread(target=self._run, name="lossy-proxy", daemon=True).start()
+
+    def _forward(self, datagram):
+        self.out_socket.send(datagram)
+        self.counters["forwarded"] += 1
+
+    def _release_held(self, everything=False):
+        still_held = []
+        for entry in self.held:
+            entry[0] -= 1
+            if everything or entry[0] <= 0:
+                self._forward(entry[1])
+            else:
+                still_held.append(entry)
+        self.held = still_held
+
+    def _run(self):
+        while True:
+            try:
+                datagram = self.in_socket.recv(65535)
+            except socket.timeout:
+                self._release_held(everything=True)  # Traffic stopped, nothing is coming to pass them
+                continue
+            self.counters["received"] += 1
+            if self.burst_left:
+                self.burst_left -= 1
+                self.counters["dropped"] += 1
+                continue
+            if self.burst_loss and self.random.random() < self.burst_loss:
+                self.burst_left = self.burst_length - 1
+                self.counters["dropped"] += 1
+                continue
+            if self.loss and self.random.random() < self.loss:
+                self.counters["dropped"] += 1
+                continue
+            if self.reorder and self.random.random() < self.reorder:
+                self.held.append([self.random.randint(1, self.reorder_depth), datagram])
+                self.counters["reordered"] += 1
+                continue
+            self._forward(datagram)
+            if self.duplicate and self.random.random() < self.duplicate:
+                self._forward(datagram)
+                self.counters["duplicated"] += 1
+            self._release_held()
+
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class Deliveries:
+    """ Checks every item pushed on the destination queue against what was sent. """
+
+    def __init__(self, payloads):
+        self.payloads = payloads
+        self.latencies = {}  # Item index: seconds
+        self.duplicates = 0
+        self.corrupted = 0
+        self.bytes = 0
+        self.last_delivery = time.perf_counter()
+        self.condition = threading.Condition()
+
+    def on_push(self, key, items):
+        now = time.perf_counter()
+        with self.condition:
+            for item in items:
+                if len(item) < ITEM_HEADER.size:
+                    self.corrupted += 1
+                    continue
+                index, pushed = ITEM_HEADER.unpack_from(item)
+                if index >= len(self.payloads) or item[ITEM_HEADER.size:] != self.payloads[index]:
+                    self.corrupted += 1
+                elif index in self.latencies:
+                    self.duplicates += 1
+                else:
+                    self.latencies[index] = now - pushed
+                    self.bytes += len(item)
+            self.last_delivery = now
+            self.condition.notify_all()
+
+    def wait(self, count, idle_seconds, timeout_seconds):
+        """ Waits until every item arrived, nothing arrived for idle_seconds, or timeout_seconds passed. """
+        deadline = time.perf_counter() + timeout_seconds
+        with self.condition:
+            while len(self.latencies) < count:
+                now = time.perf_counter()
+                if now >= deadline or now - self.last_delivery >= idle_seconds:
+                    break
+                self.condition.wait(0.1)
+
+
+def run_scenario(item_bytes, item_count, redundancy, loss_profile, rate_mbit, seed, interleave=(1, 0.0),
+                 idle_seconds=5.0, timeout_seconds=120.0):
+    """ interleave is (interleave_depth, interleave_spread_seconds) of the sender. """
+    source_port, destination_port = free_udp_port(), free_udp_port()  # Only used to tell the fakes apart
+    rng = random.Random(seed)
+    payloads = [rng.randbytes(max(0, item_bytes - ITEM_HEADER.size)) for _ in range(item_count)]
+    deliveries = Deliveries(payloads)
+    fakes = {source_port: FakeRedis(), destination_port: FakeRedis(deliveries.on_push)}
+    diode_utils.redis_connect_server = lambda ip="localhost", port=6379, password="", db=0: fakes[port]
+
+    receiver_port = free_udp_port()
+    threading.Thread(target=diode_receiver.start_udp_server,
+                     args=("127.0.0.1", receiver_port, "fake", destination_port, "", "diode_in"),
+                     kwargs={"settings": dict(diode_receiver.DEFAULT_SETTINGS)}, daemon=True).start()
+    proxy = LossyProxy(receiver_port, seed=seed, **LOSS_PROFILES[loss_profile])
+
+    settings = dict(diode_sender.DEFAULT_SETTINGS, send_rate_mbit=rate_mbit, mtu=1500, interleave_depth=interleave[0],
+                    interleave_spread_seconds=interleave[1], **REDUNDANCY[redundancy])
+    settings["chunk_bytes"] = diode_sender.resolve_chunk_bytes("lo", settings)
+    transmitter = diode_sender.create_transmitter("127.0.0.1", proxy.port, "lo", settings)
+    streams = diode_sender.create_streams("diode_out", {}, settings)
+    time.sleep(0.2)  # Receiver socket bound
+
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    fakes[source_port].rpush("diode_out", *[ITEM_HEADER.pack(index, time.perf_counter()) + payload
+                                            for index, payload in enumerate(payloads)])
+    threading.Thread(target=diode_sender.listen_to_redis_send_diode,
+                     args=(streams, "fake", source_port, "", transmitter, settings), daemon=True).start()
+    deliveries.wait(item_count, idle_seconds, timeout_seconds)
+    cpu_seconds = time.process_time() - cpu_started
+    delivered = len(deliveries.latencies)
+    duration = max(deliveries.last_delivery - started, 1e-9) if delivered else None
+    megabytes = deliveries.bytes / 1_000_000
+    latencies = sorted(deliveries.latencies.values())
+    return {
+        "item_bytes": item_bytes, "items": item_count, "redundancy": redundancy, "loss": loss_profile,
+        "rate_mbit": rate_mbit, "interleave_depth": interleave[0], "interleave_spread_seconds": interleave[1],
+        "delivered": delivered, "delivery_ratio": delivered / item_count,
+        "duplicates_delivered": deliveries.duplicates, "corrupted": deliveries.corrupted,
+        "duration_seconds": duration,
+        "items_per_second": delivered / duration if duration else 0.0,
+        "mb_per_second": megabytes / duration if duration else 0.0,
+        "latency_p50_ms": percentile(latencies, 0.5) * 1000 if latencies else None,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+        "cpu_seconds_per_mb": cpu_seconds / megabytes if megabytes else None,
+        "datagrams_sent": transmitter.sent_packets, "wire_bytes": transmitter.sent_bytes,
+        "items_per_wire_mb": delivered / (transmitter.sent_bytes / 1_000_000) if transmitter.sent_bytes else 0.0,
+        "proxy": dict(proxy.counters),
+    }
+
+
+def _scenario_process(verbose, *args):
+    if not verbose:
+        sys.stdout = open(os.devnull, "w")  # Status lines of the sender and receiver threads
+    return run_scenario(*args)
+
+
+def run_isolated_scenario(verbose, *args):
+    """ run_scenario in a new process, its threads and the receiver's module state end with it. """
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(_scenario_process, verbose, *args).result()
+
+
+def environment():
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "numpy": reed_solomon.np is not None, "cpu_count": os.cpu_count(), "timestamp": time.time()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="fewer items per scenario")
+    parser.add_argument("--output", default="loopback_bench.json")
+    parser.add_argument("--rate-mbit", type=float, default=200.0, help="sender pacing, 0 = unpaced")
+    parser.add_argument("--redundancy", nargs="+", default=["fec_25", "copies_2"], choices=sorted(REDUNDANCY))
+    parser.add_argument("--loss", nargs="+", default=sorted(LOSS_PROFILES), choices=sorted(LOSS_PROFILES))
+    parser.add_argument("--interleave", nargs="+", default=["1:0"], metavar="DEPTH:SPREAD",
+                        help="interleave_depth:interleave_spread_seconds of the sender, e.g. 8:0.05")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="keep the output of the sender and receiver")
+    args = parser.parse_args()
+
+    results = {"environment": environment(), "scenarios": []}
+    item_sizes = QUICK_ITEM_SIZES if args.quick else ITEM_SIZES
+    interleaves = [(int(depth), float(spread)) for depth, spread in (value.split(":") for value in args.interleave)]
+    print("%9s %7s %-10s %-18s %-10s %9s %8s %9s %9s %9s %10s %9s" % (
+        "bytes", "items", "redundancy", "loss", "interleave", "items/s", "MB/s", "p50 ms", "p99 ms", "cpu s/MB",
+        "items/wMB", "delivered"), flush=True)
+    for item_bytes, item_count in item_sizes.items():
+        for redundancy in args.redundancy:
+            for loss_profile in args.loss:
+                for interleave in interleaves:
+                    result = run_isolated_scenario(args.verbose, item_bytes, item_count, redundancy, loss_profile,
+                                                   args.rate_mbit, args.seed, interleave)
+                    results["scenarios"].append(result)
+                    print("%9s %7s %-10s %-18s %-10s %9.0f %8.2f %9s %9s %9s %10.1f %8.2f%%" % (
+                        item_bytes, item_count, redundancy, loss_profile, "%s:%s" % interleave,
+                        result["items_per_second"], result["mb_per_second"], _format(result["latency_p50_ms"]),
+                        _format(result["latency_p99_ms"]), _format(result["cpu_seconds_per_mb"]),
+                        result["items_per_wire_mb"], result["delivery_ratio"] * 100), flush=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=1)
+    print("Results written to %s" % args.output, flush=True)
+
+
+def _format(value):
+    return "-" if value is None else "%.2f" % value
+
+
+if __name__ == "__main__":
+    main()
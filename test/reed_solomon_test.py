@@ -0,0 +1,28 @@
+import os
+
+from tools import diode_utils, reed_solomon
+
+
+def corrupt(encoded_chunk, offset):
+    corrupted = bytearray(encoded_chunk)
+    corrupted[offset] ^= 0xff
+    return corrupted
+
+
+def test_check_batch_mixed_chunks():
+    codec = reed_solomon.get_codec(4)
+    chunks = [os.urandom(size) for size in (600, 100, 600, 251, 1)]
+    encoded_chunks = codec.encode_batch(chunks)
+    # Errors in the first and last block of multi block chunks, next to clean chunks of other lengths.
+    mixed_chunks = [corrupt(encoded_chunks[0], 3), encoded_chunks[1], corrupt(encoded_chunks[2], 600),
+                    encoded_chunks[3], encoded_chunks[4]]
+    assert codec.check_batch(mixed_chunks) == [False, True, False, True, True]
+    assert codec.check_batch(mixed_chunks) == [codec.check(chunk) for chunk in mixed_chunks]
+    assert codec.decode_batch(mixed_chunks) == chunks
+
+
+def test_decode_batch_uncorrectable_chunk():
+    encoded_chunk = diode_utils.rs_encode(bytes(range(200)))
+    for offset in range(4):
+        encoded_chunk = corrupt(encoded_chunk, offset)
+    assert diode_utils.rs_decode_batch([encoded_chunk, diode_utils.rs_encode(b"ok")]) == [None, b"ok"]
@@ -0,0 +1,70 @@
+import os
+
+from tools import spool
+
+
+def segment_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(spool.SEGMENT_SUFFIX))
+
+
+def test_reopen_after_partial_acknowledge(tmp_path):
+    items = [b"item %d" % nr for nr in range(10)]
+    first_spool = spool.Spool(str(tmp_path))
+    first_spool.put((b"queue", item) for item in items)
+    assert first_spool.take(4) == [(b"queue", item) for item in items[:4]]
+    first_spool.acknowledge(3)
+    first_spool.close()
+    # The fourth item was taken but not acknowledged, it is taken again.
+    reopened_spool = spool.Spool(str(tmp_path))
+    assert len(reopened_spool) == 7
+    assert reopened_spool.take(10) == [(b"queue", item) for item in items[3:]]
+    reopened_spool.close()
+
+
+def test_torn_final_record_is_discarded(tmp_path):
+    first_spool = spool.Spool(str(tmp_path))
+    first_spool.put([(b"", b"complete"), (b"", b"also complete")])
+    torn_offset = first_spool.segments[-1].end
+    first_spool.put([(b"", b"torn by a crash")])
+    first_spool.close()
+    path = os.path.join(str(tmp_path), segment_files(str(tmp_path))[-1])
+    with open(path, "r+b") as segment_file:
+        segment_file.seek(torn_offset + spool.RECORD_HEADER.size + 3)
+        segment_file.write(b"\xff")
+    reopened_spool = spool.Spool(str(tmp_path))
+    assert len(reopened_spool) == 2
+    assert reopened_spool.take(10) == [(b"", b"complete"), (b"", b"also complete")]
+    reopened_spool.close()
+
+
+def test_acknowledged_segments_are_reclaimed(tmp_path):
+    item = os.urandom(1000)
+    small_spool = spool.Spool(str(tmp_path), segment_bytes=4096)
+    small_spool.put((b"", item) for _ in range(20))
+    assert len(segment_files(str(tmp_path))) == 5
+    assert len(small_spool.take(10)) == 10
+    small_spool.acknowledge(10)
+    # Only the segments every record of is acknowledged go, the one being read stays.
+    assert len(segment_files(str(tmp_path))) == 3
+    assert len(small_spool.take(10)) == 10
+    small_spool.acknowledge(20)
+    assert len(segment_files(str(tmp_path))) == 1
+    assert small_spool.used_bytes == small_spool.segments[-1].end
+    small_spool.close()
+
+
+def test_restarted_pending_spool_resends_unacknowledged_items(tmp_path):
+    items = [b"item %d" % nr for nr in range(6)]
+    pending = spool.PendingSpool(str(tmp_path))
+    pending.extend(items)
+    sent_callbacks = []
+    for _ in range(4):
+        assert pending.popleft()
+        sent_callbacks.append(pending.sent_callback(pending.taken_records))
+    # Sent out of order, only the first two are acknowledged as everything before them is sent.
+    for callback in (sent_callbacks[1], sent_callbacks[0], sent_callbacks[3]):
+        callback()
+    pending.close()
+    restarted = spool.PendingSpool(str(tmp_path))
+    assert [restarted.popleft() for _ in range(len(restarted))] == items[2:]
+    restarted.close()
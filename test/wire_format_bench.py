@@ -0,0 +1,36 @@
+""" Micro benchmark of the binary frame format against the legacy pickled tuple.
+Run from the repository root: PYTHONPATH=. python test/wire_format_bench.py """
+import os
+import timeit
+
+from tools import wire_format
+
+
+def make_frames(payload_bytes=1044):
+    """ The same frame with binary digests, and with the md5 hexdigests of the legacy format. """
+    payload = os.urandom(payload_bytes)
+    return (wire_format.Frame(10, 3, 1, 1, 0x6bd81d3542a419d6, 0xdf22cbd0, payload, integrity=0x22),
+            wire_format.Frame(10, 3, 1, 1, "9e107d9d372bb6826bd81d3542a419d6", "e4d909c290d0fb1ca068ffaddf22cbd0",
+                              payload))
+
+
+def bench_wire_format(iterations=100_000):
+    frame, legacy = make_frames()
+    binary_frame = wire_format.pack_frame(frame)
+    legacy_frame = wire_format.pack_legacy_frame(legacy)
+    results = {
+        "binary_pack": timeit.timeit(lambda: wire_format.pack_frame(frame), number=iterations),
+        "binary_unpack": timeit.timeit(lambda: wire_format.unpack_frame(binary_frame), number=iterations),
+        "legacy_pack": timeit.timeit(lambda: wire_format.pack_legacy_frame(legacy), number=iterations),
+        "legacy_unpack": timeit.timeit(lambda: wire_format.unpack_frame(legacy_frame, accept_legacy=True),
+                                       number=iterations),
+    }
+    print("Header bytes: binary %s, legacy %s" % (len(binary_frame) - len(frame.payload),
+                                                 len(legacy_frame) - len(frame.payload)))
+    for name, seconds in results.items():
+        print("%-14s %8.3f us/frame" % (name, seconds / iterations * 1_000_000))
+    return results
+
+
+if __name__ == "__main__":
+    bench_wire_format()
@@ -0,0 +1,188 @@
+"""
+asyncio receiver pipeline.
+
+The event loop does little more than read the socket: a DatagramProtocol puts every datagram on a bounded ring
+as it arrives, so the kernel buffer keeps being drained while items are decoded or Redis is slow.
+Decoding, validation and reassembly are one stage, run in a single worker thread on batches taken from the ring,
+so all reassembly state stays in one thread. Completed items go through a bounded queue to the output stage,
+which pushes them with the asyncio Redis client.
+
+Every stage has a queue depth gauge, printed every stats_seconds. A full ring means decoding is the bottleneck,
+a full output queue means Redis is. When the ring is full the oldest datagram is dropped and counted.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import time
+
+from tools import redis_output
+from tools.metrics import CPU_BUCKETS, METRICS
+
+
+class DatagramRing:
+    """ Bounded FIFO of datagrams between the socket and the decode stage. """
+
+    def __init__(self, max_datagrams=65536):
+        self.datagrams = collections.deque(maxlen=max_datagrams)
+        self.event = asyncio.Event()
+        self.received_datagrams = 0
+        self.dropped_datagrams = 0
+        self.max_depth = 0  # Deepest the ring got since the last report
+
+    def put(self, datagram):
+        if len(self.datagrams) == self.datagrams.maxlen:
+            self.dropped_datagrams += 1  # The deque drops the oldest one
+            METRICS.inc("ring_dropped_datagrams")
+        self.datagrams.append(datagram)
+        self.received_datagrams += 1
+        self.max_depth = max(self.max_depth, len(self.datagrams))
+        self.event.set()
+
+    async def get_batch(self, max_datagrams):
+        """ Waits for datagrams, returns up to max_datagrams of them. """
+        while not self.datagrams:
+            self.event.clear()
+            await self.event.wait()
+        return [self.datagrams.popleft() for _ in range(min(max_datagrams, len(self.datagrams)))]
+
+
+class CompletedItems:
+    """ Collects the items completed in one decode batch, it takes the place of the output of the sync receiver. """
+
+    def __init__(self):
+        self.items = []
+
+    def put(self, item, redis_queue=None):
+        self.items.append((redis_queue, item))
+
+
+class _ReceiverProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, ring):
+        self.ring = ring
+
+    def datagram_received(self, data, addr):
+        self.ring.put(data)
+
+    def error_received(self, exc):
+        print("[x] Socket error. %s" % exc)
+
+
+class AsyncReceiver:
+    """
+    process_datagrams(datagrams) runs in the decode thread and returns a list of (redis_queue, item)
+    of the items completed by those datagrams, redis_queue None is redis_queue.
+    stats_function, if given, returns a dict of counters that is printed with the gauges.
+    """
+
+    def __init__(self, udp_socket, process_datagrams, redis_client, redis_queue, ring_datagrams=65536,
+                 batch_datagrams=256, output_items=100000, flush_items=100, retry_seconds=1.0, stats_seconds=10.0,
+                 stats_function=None):
+        self.udp_socket = udp_socket
+        self.process_datagrams = process_datagrams
+        self.redis_client = redis_client
+        self.redis_queue = redis_queue
+        self.ring_datagrams = ring_datagrams
+        self.batch_datagrams = batch_datagrams
+        self.output_items = output_items
+        self.flush_items = flush_items
+        self.retry_seconds = retry_seconds
+        self.stats_seconds = stats_seconds
+        self.stats_function = stats_function
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="decode")
+        self.ring = None
+        self.output_queue = None
+        self.decoding_datagrams = 0
+        self.pushed_items = 0
+        self.decode_seconds = 0.0
+        self.redis_seconds = 0.0
+
+    async def run(self):
+        """ Runs the pipeline until it is cancelled. """
+        self.ring = DatagramRing(self.ring_datagrams)
+        self.output_queue = asyncio.Queue(self.output_items)
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: _ReceiverProtocol(self.ring), sock=self.udp_socket)
+        stages = [asyncio.create_task(self._decode_stage()), asyncio.create_task(self._output_stage())]
+        if self.stats_seconds > 0:
+            stages.append(asyncio.create_task(self._report()))
+        try:
+            await asyncio.gather(*stages)
+        finally:
+            transport.close()
+            self.executor.shutdown(wait=False)
+
+    async def _decode_stage(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.ring.get_batch(self.batch_datagrams)
+            self.decoding_datagrams = len(batch)
+            started = time.perf_counter()
+            completed_items = await loop.run_in_executor(self.executor, self._timed_process, batch)
+            self.decode_seconds += time.perf_counter() - started
+            self.decoding_datagrams = 0
+            for completed_item in completed_items:
+                await self.output_queue.put(completed_item)  # Waits while Redis is behind
+
+    def _timed_process(self, batch):
+        started = time.thread_time()
+        completed_items = self.process_datagrams(batch)
+        METRICS.observe("cpu_seconds_decode_batch", time.thread_time() - started, CPU_BUCKETS)
+        return completed_items
+
+    async def _output_stage(self):
+        while True:
+            batch = [await self.output_queue.get()]
+            while len(batch) < self.flush_items and not self.output_queue.empty():
+                batch.append(self.output_queue.get_nowait())
+            queue_items = collections.defaultdict(list)
+            for redis_queue, item in batch:
+                queue_items[redis_queue or self.redis_queue].append(item)
+            await self._flush(queue_items)
+            self.pushed_items += len(batch)
+
+    async def _flush(self, queue_items):
+        """ Pushes the items in one pipeline, retries what Redis refused for now until it takes it.
+        Pushes Redis will never take are dropped, see tools/redis_output.py """
+        commands = list(queue_items.items())
+        retry_seconds = self.retry_seconds
+        while commands:
+            started = time.perf_counter()
+            try:
+                async with self.redis_client.pipeline(transaction=False) as pipeline:
+                    for redis_queue, items in commands:
+                        pipeline.rpush(redis_queue, *items)
+                    results = await pipeline.execute(raise_on_error=False)
+            except Exception as e:
+                results = [e] * len(commands)
+            pushed_items, commands, retry_error, dropped_items = redis_output.sort_push_results(commands, results)
+            self.redis_seconds += time.perf_counter() - started
+            if dropped_items:
+                METRICS.inc("redis_dropped_items", dropped_items)
+            if pushed_items:
+                METRICS.observe("redis_flush_seconds", time.perf_counter() - started)
+                METRICS.inc("redis_pushed_items", pushed_items)
+            if commands:
+                print("[x] Redis output error, retrying in %s seconds. %s" % (retry_seconds, retry_error))
+                await asyncio.sleep(retry_seconds)
+                retry_seconds = min(retry_seconds * 2, redis_output.MAX_RETRY_SECONDS)
+
+    def gauges(self):
+        """ Queue depths of every stage, and what went through them. """
+        return {
+            "ring_depth": len(self.ring.datagrams), "ring_max_depth": self.ring.max_depth,
+            "ring_capacity": self.ring_datagrams, "ring_dropped": self.ring.dropped_datagrams,
+            "received_datagrams": self.ring.received_datagrams, "decoding_datagrams": self.decoding_datagrams,
+            "output_depth": self.output_queue.qsize(), "output_capacity": self.output_items,
+            "pushed_items": self.pushed_items, "decode_seconds": round(self.decode_seconds, 3),
+            "redis_seconds": round(self.redis_seconds, 3),
+        }
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.stats_seconds)
+            gauges = self.gauges()
+            self.ring.max_depth = len(self.ring.datagrams)
+            if self.stats_function:
+                gauges.update(self.stats_function())
+            print("[*] " + ", ".join("%s: %s" % (name, value) for name, value in gauges.items()))
@@ -0,0 +1,89 @@
+"""
+Coalescing of small items on the sender.
+
+Every item costs at least one datagram with its own header, parity and checksums, so a stream of small items
+is limited by the packet rate and not by the bandwidth. Small items are packed into one batch item instead,
+as length prefixed values, that is sent like any other item with FLAG_BATCH set in its frame header.
+A batch is closed when the next item doesn't fit in max_bytes, or when its oldest item has waited linger_seconds.
+The receiver splits the batch back into its items, in order.
+"""
+import struct
+import time
+
+ITEM_LENGTH = struct.Struct("!I")
+
+
+def pack_batch(items):
+    batch = bytearray(sum(ITEM_LENGTH.size + len(item) for item in items))
+    offset = 0
+    for item in items:
+        ITEM_LENGTH.pack_into(batch, offset, len(item))
+        offset += ITEM_LENGTH.size
+        batch[offset:offset + len(item)] = item
+        offset += len(item)
+    return batch
+
+
+def unpack_batch(batch):
+    """ Returns the items of a batch as memoryviews into it. Raises ValueError if the batch is malformed. """
+    view = memoryview(batch)
+    items = []
+    offset = 0
+    while offset < len(view):
+        if offset + ITEM_LENGTH.size > len(view):
+            raise ValueError("Batch truncated in an item length at byte %s" % offset)
+        (length,) = ITEM_LENGTH.unpack_from(view, offset)
+        offset += ITEM_LENGTH.size
+        if offset + length > len(view):
+            raise ValueError("Batch item of %s bytes at byte %s runs past the end" % (length, offset))
+        items.append(view[offset:offset + length])
+        offset += length
+    return items
+
+
+class ItemBatcher:
+    """ One open batch per key, the sender uses its streams as keys as every stream is sent separately. """
+
+    def __init__(self, max_bytes=1024, linger_seconds=0.005):
+        self.max_bytes = max_bytes
+        self.linger_seconds = linger_seconds
+        self.batches = {}  # key: [timestamp of the first item, packed size, items]
+
+    def fits(self, item):
+        """ True if the item is small enough to be batched at all. """
+        return ITEM_LENGTH.size + len(item) <= self.max_bytes
+
+    def add(self, key, item, now=None):
+        """ Adds an item to the batch of key. Returns the packed batch that was closed to make room, or None. """
+        batch = self.batches.get(key)
+        closed_batch = None
+        if batch and batch[1] + ITEM_LENGTH.size + len(item) > self.max_bytes:
+            closed_batch = self.pop(key)
+            batch = None
+        if batch is None:
+            batch = self.batches[key] = [time.monotonic() if now is None else now, 0, []]
+        batch[1] += ITEM_LENGTH.size + len(item)
+        batch[2].append(item)
+        return closed_batch
+
+    def pop(self, key):
+        """ Closes the batch of key, returns it packed or None if there was none. """
+        batch = self.batches.pop(key, None)
+        if batch is None:
+            return None
+        return pack_batch(batch[2])
+
+    def pop_due(self, now=None):
+        """ Closes the batches that have lingered long enough, returns a list of (key, packed batch). """
+        if not self.batches:
+            return []
+        if now is None:
+            now = time.monotonic()
+        due_keys = [key for key, batch in self.batches.items() if batch[0] + self.linger_seconds <= now]
+        return [(key, self.pop(key)) for key in due_keys]
+
+    def next_deadline(self):
+        """ Monotonic time at which the oldest open batch is due, None without open batches. """
+        if not self.batches:
+            return None
+        return min(batch[0] for batch in self.batches.values()) + self.linger_seconds
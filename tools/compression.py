@@ -0,0 +1,95 @@
+"""
+Optional compression of items between the Redis drain and chunking.
+
+The codec is stored in the frame header flags (COMPRESSION_MASK), so the receiver knows how to decompress
+every item on its own, and senders with different settings can share a receiver.
+zlib and gzip are always available, zstd (zstandard) and lz4 are used when they are installed.
+
+Compression is skipped for items below min_bytes, and when it doesn't save at least (1 - max_ratio) of the size.
+Large items first compress a sample of sample_bytes, so incompressible data (media, encrypted or already
+compressed payloads) costs one small attempt instead of a full pass.
+"""
+import gzip
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+COMPRESSION_SHIFT = 2
+COMPRESSION_MASK = 0x07 << COMPRESSION_SHIFT  # Bits of the frame flags holding the codec id
+CODEC_IDS = {"none": 0, "zlib": 1, "gzip": 2, "zstd": 3, "lz4": 4}
+
+
+def _compressor(codec, level):
+    if codec == "zlib":
+        return lambda data: zlib.compress(data, level)
+    if codec == "gzip":
+        return lambda data: gzip.compress(data, level, mtime=0)
+    if codec == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor(level=level).compress
+    if codec == "lz4":
+        if lz4 is None:
+            raise ValueError("lz4 compression needs the lz4 package")
+        return lambda data: lz4.frame.compress(data, compression_level=level)
+    raise ValueError("Unknown compression codec %s, use one of %s" % (codec, ", ".join(CODEC_IDS)))
+
+
+def decompress(payload, flags):
+    """ Decompresses an item by the codec in its frame flags, items without one are returned as they are.
+    Raises ValueError for a codec that isn't installed or data that doesn't decompress. """
+    codec_id = (flags & COMPRESSION_MASK) >> COMPRESSION_SHIFT
+    try:
+        if codec_id == 0:
+            return payload
+        if codec_id == 1:
+            return zlib.decompress(payload)
+        if codec_id == 2:
+            return gzip.decompress(payload)
+        if codec_id == 3 and zstandard is not None:
+            return zstandard.ZstdDecompressor().decompressobj().decompress(payload)
+        if codec_id == 4 and lz4 is not None:
+            return lz4.frame.decompress(payload)
+    except Exception as e:
+        raise ValueError("Item doesn't decompress: %s" % e)
+    raise ValueError("Item compressed with codec %s, which isn't installed or known" % codec_id)
+
+
+class Compressor:
+
+    def __init__(self, codec="zlib", level=1, min_bytes=512, max_ratio=0.9, sample_bytes=4096):
+        self.codec_flags = CODEC_IDS.get(codec, 0) << COMPRESSION_SHIFT
+        self.compress_function = _compressor(codec, level) if codec != "none" else None
+        self.min_bytes = min_bytes
+        self.max_ratio = max_ratio
+        self.sample_bytes = sample_bytes
+        self.compressed_items = 0
+        self.skipped_items = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def compress(self, item):
+        """ Returns (payload, flags), the compressed item and its codec flags or the item itself and 0. """
+        if self.compress_function is None or len(item) < self.min_bytes:
+            return item, 0
+        if len(item) > 2 * self.sample_bytes:
+            sample = memoryview(item)[:self.sample_bytes]
+            if len(self.compress_function(sample)) > len(sample) * self.max_ratio:
+                self.skipped_items += 1
+                return item, 0
+        compressed = self.compress_function(item)
+        if len(compressed) > len(item) * self.max_ratio:
+            self.skipped_items += 1
+            return item, 0
+        self.compressed_items += 1
+        self.bytes_in += len(item)
+        self.bytes_out += len(compressed)
+        return compressed, self.codec_flags
@@ -0,0 +1,51 @@
+"""
+Receiving datagrams into one reusable buffer.
+
+Every datagram is read with recvfrom_into into the same preallocated buffer, instead of a new bytes object per
+recvfrom. Frames carry the largest datagram size their sender uses, the buffer and SO_RCVBUF are sized to it
+as soon as it is seen. A datagram that is still larger than the buffer is detected with MSG_TRUNC,
+dropped, and the buffer grown so the next ones fit.
+"""
+import socket
+
+MSG_TRUNC = getattr(socket, "MSG_TRUNC", 0)  # Linux returns the full datagram length with it
+
+
+class DatagramReader:
+
+    def __init__(self, udp_socket, buffersize=4096, receive_buffer_datagrams=4096):
+        self.udp_socket = udp_socket
+        self.receive_buffer_datagrams = receive_buffer_datagrams
+        self.datagram_bytes = 0
+        self.buffer = bytearray()
+        self.truncated_datagrams = 0
+        self.set_datagram_size(buffersize)
+
+    def set_datagram_size(self, datagram_bytes):
+        """ Grows the buffer and SO_RCVBUF for datagrams of up to datagram_bytes, never shrinks them. """
+        if datagram_bytes <= self.datagram_bytes:
+            return
+        self.datagram_bytes = datagram_bytes
+        if datagram_bytes > len(self.buffer):
+            self.buffer = bytearray(datagram_bytes)  # Views of the old buffer stay valid
+        requested = datagram_bytes * self.receive_buffer_datagrams
+        try:
+            self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, requested)
+            granted = self.udp_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        except OSError as e:
+            print("[x] Could not set the socket receive buffer. %s" % e)
+            return
+        if granted < requested:
+            print("[x] Socket receive buffer is %s bytes instead of %s, raise net.core.rmem_max to avoid drops." % (
+                granted, requested))
+
+    def read(self):
+        """ Returns (datagram, address), the datagram is a memoryview that is only valid until the next read. """
+        while True:
+            buffer = self.buffer  # The buffer can be replaced by another thread
+            nbytes, address = self.udp_socket.recvfrom_into(buffer, 0, MSG_TRUNC)
+            if nbytes <= len(buffer):
+                return memoryview(buffer)[:nbytes], address
+            self.truncated_datagrams += 1
+            print("[x] Dropped a %s byte datagram from %s, growing the receive buffer." % (nbytes, address))
+            self.set_datagram_size(nbytes)
@@ -0,0 +1,90 @@
+"""
+Multi core decoding for the receiver.
+
+A reader thread does nothing but read the UDP socket, so the kernel buffer is drained while other work runs.
+Datagrams are handed to a process pool in batches, where frames are parsed, Reed Solomon decoded (a whole batch in
+one vectorized call, see tools/reed_solomon.py) and checked.
+Results come back in arrival order, so reassembly, deduplication and the Redis output stay in the
+main process and keep one consistent state per item.
+
+SO_REUSEPORT workers were not used: the kernel spreads datagrams over the sockets by the address 4-tuple,
+so everything from one sender would still land on one worker.
+"""
+import multiprocessing
+import queue
+import socket
+import threading
+import time
+
+from tools import diode_utils, wire_format
+
+
+def decode_datagrams(datagrams, accept_legacy=False):
+    """
+    Runs in a pool worker. Returns a list of (frame, byte_chunk) for the valid frames, where the frame payload
+    is dropped and byte_chunk is the decoded chunk, or False if it could not be validated,
+    with the number of chunks Reed Solomon corrected and of invalid frames.
+    """
+    corrected_before = diode_utils.rs_corrected_chunks()
+    frames = []
+    for datagram in datagrams:
+        frame = wire_format.unpack_frame(datagram, accept_legacy)
+        if frame is not None:
+            frames.append(frame)
+    results = [(frame._replace(payload=None), byte_chunk)
+               for frame, byte_chunk in zip(frames, diode_utils.validate_packets(frames))]
+    return results, diode_utils.rs_corrected_chunks() - corrected_before, len(datagrams) - len(frames)
+
+
+class DecodePool:
+
+    def __init__(self, reader, workers=4, accept_legacy=False, batch_datagrams=64, batch_seconds=0.005,
+                 max_pending_batches=1024):
+        """ reader is the tools/datagram_reader.DatagramReader of the socket. """
+        self.reader = reader
+        self.accept_legacy = accept_legacy
+        self.batch_datagrams = batch_datagrams
+        self.batch_seconds = batch_seconds
+        self.running = True
+        self.received_datagrams = 0
+        self.corrected_chunks = 0  # Counted by the workers
+        self.invalid_frames = 0
+
+        self.pool = multiprocessing.Pool(workers)
+        self.pending = queue.Queue(max_pending_batches)  # AsyncResults, in arrival order
+        self.thread = threading.Thread(target=self._read, name="udp-reader", daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        self.reader.udp_socket.settimeout(self.batch_seconds)
+        batch = []
+        batch_deadline = 0.0
+        while self.running:
+            try:
+                datagram, _ = self.reader.read()
+                if not batch:
+                    batch_deadline = time.monotonic() + self.batch_seconds
+                batch.append(bytes(datagram))  # Copied out of the reusable buffer, to send it to a worker
+                self.received_datagrams += 1
+            except socket.timeout:
+                pass
+            except OSError:
+                break  # Socket closed
+            if batch and (len(batch) >= self.batch_datagrams or time.monotonic() >= batch_deadline):
+                self.pending.put(self.pool.apply_async(decode_datagrams, (batch, self.accept_legacy)))
+                batch = []
+
+    def results(self):
+        """ Yields (frame, byte_chunk) in arrival order. """
+        while self.running:
+            results, corrected_chunks, invalid_frames = self.pending.get().get()
+            self.corrected_chunks += corrected_chunks
+            self.invalid_frames += invalid_frames
+            yield from results
+
+    def pending_batches(self):
+        return self.pending.qsize()
+
+    def close(self):
+        self.running = False
+        self.pool.terminate()
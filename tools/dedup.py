@@ -0,0 +1,137 @@
+"""
+Deduplication of completed items on the receiver.
+
+Redundant copies and late repair packets can complete an item more than once, only the first completion
+should reach Redis. Items are keyed by their full item id from the frame header.
+
+SeenItems keeps every id for ttl_seconds in an insertion ordered dict. Ids are inserted in time order,
+so expired ids are always at the front and are evicted in amortized O(1), a few per check.
+BloomSeenItems uses fixed memory for very high item rates: two Bloom filter generations that are rotated
+every ttl_seconds, so an id is remembered for between one and two ttl periods. It can report an item
+as seen that wasn't (false positive rate set by its size), but never misses one that was.
+"""
+import time
+from collections import OrderedDict
+from hashlib import md5
+
+
+class SeenItems:
+
+    def __init__(self, ttl_seconds=3.0, max_items=1000000):
+        self.ttl_seconds = ttl_seconds
+        self.max_items = max_items
+        self.items = OrderedDict()  # item_id: first seen, oldest first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def check(self, item_id, now=None):
+        """ Returns the seconds since the item was first seen, or -1 if it is new (it is then remembered). """
+        if now is None:
+            now = time.monotonic()
+        self._expire(now)
+        first_seen = self.items.get(item_id)
+        if first_seen is not None:
+            self.hits += 1
+            return now - first_seen
+        self.misses += 1
+        self.items[item_id] = now
+        if len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+            self.evictions += 1
+        return -1
+
+    def contains(self, item_id, now=None):
+        """ True if the item was seen within ttl_seconds, without remembering it or counting it. """
+        if now is None:
+            now = time.monotonic()
+        self._expire(now)
+        return item_id in self.items
+
+    def _expire(self, now):
+        items = self.items
+        expire_before = now - self.ttl_seconds
+        while items:
+            item_id, first_seen = next(iter(items.items()))
+            if first_seen > expire_before:
+                break
+            items.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "items": len(self.items)}
+
+
+class BloomSeenItems:
+
+    def __init__(self, ttl_seconds=3.0, bits=8388608, hashes=7):
+        self.ttl_seconds = ttl_seconds
+        self.bits = bits
+        self.hashes = hashes
+        self.current = bytearray((bits + 7) // 8)
+        self.previous = bytearray(len(self.current))
+        self.rotated = time.monotonic()
+        self.current_items = 0
+        self.previous_items = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _positions(self, item_id):
+        if not isinstance(item_id, int):
+            item_id = int.from_bytes(md5(str(item_id).encode()).digest()[:8], "big")
+        # Double hashing, the item id is already a hash so its two halves are used directly.
+        low = item_id & 0xffffffff
+        high = (item_id >> 32) | 1
+        return [(low + i * high) % self.bits for i in range(self.hashes)]
+
+    @staticmethod
+    def _contains(bitmap, positions):
+        for position in positions:
+            if not bitmap[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def _rotate(self, now):
+        if now - self.rotated >= self.ttl_seconds:
+            # Forget the oldest generation, in one step instead of per item.
+            self.previous, self.current = self.current, self.previous
+            self.current[:] = bytes(len(self.current))
+            self.evictions += self.previous_items
+            self.previous_items = self.current_items
+            self.current_items = 0
+            self.rotated = now
+
+    def contains(self, item_id, now=None):
+        """ True if the item was probably seen, without remembering it or counting it. """
+        if now is None:
+            now = time.monotonic()
+        self._rotate(now)
+        positions = self._positions(item_id)
+        return self._contains(self.current, positions) or self._contains(self.previous, positions)
+
+    def check(self, item_id, now=None):
+        """ Returns 0 if the item was probably seen before, -1 if it is new (it is then remembered). """
+        if now is None:
+            now = time.monotonic()
+        self._rotate(now)
+        positions = self._positions(item_id)
+        if self._contains(self.current, positions) or self._contains(self.previous, positions):
+            self.hits += 1
+            return 0
+        self.misses += 1
+        for position in positions:
+            self.current[position >> 3] |= 1 << (position & 7)
+        self.current_items += 1
+        return -1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "items": self.current_items + self.previous_items}
+
+
+def create_seen_items(ttl_seconds=3.0, max_items=1000000, bloom_bits=0, bloom_hashes=7):
+    """ Exact SeenItems, or BloomSeenItems when bloom_bits is set. """
+    if bloom_bits:
+        return BloomSeenItems(ttl_seconds, bloom_bits, bloom_hashes)
+    return SeenItems(ttl_seconds, max_items)
@@ -1,75 +1,118 @@
 
 
+import time
 
-import sys
 import redis
 from hashlib import md5
-from reedsolo import RSCodec
 
+from tools import integrity, reed_solomon, wire_format
+
+IPV4_UDP_HEADER_BYTES = 28
+REDIS_LPOP_COUNT = True  # Set to False when the server is older than 6.2 and doesn't support LPOP with a count
 
 ## Bytearray utils ###########
-def bytearray_splitter_by_bytes(in_bytes, split_bytes=1024):
-    counter = 1
-    out_list = []
-    _bytearray = bytearray()
-    for i in in_bytes:
-        _bytearray.append(i)
-        if counter % split_bytes == 0:
-            out_list.append(_bytearray)
-            _bytearray = bytearray()
-        counter += 1
-    if len(_bytearray) > 0:
-        out_list.append(_bytearray)
-    out_tuple = tuple(out_list)
-    return out_tuple
-
-
-def bytearray_splitter_by_pieces(in_bytes, pieces=8):
-    counter = 1
-    out_list = []
-    _bytearray = bytearray()
-    split_by = sys.getsizeof(in_bytes) // pieces
-    for i in in_bytes:
-        _bytearray.append(i)
-        counter += 1
-        if counter % split_by == 0:
-            out_list.append(_bytearray)
-            _bytearray = bytearray()
-    out_tuple = tuple(out_list)
-    return out_tuple
-
-
-def bytearray_joiner(sequence_of_bytearrays):
-    _bytearray = bytearray()
-    for item in sequence_of_bytearrays:
-        try:
-            rs_decoded_item = rs_decode(item)
-        except:
-            rs_decoded_item = item
-        for item_byte in item:
-            _bytearray.append(item_byte)
-    _bytes = bytes(_bytearray)
-    return _bytes
+def chunk_splitter(in_bytes, chunk_bytes=1024, pieces=None):
+    """ Splits bytes into chunks of chunk_bytes, or into a number of equal pieces (the last one can be shorter).
+    Chunks are memoryview slices of in_bytes, nothing is copied. """
+    view = memoryview(in_bytes)
+    if pieces:
+        chunk_bytes = max(1, -(-len(view) // pieces))
+    return tuple(view[i:i + chunk_bytes] for i in range(0, len(view), chunk_bytes))
+
+
+def chunk_joiner(sequence_of_chunks):
+    """ Joins chunks into one preallocated bytearray, one copy per chunk. """
+    total_length = sum(len(chunk) for chunk in sequence_of_chunks)
+    _bytearray = bytearray(total_length)
+    view = memoryview(_bytearray)
+    offset = 0
+    for chunk in sequence_of_chunks:
+        view[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+    return _bytearray
 
 
 ################################
 
 # Reed Solomon
+# Codecs are cached per parameter set in tools/reed_solomon, see that module for the table driven math.
 def rs_encode(data, checksum_bytes=4):
-    rs_codec = RSCodec(checksum_bytes)
-    rs_data = rs_codec.encode(data)
+    rs_data = reed_solomon.get_codec(checksum_bytes).encode(data)
     return rs_data
 
 
 def rs_decode(data, checksum_bytes=4):
-    rs_codec = RSCodec(checksum_bytes)
-    rs_data = rs_codec.decode(data)[0]
+    rs_data = reed_solomon.get_codec(checksum_bytes).decode(data)
     return rs_data
 
 
+def max_datagram_bytes(chunk_bytes, checksum_bytes=4):
+    """ Size of the largest datagram carrying chunks of chunk_bytes, with the erasure coding extension. """
+    return wire_format.FEC_HEADER_END + reed_solomon.get_codec(checksum_bytes).encoded_size(chunk_bytes)
+
+
+def chunk_bytes_for_mtu(mtu, checksum_bytes=4):
+    """ Largest chunk whose datagram fits in one IPv4 packet of mtu bytes, so it is never fragmented. """
+    udp_payload_bytes = min(mtu, 65535) - IPV4_UDP_HEADER_BYTES - wire_format.FEC_HEADER_END
+    return reed_solomon.get_codec(checksum_bytes).max_data_size(udp_payload_bytes)
+
+
+def rs_corrected_chunks(checksum_bytes=4):
+    """ Chunks this process corrected with Reed Solomon so far. """
+    return reed_solomon.get_codec(checksum_bytes).corrected_chunks
+
+
+def rs_encode_batch(chunks, checksum_bytes=4):
+    """ Encodes every chunk in one call, returns a list of encoded bytearrays. """
+    return reed_solomon.get_codec(checksum_bytes).encode_batch(chunks)
+
+
+def rs_decode_batch(chunks, checksum_bytes=4):
+    """ Decodes every chunk in one call, chunks that can't be corrected are returned as None. """
+    return reed_solomon.get_codec(checksum_bytes).decode_batch(chunks)
+
+
 ##########################
 
 
+## Config ##########################
+
+def read_config_settings(config_file, defaults):
+    """ Reads optional key=value settings from a config file.
+    Only keys present in defaults are read, values are cast to the type of their default. """
+    settings = dict(defaults)
+    with open(config_file, 'r') as f:
+        for line in f:
+            line_split = line.strip().replace(" ", "").split("=")
+            key = line_split[0]
+            if key in settings and len(line_split) == 2:
+                default = settings[key]
+                if isinstance(default, bool):
+                    settings[key] = line_split[1].lower() in ("1", "true", "yes", "on")
+                else:
+                    settings[key] = type(default)(line_split[1])
+    return settings
+
+
+def read_config_streams(config_file):
+    """ Reads stream_<id> = <redis queue>[,option=value,...] lines, used to carry several queues over one port.
+    Returns {stream_id: (redis_queue, {option: float value})}. """
+    streams = {}
+    with open(config_file, 'r') as f:
+        for line in f:
+            key, _, value = line.strip().replace(" ", "").partition("=")
+            if not key.startswith("stream_") or not value:
+                continue
+            redis_queue, *options = value.split(",")
+            streams[int(key[len("stream_"):])] = (redis_queue, {option_name: float(option_value) for
+                                                              option_name, _, option_value in
+                                                              (option.partition("=") for option in options)})
+    return streams
+
+
+#####################
+
+
 ## Redis ##########################
 
 def redis_connect_server(ip="localhost", port=6379, password="password", db=0):
@@ -85,6 +128,12 @@ def redis_connect_server(ip="localhost", port=6379, password="password", db=0):
     return redis_server
 
 
+def redis_connect_async_server(ip="localhost", port=6379, password="password", db=0):
+    """ asyncio Redis client, needs redis-py 4.2 or later. """
+    import redis.asyncio
+    return redis.asyncio.Redis(host=ip, port=port, password=password, db=db)
+
+
 def redis_add_item_to_list(redis_server, redis_key, item):
     try:
         count = redis_server.rpush(redis_key, item)
@@ -94,6 +143,66 @@ def redis_add_item_to_list(redis_server, redis_key, item):
     return count
 
 
+def redis_pop_items_multi(redis_server, redis_keys, count=100):
+    """ Pops up to count items from each list, all in one round trip. Returns a list of item lists, in key order. """
+    global REDIS_LPOP_COUNT
+    if REDIS_LPOP_COUNT:
+        pipeline = redis_server.pipeline(transaction=False)
+        for redis_key in redis_keys:
+            pipeline.lpop(redis_key, count)
+        try:
+            return [items or [] for items in pipeline.execute()]
+        except redis.exceptions.ResponseError:
+            REDIS_LPOP_COUNT = False
+    pipeline = redis_server.pipeline(transaction=True)
+    for redis_key in redis_keys:
+        pipeline.lrange(redis_key, 0, count - 1)
+        pipeline.ltrim(redis_key, count, -1)
+    return pipeline.execute()[::2]
+
+
+def redis_read_items_multi(redis_server, redis_keys, count=100):
+    """ Reads up to count items from the head of each list without removing them, all in one round trip. """
+    pipeline = redis_server.pipeline(transaction=False)
+    for redis_key in redis_keys:
+        pipeline.lrange(redis_key, 0, count - 1)
+    return pipeline.execute()
+
+
+def redis_trim_items_multi(redis_server, redis_keys, counts):
+    """ Removes the first counts[i] items of every list, the ones redis_read_items_multi returned. """
+    pipeline = redis_server.pipeline(transaction=False)
+    for redis_key, count in zip(redis_keys, counts):
+        if count:
+            pipeline.ltrim(redis_key, count, -1)
+    pipeline.execute()
+
+
+def redis_wait_item(redis_server, redis_keys, max_wait_seconds=2):
+    """ Blocks until one of the lists has an item, returns (key, item) or None after max_wait_seconds. """
+    popped = redis_server.blpop(redis_keys, timeout=max_wait_seconds)
+    if popped is None:
+        return None
+    redis_key, item = popped
+    if isinstance(redis_key, bytes):
+        redis_key = redis_key.decode()
+    return redis_key, item
+
+
+def redis_wait_items(redis_server, redis_keys, max_wait_seconds=2, poll_seconds=0.01):
+    """ Polls until one of the lists has an item, without removing it. Returns True, or False after max_wait_seconds. """
+    deadline = time.monotonic() + max_wait_seconds
+    while True:
+        pipeline = redis_server.pipeline(transaction=False)
+        for redis_key in redis_keys:
+            pipeline.llen(redis_key)
+        if any(pipeline.execute()):
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(poll_seconds)
+
+
 def redis_check_connected(redis_server, daemon=True):
     try:
         redis_server.set("connection_test", "connected")
@@ -127,6 +236,37 @@ def redis_get_length_of_list(redis_server, list_name):
 #####################
 
 
+def validate_packet(rs_byte_chunk, chunk_checksum, integrity_byte=0):
+    """ Reed Solomon decodes a chunk and compares its checksum with the one in the frame,
+    computed with the chunk checksum algorithm in integrity_byte, see tools/integrity.py
+    Returns the decoded chunk, or False if it can't be corrected or the checksum differs. """
+    try:
+        byte_chunk = rs_decode(rs_byte_chunk)
+    except reed_solomon.ReedSolomonError:
+        return False
+    return check_chunk(byte_chunk, chunk_checksum, integrity_byte)
+
+
+def validate_packets(frames):
+    """ validate_packet for the payloads of a batch of frames, Reed Solomon checked in one vectorized call.
+    Returns the decoded chunk, or False, for every frame. """
+    decoded_chunks = rs_decode_batch([frame.payload for frame in frames])
+    return [check_chunk(byte_chunk, frame.chunk_checksum, frame.integrity) if byte_chunk is not None else False
+            for frame, byte_chunk in zip(frames, decoded_chunks)]
+
+
+def check_chunk(byte_chunk, chunk_checksum, integrity_byte=0):
+    """ Returns the decoded chunk if it matches its checksum, else False. """
+    if isinstance(chunk_checksum, str):
+        checksum = md5sum_bytestring(byte_chunk)[-2:]  # Legacy pickled frame
+    else:
+        checksum = integrity.chunk_checksum(integrity_byte, byte_chunk)
+    if checksum == chunk_checksum:
+        return byte_chunk
+    else:
+        return False
+
+
 def md5sum_bytestring(bytestring):
     byte_md5 = md5(bytestring)
     md5sum = byte_md5.hexdigest()
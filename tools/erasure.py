@@ -0,0 +1,113 @@
+"""
+Cross packet erasure coding.
+
+A block of N equally sized data packets gets K repair packets, every byte column of the block is a
+systematic Reed Solomon style code word over GF(256) built from a Cauchy matrix.
+Any N of the N + K packets are enough to rebuild the missing data packets, so loss tolerance no longer
+depends on which packets the diode drops.
+N + K can be at most 256.
+
+Packets are multiplied by a constant with bytes.translate and added (XOR) as big integers,
+so the per byte work is done in C.
+"""
+import math
+
+from tools.reed_solomon import GF_EXP, GF_LOG, GF_MUL
+
+GF_MUL_TRANSLATE = [bytes(row) for row in GF_MUL]  # GF_MUL_TRANSLATE[c] maps byte b to c * b
+MAX_BLOCK_PACKETS = 256
+
+
+def gf_inverse(a):
+    return GF_EXP[255 - GF_LOG[a]]
+
+
+def repair_packet_count(data_packets, overhead):
+    """ Number of repair packets needed for a block of data_packets at the given overhead (0.2 = 20%). """
+    return max(1, math.ceil(data_packets * overhead))
+
+
+def cauchy_coefficient(repair_nr, data_nr):
+    """ Weight of data packet data_nr in repair packet repair_nr, any square submatrix is invertible.
+    Repair packets count down from 255 and data packets up from 0, so the two never meet while N + K <= 256
+    and the weights don't depend on how many repair packets a block has. """
+    return gf_inverse((MAX_BLOCK_PACKETS - 1 - repair_nr) ^ data_nr)
+
+
+def _scale(packet, coefficient):
+    return int.from_bytes(bytes(packet).translate(GF_MUL_TRANSLATE[coefficient]), "big")
+
+
+def _pad(packet, width):
+    packet = bytes(packet)
+    return packet + bytes(width - len(packet))
+
+
+def encode_block(data_packets, repair_count):
+    """
+    Returns repair_count repair packets for a block of data packets.
+    Data packets shorter than the longest one are zero padded, repair packets have the padded width.
+    """
+    data_count = len(data_packets)
+    if data_count + repair_count > MAX_BLOCK_PACKETS:
+        raise ValueError("Erasure block too large: %s data + %s repair packets" % (data_count, repair_count))
+    width = max(len(packet) for packet in data_packets)
+    padded = [_pad(packet, width) for packet in data_packets]
+    repair_packets = []
+    for repair_nr in range(repair_count):
+        repair = 0
+        for data_nr, packet in enumerate(padded):
+            repair ^= _scale(packet, cauchy_coefficient(repair_nr, data_nr))
+        repair_packets.append(repair.to_bytes(width, "big"))
+    return repair_packets
+
+
+def _invert_matrix(matrix):
+    """ Gauss-Jordan inversion of a square matrix over GF(256). """
+    size = len(matrix)
+    rows = [list(row) + [int(i == j) for j in range(size)] for i, row in enumerate(matrix)]
+    for column in range(size):
+        pivot = next(row for row in range(column, size) if rows[row][column])
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        inverse_pivot = gf_inverse(rows[column][column])
+        rows[column] = [GF_MUL[inverse_pivot][value] for value in rows[column]]
+        for row in range(size):
+            factor = rows[row][column]
+            if row != column and factor:
+                rows[row] = [value ^ GF_MUL[factor][pivot_value]
+                             for value, pivot_value in zip(rows[row], rows[column])]
+    return [row[size:] for row in rows]
+
+
+def decode_block(packets, data_count, width):
+    """
+    Rebuilds the data packets of a block.
+    packets maps the index in the block (0..data_count-1 data, data_count.. repair) to a received packet.
+    Returns a list of data_count packets zero padded to width, or None if fewer than data_count arrived.
+    """
+    data = [packets.get(data_nr) for data_nr in range(data_count)]
+    missing = [data_nr for data_nr, packet in enumerate(data) if packet is None]
+    if not missing:
+        return [_pad(packet, width) for packet in data]
+    repair_nrs = [index - data_count for index in sorted(packets) if index >= data_count][:len(missing)]
+    if len(repair_nrs) < len(missing):
+        return None
+
+    # Remove the contribution of the data packets we have, what remains only depends on the missing ones.
+    known = [(data_nr, _pad(packet, width)) for data_nr, packet in enumerate(data) if packet is not None]
+    syndromes = []
+    for repair_nr in repair_nrs:
+        syndrome = int.from_bytes(_pad(packets[data_count + repair_nr], width), "big")
+        for data_nr, packet in known:
+            syndrome ^= _scale(packet, cauchy_coefficient(repair_nr, data_nr))
+        syndromes.append(syndrome.to_bytes(width, "big"))
+
+    inverse = _invert_matrix([[cauchy_coefficient(repair_nr, data_nr) for data_nr in missing]
+                              for repair_nr in repair_nrs])
+    for inverse_row, data_nr in zip(inverse, missing):
+        rebuilt = 0
+        for coefficient, syndrome in zip(inverse_row, syndromes):
+            if coefficient:
+                rebuilt ^= _scale(syndrome, coefficient)
+        data[data_nr] = rebuilt.to_bytes(width, "big")
+    return [_pad(packet, width) for packet in data]
@@ -0,0 +1,344 @@
+"""
+File transfer without Redis.
+
+The sender maps a file with mmap and sends it as a sequence of block items of block_bytes, only one block is
+in memory at a time whatever the file size. Every block item starts with a BLOCK_HEADER carrying the file id,
+the file size, the block size and the BLAKE2b hash of the block, so the receiver can preallocate the
+destination and check the block on its own. After the last block comes a manifest item with the relative path
+and the hashes of all blocks.
+File items are ordinary items with FLAG_FILE set in the frame header, they get the same erasure coding,
+redundant copies and compression as items from Redis.
+
+The receiver writes every checked block at its offset into a preallocated, memory mapped part file.
+Once the manifest is in and every block matches its hash, the part file is renamed to the relative path under
+the output directory and a completion manifest (<path>.manifest.json) with the block hashes is written next
+to it. Files that stop getting blocks for timeout_seconds get an incomplete manifest listing the missing blocks.
+A file is only started if its size fits max_file_bytes and the free disk space, and its blocks max_block_bytes
+and MAX_FILE_BLOCKS. A file that can't be written or saved (a disk error, a path taken by a directory) is
+recorded as incomplete the same way, the receiver keeps going.
+"""
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import time
+
+from tools.metrics import METRICS
+
+KIND_BLOCK = 1
+KIND_MANIFEST = 2
+DIGEST_BYTES = 16
+# kind B, file_id Q, file_size Q, block_bytes I, block_nr I, block hash
+BLOCK_HEADER = struct.Struct("!BQQII%ds" % DIGEST_BYTES)
+# kind B, file_id Q, file_size Q, block_bytes I, block_count I, path_length H, then the path and the block hashes
+MANIFEST_HEADER = struct.Struct("!BQQIIH")
+PARTIAL_DIRECTORY = ".partial"  # Part files and incomplete manifests, under the output directory
+MAX_FILE_BLOCKS = 1 << 22  # 4 TiB in blocks of 1 MiB, bounds the per block state of a file
+
+
+def block_digest(block):
+    return hashlib.blake2b(block, digest_size=DIGEST_BYTES).digest()
+
+
+def block_count(file_size, block_bytes):
+    return -(-file_size // block_bytes)
+
+
+def pack_manifest(file_id, file_size, block_bytes, relative_path, block_hashes):
+    path = relative_path.encode()
+    return (MANIFEST_HEADER.pack(KIND_MANIFEST, file_id, file_size, block_bytes, len(block_hashes), len(path))
+            + path + b"".join(block_hashes))
+
+
+def unpack_manifest(item):
+    """ Returns (file_id, file_size, block_bytes, relative_path, block_hashes), raises ValueError if malformed. """
+    try:
+        _, file_id, file_size, block_bytes, count, path_length = MANIFEST_HEADER.unpack_from(item)
+    except struct.error:
+        raise ValueError("File manifest shorter than its header")
+    path_end = MANIFEST_HEADER.size + path_length
+    if len(item) != path_end + count * DIGEST_BYTES or block_bytes == 0 or count != block_count(file_size,
+                                                                                                   block_bytes):
+        raise ValueError("File manifest length doesn't match its header")
+    relative_path = bytes(item[MANIFEST_HEADER.size:path_end]).decode(errors="replace")
+    hashes = [bytes(item[offset:offset + DIGEST_BYTES]) for offset in range(path_end, len(item), DIGEST_BYTES)]
+    return file_id, file_size, block_bytes, relative_path, hashes
+
+
+def file_items(path, relative_path, block_bytes=1048576, file_id=None):
+    """
+    Yields the items of one file: its blocks read from a read only mapping, then its manifest.
+    Every block is copied once, behind its header, the mapping itself is never read into memory as a whole.
+    """
+    if file_id is None:
+        file_id = int.from_bytes(os.urandom(8), "big")
+    block_hashes = []
+    with open(path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        if file_size:  # Empty files can't be mapped, they are just a manifest
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                view = memoryview(mapped)
+                try:
+                    for block_nr, offset in enumerate(range(0, file_size, block_bytes)):
+                        with view[offset:offset + block_bytes] as block:
+                            digest = block_digest(block)
+                            item = bytearray(BLOCK_HEADER.size + len(block))
+                            BLOCK_HEADER.pack_into(item, 0, KIND_BLOCK, file_id, file_size, block_bytes, block_nr,
+                                                   digest)
+                            item[BLOCK_HEADER.size:] = block
+                        block_hashes.append(digest)
+                        yield item
+                finally:
+                    view.release()  # The mapping can't be closed while a view of it exists
+    yield pack_manifest(file_id, file_size, block_bytes, relative_path, block_hashes)
+
+
+def walk_files(paths):
+    """ Yields (path, relative path) of the files and of everything in the directories in paths.
+    Directories keep their own name in the relative path. """
+    for path in paths:
+        path = os.path.abspath(path)
+        if not os.path.isdir(path):
+            yield path, os.path.basename(path)
+            continue
+        parent = os.path.dirname(path)
+        for directory, subdirectories, file_names in os.walk(path):
+            subdirectories.sort()
+            for file_name in sorted(file_names):
+                file_path = os.path.join(directory, file_name)
+                if os.path.isfile(file_path):
+                    yield file_path, os.path.relpath(file_path, parent)
+
+
+class IncomingFile:
+    """ A file being received, blocks are written straight into a mapping of its part file. """
+
+    def __init__(self, part_path, file_size, block_bytes):
+        self.part_path = part_path
+        self.file_size = file_size
+        self.block_bytes = block_bytes
+        self.block_count = block_count(file_size, block_bytes)
+        self.block_hashes = [None] * self.block_count  # Hashes of the blocks written so far
+        self.missing = self.block_count
+        self.relative_path = None  # Known once the manifest is in
+        self.manifest_hashes = None
+        self.last_activity = time.monotonic()
+        self.file = open(part_path, "w+b")
+        self.mapped = None
+        if file_size:
+            try:
+                try:
+                    os.posix_fallocate(self.file.fileno(), 0, file_size)
+                except (AttributeError, OSError):
+                    self.file.truncate(file_size)  # Sparse, when the file system can't preallocate
+                self.mapped = mmap.mmap(self.file.fileno(), file_size)
+            except (OSError, ValueError):
+                self.file.close()
+                os.remove(part_path)
+                raise
+
+    def write_block(self, block_nr, digest, data):
+        offset = block_nr * self.block_bytes
+        self.mapped[offset:offset + len(data)] = data
+        self.block_hashes[block_nr] = digest
+        self.missing -= 1
+
+    def missing_blocks(self):
+        return [block_nr for block_nr, digest in enumerate(self.block_hashes) if digest is None]
+
+    def close(self):
+        if self.mapped is not None:
+            self.mapped.flush()
+            self.mapped.close()
+        self.file.close()
+
+
+class FileWriter:
+    """ Writes file items into output_directory, see the module docstring. """
+
+    def __init__(self, output_directory, timeout_seconds=60.0, max_file_bytes=0, max_block_bytes=67108864):
+        """ max_file_bytes 0 only limits files to the free disk space. """
+        self.output_directory = os.path.abspath(output_directory)
+        self.partial_directory = os.path.join(self.output_directory, PARTIAL_DIRECTORY)
+        os.makedirs(self.partial_directory, exist_ok=True)
+        self.timeout_seconds = timeout_seconds
+        self.max_file_bytes = max_file_bytes
+        self.max_block_bytes = max_block_bytes
+        self.files = {}  # file_id: IncomingFile
+        self.finished = {}  # file_id: when it was finished, so late copies don't start it again
+        self.last_expiry = time.monotonic()
+
+    def put(self, item):
+        """ Takes a completed file item, a block or a manifest. Returns False if it was malformed. """
+        if not item:
+            return False
+        try:
+            if item[0] == KIND_BLOCK:
+                return self._put_block(item)
+            if item[0] == KIND_MANIFEST:
+                return self._put_manifest(item)
+        except ValueError as e:
+            print("[x] Dropping file item. %s" % e)
+            METRICS.inc("file_items_invalid")
+            return False
+        except OSError as e:
+            self._failed(int.from_bytes(item[1:9], "big"), e)
+            return False
+        METRICS.inc("file_items_invalid")
+        return False
+
+    def _failed(self, file_id, error):
+        """ Gives up on a file that couldn't be written. """
+        incoming = self.files.pop(file_id, None)
+        self.finished[file_id] = time.monotonic()
+        if incoming is None:
+            print("[x] File %016x incomplete, it can't be written. %s" % (file_id, error))
+            METRICS.inc("files_incomplete")
+            return
+        incoming.close()
+        self._incomplete(file_id, incoming, "it can't be written, %s" % error)
+
+    def _check_size(self, file_id, file_size, block_bytes):
+        """ Raises ValueError for files that can't be received, before anything is allocated for them. """
+        if block_bytes == 0 or block_bytes > self.max_block_bytes:
+            raise ValueError("File %016x has a block size of %s, max_block_bytes is %s" % (
+                file_id, block_bytes, self.max_block_bytes))
+        if block_count(file_size, block_bytes) > MAX_FILE_BLOCKS:
+            raise ValueError("File %016x has more than %s blocks" % (file_id, MAX_FILE_BLOCKS))
+        if self.max_file_bytes and file_size > self.max_file_bytes:
+            raise ValueError("File %016x of %s bytes is larger than max_file_bytes" % (file_id, file_size))
+        free_bytes = shutil.disk_usage(self.partial_directory).free
+        if file_size > free_bytes:
+            raise ValueError("File %016x of %s bytes doesn't fit the %s bytes of free disk space" % (
+                file_id, file_size, free_bytes))
+
+    def _incoming(self, file_id, file_size, block_bytes):
+        incoming = self.files.get(file_id)
+        if incoming is None:
+            if file_id in self.finished:
+                return None
+            try:
+                self._check_size(file_id, file_size, block_bytes)
+            except ValueError:
+                self.finished[file_id] = time.monotonic()  # Its other items are dropped without a message
+                raise
+            incoming = IncomingFile(os.path.join(self.partial_directory, "%016x.part" % file_id), file_size,
+                                    block_bytes)
+            self.files[file_id] = incoming
+        elif (incoming.file_size, incoming.block_bytes) != (file_size, block_bytes):
+            raise ValueError("File %016x changed size between items" % file_id)
+        incoming.last_activity = time.monotonic()
+        return incoming
+
+    def _put_block(self, item):
+        try:
+            _, file_id, file_size, block_bytes, block_nr, digest = BLOCK_HEADER.unpack_from(item)
+        except struct.error:
+            raise ValueError("File block shorter than its header")
+        incoming = self._incoming(file_id, file_size, block_bytes)
+        if incoming is None or block_nr >= incoming.block_count or incoming.block_hashes[block_nr] is not None:
+            return True  # Already written, or the file is done
+        data = memoryview(item)[BLOCK_HEADER.size:]
+        expected_bytes = min(block_bytes, file_size - block_nr * block_bytes)
+        if len(data) != expected_bytes or block_digest(data) != digest:
+            METRICS.inc("file_block_hash_failures")
+            raise ValueError("Block %s of file %016x doesn't match its hash" % (block_nr, file_id))
+        incoming.write_block(block_nr, digest, data)
+        METRICS.inc("file_blocks_written")
+        if incoming.missing == 0 and incoming.manifest_hashes is not None:
+            self._finish(file_id, incoming)
+        return True
+
+    def _put_manifest(self, item):
+        file_id, file_size, block_bytes, relative_path, block_hashes = unpack_manifest(item)
+        incoming = self._incoming(file_id, file_size, block_bytes)
+        if incoming is None or incoming.manifest_hashes is not None:
+            return True
+        incoming.relative_path = relative_path
+        incoming.manifest_hashes = block_hashes
+        if incoming.missing == 0:
+            self._finish(file_id, incoming)
+        return True
+
+    def destination(self, relative_path):
+        """ Path under the output directory, None for paths that would end up outside of it. """
+        destination = os.path.normpath(os.path.join(self.output_directory, relative_path))
+        if (os.path.isabs(relative_path) or not destination.startswith(self.output_directory + os.sep)
+                or destination.startswith(self.partial_directory + os.sep)):
+            return None
+        return destination
+
+    def _finish(self, file_id, incoming):
+        del self.files[file_id]
+        self.finished[file_id] = time.monotonic()
+        incoming.close()
+        destination = self.destination(incoming.relative_path)
+        if incoming.block_hashes != incoming.manifest_hashes or destination is None:
+            self._incomplete(file_id, incoming,
+                             "unsafe path" if destination is None else "blocks don't match the manifest")
+            return
+        try:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            os.replace(incoming.part_path, destination)
+        except OSError as e:
+            self._incomplete(file_id, incoming, "it can't be saved as %s, %s" % (destination, e))
+            return
+        try:
+            self._write_manifest(destination + ".manifest.json", file_id, incoming)
+        except OSError as e:
+            print("[x] Can't write the manifest of %s. %s" % (destination, e))
+        METRICS.inc("files_received")
+        print("[*] Received file %s, %s bytes." % (incoming.relative_path, incoming.file_size))
+
+    def expire(self, now=None):
+        """ Gives up on files that got no item for timeout_seconds, checks at most once per second. """
+        if now is None:
+            now = time.monotonic()
+        if now - self.last_expiry < 1.0:
+            return
+        self.last_expiry = now
+        for file_id, incoming in list(self.files.items()):
+            if now - incoming.last_activity < self.timeout_seconds:
+                continue
+            del self.files[file_id]
+            self.finished[file_id] = now
+            incoming.close()
+            reason = "timed out, %s blocks missing" % incoming.missing
+            if incoming.manifest_hashes is None:
+                reason += ", no manifest"
+            self._incomplete(file_id, incoming, reason)
+        for file_id, finished in list(self.finished.items()):
+            if now - finished > self.timeout_seconds:
+                del self.finished[file_id]
+
+    def _incomplete(self, file_id, incoming, reason):
+        """ Reports a file that wasn't saved, with a manifest in the partial directory. """
+        print("[x] File %s (%016x) incomplete, %s." % (incoming.relative_path, file_id, reason))
+        METRICS.inc("files_incomplete")
+        try:
+            self._write_manifest(os.path.join(self.partial_directory, "%016x.manifest.json" % file_id), file_id,
+                                 incoming, reason)
+        except OSError as e:
+            print("[x] Can't write the manifest of %016x. %s" % (file_id, e))
+
+    @staticmethod
+    def _write_manifest(path, file_id, incoming, problem=None):
+        manifest = {"file_id": "%016x" % file_id, "path": incoming.relative_path, "size": incoming.file_size,
+                    "block_bytes": incoming.block_bytes, "hash": "blake2b-%s" % (DIGEST_BYTES * 8),
+                    "blocks": [digest.hex() if digest else None for digest in incoming.block_hashes],
+                    "complete": problem is None, "finished": time.time()}
+        if problem:
+            manifest["problem"] = problem
+            manifest["missing_blocks"] = incoming.missing_blocks()
+            manifest["part_file"] = incoming.part_path
+        with open(path, "w") as f:
+            json.dump(manifest, f, indent=1)
+
+    def close(self):
+        for incoming in self.files.values():
+            incoming.close()
+        self.files = {}
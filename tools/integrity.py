@@ -0,0 +1,154 @@
+"""
+Checksums of chunks and digests of items.
+
+Every chunk is checked with a 32 bit checksum and every item gets a 64 bit digest that is its id and is checked
+once the item is complete, both as binary digests at their full width in the frame header.
+Which algorithms were used is one byte of the header, chunk checksum in the high nibble and item digest in the
+low one, so senders and receivers can change algorithms without a new frame version.
+
+Chunk checksums: crc32c (Castagnoli, crc32c package, hardware accelerated), crc32 (zlib, always there),
+md5 (the last 32 bits, what older senders used). Item digests: xxh3 (64 bit xxh3, xxhash package),
+blake2b (8 byte BLAKE2b, hashlib), md5 (the last 64 bits).
+A sender uses crc32 and xxh3 by default, crc32c is opt-in as a receiver without the crc32c package can only
+check crc32c chunks with a table driven version, two orders of magnitude slower (it warns when it starts).
+Without the packages a sender falls back to crc32 and blake2b.
+without the xxhash package it can't check xxh3 item digests and only uses them as ids.
+"""
+import hashlib
+import zlib
+
+try:
+    import crc32c as _crc32c
+except ImportError:
+    _crc32c = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+CHUNK_MD5 = 0
+CHUNK_CRC32 = 1
+CHUNK_CRC32C = 2
+ITEM_MD5 = 0
+ITEM_BLAKE2B = 1
+ITEM_XXH3 = 2
+CHUNK_ALGORITHMS = {"md5": CHUNK_MD5, "crc32": CHUNK_CRC32, "crc32c": CHUNK_CRC32C}
+ITEM_ALGORITHMS = {"md5": ITEM_MD5, "blake2b": ITEM_BLAKE2B, "xxh3": ITEM_XXH3}
+_warned = set()  # Algorithms the receiver already warned about
+
+
+def _crc32c_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _crc32c_table()
+
+
+def crc32c_python(data):
+    """ CRC32C one byte at a time, for receivers without the crc32c package. """
+    crc = 0xffffffff
+    table = _CRC32C_TABLE
+    for byte in bytes(data):
+        crc = table[(crc ^ byte) & 0xff] ^ (crc >> 8)
+    return crc ^ 0xffffffff
+
+
+def md5_chunk_checksum(data):
+    return int.from_bytes(hashlib.md5(data).digest()[-4:], "big")
+
+
+def md5_item_digest(data):
+    return int.from_bytes(hashlib.md5(data).digest()[-8:], "big")
+
+
+def blake2b_item_digest(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+
+CHUNK_FUNCTIONS = {CHUNK_MD5: md5_chunk_checksum, CHUNK_CRC32: zlib.crc32,
+                   CHUNK_CRC32C: _crc32c.crc32c if _crc32c else crc32c_python}
+ITEM_FUNCTIONS = {ITEM_MD5: md5_item_digest, ITEM_BLAKE2B: blake2b_item_digest}
+if xxhash:
+    ITEM_FUNCTIONS[ITEM_XXH3] = xxhash.xxh3_64_intdigest
+
+
+class IntegritySuite:
+    """ The chunk checksum and item digest a sender uses, by name, with fallbacks when a package is missing. """
+
+    def __init__(self, chunk="crc32", item="xxh3"):
+        if chunk not in CHUNK_ALGORITHMS:
+            raise ValueError("Unknown chunk checksum %s, use one of %s" % (chunk, ", ".join(CHUNK_ALGORITHMS)))
+        if item not in ITEM_ALGORITHMS:
+            raise ValueError("Unknown item digest %s, use one of %s" % (item, ", ".join(ITEM_ALGORITHMS)))
+        if chunk == "crc32c" and not _crc32c:
+            print("[x] crc32c package not installed, checking chunks with crc32.")
+            chunk = "crc32"
+        if item == "xxh3" and not xxhash:
+            print("[x] xxhash package not installed, using blake2b item digests.")
+            item = "blake2b"
+        self.chunk_name = chunk
+        self.item_name = item
+        self.chunk_checksum = CHUNK_FUNCTIONS[CHUNK_ALGORITHMS[chunk]]
+        self.item_digest = ITEM_FUNCTIONS[ITEM_ALGORITHMS[item]]
+        self.header_byte = CHUNK_ALGORITHMS[chunk] << 4 | ITEM_ALGORITHMS[item]
+
+
+class LegacyMd5Suite:
+    """ md5 hexdigests, for the pickled tuples of the legacy format. """
+    chunk_name = item_name = "md5"
+    header_byte = 0
+
+    @staticmethod
+    def chunk_checksum(data):
+        return hashlib.md5(data).hexdigest()
+
+    item_digest = chunk_checksum
+
+
+LEGACY_MD5 = LegacyMd5Suite()
+_default_suite = None
+
+
+def default_suite():
+    """ The default algorithms, created on first use so a missing package is only reported then. """
+    global _default_suite
+    if _default_suite is None:
+        _default_suite = IntegritySuite()
+    return _default_suite
+
+
+def warn_missing_packages():
+    """ Warns a receiver at startup about the checks it can only do slowly, or not at all. """
+    if not _crc32c:
+        print("[x] crc32c package not installed, chunks of senders with chunk_checksum = crc32c are checked "
+              "slowly in Python. Install it, or keep those senders on crc32.")
+    if not xxhash:
+        print("[x] xxhash package not installed, xxh3 item digests are only used as ids and not checked.")
+
+
+def chunk_checksum(header_byte, data):
+    """ Checksum of a chunk with the algorithm of the frame, None if it is unknown. """
+    function = CHUNK_FUNCTIONS.get(header_byte >> 4)
+    if function is None:
+        return None
+    if function is crc32c_python and "crc32c" not in _warned:
+        _warned.add("crc32c")
+        print("[x] crc32c package not installed, checking crc32c chunks slowly in Python.")
+    return function(data)
+
+
+def check_item(header_byte, data, digest):
+    """ False if the item doesn't match its digest. Items with a digest this receiver can't compute pass. """
+    function = ITEM_FUNCTIONS.get(header_byte & 0x0f)
+    if function is None:
+        if header_byte not in _warned:
+            _warned.add(header_byte)
+            print("[x] Can't check item digest %s, install the xxhash package." % (header_byte & 0x0f))
+        return True
+    return function(data) == digest
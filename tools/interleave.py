@@ -0,0 +1,115 @@
+"""
+Interleaved transmission on the sender.
+
+Sending items one after another, and the copies or repair packets of an item right after its data packets,
+puts all packets of an item next to each other on the wire. A burst drop (a switch buffer overflowing,
+the receiver pausing) then takes out a whole stretch of one item, data and redundancy alike, which its
+erasure coding can't make up for.
+
+The Interleaver keeps up to depth items in flight and sends their datagrams round robin, one item after
+another, so a burst of N datagrams costs each item about N / depth of them.
+Redundant datagrams (repair packets and the extra copies) of an item start at a different packet for every item,
+otherwise the copies of the same packet of neighbouring items would be neighbours again and one burst could take
+out the copies of packets an earlier burst took, for several items at once.
+With spread_seconds they are not sent with the data but spread evenly over spread_seconds after the item was added,
+so one burst can't take an item's data and its redundancy. Items whose data is sent don't count against depth
+while their redundancy is waiting.
+
+Both cost latency: an item waits for the items it is interleaved with, and is only complete at the receiver
+once enough of its redundant datagrams came in when data packets were lost. depth and spread_seconds
+should be set against the latency budget, depth 1 and spread 0 send items one after another.
+Items of a stream can complete out of order at the receiver when they are interleaved.
+
+An item can come with a done function, that is called once its last datagram was popped and sent (see sent),
+the sender acknowledges spooled items with it, see tools/spool.py
+"""
+import collections
+import heapq
+import itertools
+import time
+
+GOLDEN_RATIO = 0.6180339887  # Item n starts its redundancy n * GOLDEN_RATIO into it, far from its neighbours
+
+
+class Interleaver:
+
+    def __init__(self, depth=1, spread_seconds=0.0):
+        self.depth = max(1, depth)
+        self.spread_seconds = spread_seconds
+        self.items = collections.deque()  # (deque of datagrams, progress) per item that is sending data
+        self.spread = []  # A heap of (release time, order, datagram, progress)
+        self.finished = []  # done functions of items whose last datagram was popped, see sent
+        self.order = itertools.count()
+        self.added_items = 0
+        self.pending_datagrams = 0
+
+    def full(self):
+        return len(self.items) >= self.depth
+
+    def add(self, datagrams, spread_datagrams=(), now=None, done=None):
+        """ datagrams go out as soon as their turn comes, spread_datagrams after them or over spread_seconds.
+        done is called without arguments once every datagram of the item is sent. """
+        spread_count = len(spread_datagrams)
+        start = int(spread_count * (self.added_items * GOLDEN_RATIO % 1.0))
+        spread_datagrams = spread_datagrams[start:] + spread_datagrams[:start]
+        self.added_items += 1
+        self.pending_datagrams += len(datagrams) + spread_count
+        progress = None
+        if done:
+            progress = [len(datagrams) + spread_count, done]  # Datagrams not popped yet
+            if not progress[0]:
+                self.finished.append(done)
+        if self.spread_seconds <= 0:
+            datagrams = itertools.chain(datagrams, spread_datagrams)
+        elif spread_count:
+            if now is None:
+                now = time.monotonic()
+            for spread_nr, datagram in enumerate(spread_datagrams):
+                release = now + self.spread_seconds * (spread_nr + 1) / spread_count
+                heapq.heappush(self.spread, (release, next(self.order), datagram, progress))
+        queue = collections.deque(datagrams)
+        if queue:
+            self.items.append((queue, progress))
+
+    def _popped(self, progress):
+        progress[0] -= 1
+        if progress[0] == 0:
+            self.finished.append(progress[1])
+
+    def pop_ready(self, max_datagrams, now=None):
+        """ Up to max_datagrams datagrams that are due, spread datagrams first and then one from every item in turn. """
+        if now is None:
+            now = time.monotonic()
+        ready = []
+        spread = self.spread
+        while spread and spread[0][0] <= now and len(ready) < max_datagrams:
+            _, _, datagram, progress = heapq.heappop(spread)
+            ready.append(datagram)
+            if progress:
+                self._popped(progress)
+        items = self.items
+        while items and len(ready) < max_datagrams:
+            queue, progress = items[0]
+            ready.append(queue.popleft())
+            if progress:
+                self._popped(progress)
+            if queue:
+                items.rotate(-1)
+            else:
+                items.popleft()  # The next item is now first, no rotation needed
+        self.pending_datagrams -= len(ready)
+        return ready
+
+    def sent(self):
+        """ Calls the done functions of the items whose datagrams are all sent, once pop_ready's datagrams are. """
+        finished, self.finished = self.finished, []
+        for done in finished:
+            done()
+
+    def next_release(self):
+        """ When the next datagram comes due, None if nothing is waiting. """
+        if self.items:
+            return 0.0
+        if self.spread:
+            return self.spread[0][0]
+        return None
@@ -0,0 +1,152 @@
+"""
+Counters and histograms shared by the sender and the receiver.
+
+Both programs count into the module level METRICS registry, and export it as Prometheus text on a localhost
+HTTP endpoint, as a JSON file rewritten every few seconds, or both. See start_exporters.
+Counters kept elsewhere (the transmitter, the Reed Solomon codec, a worker pool) are registered as functions
+and read at export time, so the hot paths don't count twice.
+
+Histograms have fixed buckets: observing is a bisect and two additions.
+"""
+import bisect
+import http.server
+import json
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+CPU_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+               0.1, 0.25, 1.0)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
+
+
+class Metrics:
+
+    def __init__(self, prefix="rediode"):
+        self.prefix = prefix
+        self.lock = threading.Lock()  # Counters are updated from the main, output and decode threads
+        self.counters = {}
+        self.histograms = {}
+        self.functions = {}  # name: function returning the current value
+        self.started = time.time()
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    def register_function(self, name, function):
+        """ Exports the value returned by function as name, for values that are counted somewhere else. """
+        self.functions[name] = function
+
+    def to_dict(self):
+        with self.lock:
+            snapshot = {"timestamp": time.time(), "uptime_seconds": time.time() - self.started,
+                        "counters": dict(self.counters),
+                        "histograms": {name: histogram.to_dict() for name, histogram in self.histograms.items()}}
+        for name, function in self.functions.items():
+            try:
+                snapshot["counters"][name] = function()
+            except Exception as e:
+                print("[x] Metric %s failed. %s" % (name, e))
+        return snapshot
+
+    def render_prometheus(self):
+        snapshot = self.to_dict()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append("%s_%s %s" % (self.prefix, name, value))
+        for name, histogram in sorted(snapshot["histograms"].items()):
+            full_name = "%s_%s" % (self.prefix, name)
+            lines.append("# TYPE %s histogram" % full_name)
+            for bound, count in histogram["buckets"].items():
+                lines.append('%s_bucket{le="%s"} %s' % (full_name, bound, count))
+            lines.append("%s_sum %s" % (full_name, histogram["sum"]))
+            lines.append("%s_count %s" % (full_name, histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    metrics = METRICS
+
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.metrics.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # No line per scrape
+
+
+def start_prometheus_server(port, host="127.0.0.1", metrics=METRICS):
+    """ Serves the metrics as Prometheus text on http://host:port/metrics from a daemon thread. """
+    handler = type("MetricsHandler", (_MetricsHandler,), {"metrics": metrics})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print("[*] Metrics on http://%s:%s/metrics" % (host, port))
+    return server
+
+
+def write_json_file(path, metrics=METRICS):
+    """ Replaces the stats file in one step, readers never see half a file. """
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(metrics.to_dict(), f, indent=1)
+    os.replace(temporary_path, path)
+
+
+def start_json_writer(path, interval_seconds=10.0, metrics=METRICS):
+    def run():
+        while True:
+            time.sleep(interval_seconds)
+            try:
+                write_json_file(path, metrics)
+            except OSError as e:
+                print("[x] Could not write metrics to %s. %s" % (path, e))
+
+    threading.Thread(target=run, name="metrics-json", daemon=True).start()
+
+
+def start_exporters(settings, metrics=METRICS):
+    """ Starts the exporters enabled by the metrics_port, metrics_json_file and metrics_json_seconds settings. """
+    if settings["metrics_port"]:
+        start_prometheus_server(settings["metrics_port"], metrics=metrics)
+    if settings["metrics_json_file"]:
+        start_json_writer(settings["metrics_json_file"], settings["metrics_json_seconds"], metrics=metrics)
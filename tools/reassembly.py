@@ -0,0 +1,130 @@
+"""
+Reassembly of items on the receiver.
+
+Every in-flight item gets one ItemReassembly, holding a preallocated buffer that chunks are written into
+at their offset, a bitmap of received packets and a count of missing ones.
+The item is complete the moment the missing count reaches zero, whatever order packets arrive in,
+and the payload is a view of the buffer, so it is never joined or copied again.
+"""
+from tools import erasure
+
+
+class ItemReassembly:
+    """
+    fec_info is (fec_block_packets, repair_packets_per_block, item_length, chunk_bytes) for erasure coded items.
+    Without it, the chunk size is learned from the first packet that isn't the last one,
+    as all packets but the last are full size.
+    """
+    __slots__ = ("total_packets", "chunk_bytes", "item_length", "buffer", "received", "missing", "timestamp",
+                 "last_chunk", "block_packets", "repair_count", "block_received", "block_repairs")
+
+    def __init__(self, total_packets, fec_info=None, timestamp=0):
+        self.total_packets = total_packets
+        self.received = bytearray((total_packets + 7) // 8)
+        self.missing = total_packets
+        self.timestamp = timestamp
+        self.last_chunk = None  # Last packet, kept aside until the chunk size is known
+        self.buffer = None
+        self.chunk_bytes = None
+        self.item_length = None
+        self.block_packets = None
+        if fec_info:
+            self.block_packets, self.repair_count, self.item_length, self.chunk_bytes = fec_info
+            self.buffer = bytearray(self.item_length)
+            block_count = -(-total_packets // self.block_packets)
+            self.block_received = [0] * block_count  # Data and repair packets received per block
+            self.block_repairs = [None] * block_count  # repair_nr: packet, created on the first repair packet
+
+    def has(self, packet_nr):
+        """ True if the packet isn't needed anymore, it was received or its block is already rebuilt. """
+        if packet_nr < self.total_packets:
+            return bool(self.received[packet_nr >> 3] & (1 << (packet_nr & 7)))
+        if not self.block_packets:
+            return True  # Repair packet number without erasure coding, nothing to do with it
+        block_nr = (packet_nr - self.total_packets) // self.repair_count
+        return block_nr >= len(self.block_received) or self._block_complete(block_nr)
+
+    def add(self, packet_nr, byte_chunk):
+        """ Stores a validated packet, returns True when the item is complete. """
+        if self.has(packet_nr):
+            return self.missing == 0
+        if packet_nr >= self.total_packets:
+            self._add_repair(packet_nr, byte_chunk)
+        elif self.buffer is None:
+            self._add_unsized(packet_nr, byte_chunk)
+        else:
+            self._write(packet_nr, byte_chunk)
+            if self.block_packets:
+                self._count_block_packet(packet_nr // self.block_packets)
+        return self.missing == 0
+
+    def payload(self):
+        """ The complete item, a view of the reassembly buffer. """
+        if len(self.buffer) == self.item_length:
+            return self.buffer
+        return memoryview(self.buffer)[:self.item_length]
+
+    def _write(self, packet_nr, byte_chunk, mark=True):
+        offset = packet_nr * self.chunk_bytes
+        self.buffer[offset:offset + len(byte_chunk)] = byte_chunk
+        if packet_nr == self.total_packets - 1:
+            self.item_length = offset + len(byte_chunk)
+        if mark:
+            self.received[packet_nr >> 3] |= 1 << (packet_nr & 7)
+            self.missing -= 1
+
+    def _add_unsized(self, packet_nr, byte_chunk):
+        """ Packets of an item without erasure coding, before the buffer is allocated. """
+        last_packet_nr = self.total_packets - 1
+        if packet_nr == last_packet_nr and self.total_packets > 1:
+            # The last packet can be short, keep it aside until a full packet tells the chunk size.
+            self.last_chunk = byte_chunk
+            self.received[packet_nr >> 3] |= 1 << (packet_nr & 7)
+            self.missing -= 1
+            return
+        self.chunk_bytes = len(byte_chunk)
+        self.buffer = bytearray(self.chunk_bytes * self.total_packets)
+        self.item_length = len(self.buffer)
+        self._write(packet_nr, byte_chunk)
+        if self.last_chunk is not None:
+            self._write(last_packet_nr, self.last_chunk, mark=False)
+            self.last_chunk = None
+
+    def _block_complete(self, block_nr):
+        return self.block_received[block_nr] >= self._block_data_count(block_nr)
+
+    def _block_data_count(self, block_nr):
+        return min(self.block_packets, self.total_packets - block_nr * self.block_packets)
+
+    def _add_repair(self, packet_nr, byte_chunk):
+        block_nr, repair_nr = divmod(packet_nr - self.total_packets, self.repair_count)
+        if self.block_repairs[block_nr] is None:
+            self.block_repairs[block_nr] = {}
+        self.block_repairs[block_nr][repair_nr] = byte_chunk
+        self._count_block_packet(block_nr)
+
+    def _count_block_packet(self, block_nr):
+        """ Rebuilds the missing data packets of a block once it has as many packets as data packets. """
+        self.block_received[block_nr] += 1
+        repairs = self.block_repairs[block_nr]
+        if not repairs or self.block_received[block_nr] != self._block_data_count(block_nr):
+            return
+        data_count = self._block_data_count(block_nr)
+        block_start = block_nr * self.block_packets
+        block_offset = block_start * self.chunk_bytes
+        width = min(self.chunk_bytes, self.item_length - block_offset)
+        packets = {data_count + repair_nr: packet for repair_nr, packet in repairs.items()}
+        missing_nrs = []
+        for data_nr in range(data_count):
+            packet_nr = block_start + data_nr
+            if self.received[packet_nr >> 3] & (1 << (packet_nr & 7)):
+                offset = block_offset + data_nr * self.chunk_bytes
+                packets[data_nr] = self.buffer[offset:offset + self.chunk_bytes]
+            else:
+                missing_nrs.append(data_nr)
+        rebuilt_block = erasure.decode_block(packets, data_count, width)
+        for data_nr in missing_nrs:
+            packet_nr = block_start + data_nr
+            # Remove padding, only the last packet of an item can be shorter.
+            self._write(packet_nr, rebuilt_block[data_nr][:self.item_length - packet_nr * self.chunk_bytes])
+        self.block_repairs[block_nr] = None
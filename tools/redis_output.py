@@ -0,0 +1,199 @@
+"""
+Receiver output stage.
+
+Completed items are put on an in-memory backlog and a background thread pushes them to Redis,
+so the thread that reads the UDP socket never waits for a Redis round trip.
+Every item can go to its own queue, items of the same queue are pushed in the order they were put.
+Items are flushed with multi-value RPUSH in one pipeline when flush_items are waiting or when the
+oldest waiting item is flush_seconds old. If Redis goes away, or refuses writes for a while (OOM under maxmemory,
+READONLY after a failover, BUSY running a script), the pushes are kept and retried with backoff until Redis takes
+them, only the pushes that failed, so a retried push can land after a later push of its queue from the same
+pipeline. Pushes Redis will never take (WRONGTYPE) are dropped and counted, the thread never stops on an error.
+The backlog is bounded, when it is full the oldest item is dropped and counted.
+With a spool (see tools/spool.py) items wait in it on disk instead, and are acknowledged once they are in Redis,
+so an outage only drops items once the spool is full, and items that weren't pushed are pushed after a restart.
+"""
+import collections
+import threading
+import time
+
+import redis
+
+from tools.metrics import METRICS
+
+MAX_RETRY_SECONDS = 30.0
+# Errors Redis recovers from by itself, the last ones by their reply, as older redis-py raise a plain ResponseError.
+TRANSIENT_ERRORS = (ConnectionError,) + tuple(
+    getattr(redis.exceptions, name) for name in ("ConnectionError", "TimeoutError", "ReadOnlyError",
+                                                 "OutOfMemoryError", "MasterDownError", "TryAgainError",
+                                                 "ClusterDownError") if hasattr(redis.exceptions, name))
+TRANSIENT_REPLIES = ("OOM", "READONLY", "BUSY", "LOADING", "MASTERDOWN", "TRYAGAIN", "CLUSTERDOWN")
+
+
+def push_commands(queue_items, flush_items):
+    """ (redis_queue, items) of every RPUSH, of at most flush_items items. """
+    return [(redis_queue, items[start:start + flush_items])
+            for redis_queue, items in queue_items.items() for start in range(0, len(items), flush_items)]
+
+
+def sort_push_results(commands, results):
+    """
+    Splits pipelined pushes by their results, an exception or the reply of every command.
+    Returns (items pushed, commands to retry, first error to retry on, items dropped).
+    """
+    pushed_items = dropped_items = 0
+    retry_commands = []
+    retry_error = None
+    for (redis_queue, items), result in zip(commands, results):
+        if not isinstance(result, Exception):
+            pushed_items += len(items)
+            continue
+        METRICS.inc("redis_errors")
+        if isinstance(result, TRANSIENT_ERRORS) or str(result).startswith(TRANSIENT_REPLIES):
+            retry_commands.append((redis_queue, items))
+            retry_error = retry_error or result
+        else:
+            print("[x] Redis refused %s items for %s, dropping them. %s" % (len(items), redis_queue, result))
+            dropped_items += len(items)
+    return pushed_items, retry_commands, retry_error, dropped_items
+
+
+class RedisOutput:
+
+    def __init__(self, redis_server, redis_queue, flush_items=100, flush_seconds=0.05, max_backlog_items=100000,
+                 retry_seconds=1.0, spool=None):
+        self.redis_server = redis_server
+        self.redis_queue = redis_queue
+        self.flush_items = flush_items
+        self.flush_seconds = flush_seconds
+        self.max_backlog_items = max_backlog_items
+        self.retry_seconds = retry_seconds
+        self.spool = spool  # Takes the place of the backlog, max_backlog_items is then the most pushed at a time
+
+        self.backlog = collections.deque()
+        self.oldest_timestamp = 0.0  # When the oldest item in the backlog was added
+        self.condition = threading.Condition()
+        self.running = True
+        self.pushed_items = 0
+        self.dropped_items = 0
+        self.flush_count = 0
+
+        self.thread = threading.Thread(target=self._run, name="redis-output", daemon=True)
+        self.thread.start()
+
+    def put(self, item, redis_queue=None):
+        """ Queues an item for redis_queue, the queue given at creation if None. """
+        with self.condition:
+            if not self.backlog_size():
+                self.oldest_timestamp = time.monotonic()
+            if self.spool is not None:
+                if self.spool.full():
+                    self._dropped("Redis output spool full")
+                    return
+                self.spool.put([(redis_queue or self.redis_queue, item)])
+            else:
+                if len(self.backlog) >= self.max_backlog_items:
+                    self.backlog.popleft()
+                    self._dropped("Redis output backlog full")
+                self.backlog.append((redis_queue or self.redis_queue, item))
+            waiting_items = self.backlog_size()
+            if waiting_items == 1 or waiting_items >= self.flush_items:
+                # Wakes the thread to start the deadline of a new batch, or to flush a full one.
+                self.condition.notify()
+
+    def _dropped(self, reason):
+        self.dropped_items += 1
+        METRICS.inc("redis_dropped_items")
+        if self.dropped_items % 1000 == 1:
+            print("[x] %s, dropped %s items." % (reason, self.dropped_items))
+
+    def _run(self):
+        if self.spool is not None and len(self.spool):
+            self.oldest_timestamp = 0.0  # Items from before a restart, pushed right away
+        while True:
+            with self.condition:
+                while self.running:
+                    if self.backlog_size() >= self.flush_items:
+                        break
+                    if self.backlog_size():
+                        wait_seconds = self.oldest_timestamp + self.flush_seconds - time.monotonic()
+                        if wait_seconds <= 0:
+                            break
+                        self.condition.wait(wait_seconds)
+                    else:
+                        self.condition.wait()
+                if not self.backlog_size():
+                    if not self.running:
+                        return
+                    continue
+                if self.spool is not None:
+                    batch = [(redis_queue.decode(), item) for redis_queue, item in
+                             self.spool.take(self.max_backlog_items)]
+                    taken_records = self.spool.taken_records
+                else:
+                    batch = list(self.backlog)
+                    self.backlog.clear()
+            self._flush(batch)
+            if self.spool is not None:
+                with self.condition:
+                    self.spool.acknowledge(taken_records)
+
+    def _flush(self, batch):
+        """ Pushes the batch in one pipeline, retries what Redis refused for now until it takes it. """
+        queue_items = collections.defaultdict(list)
+        for redis_queue, item in batch:
+            queue_items[redis_queue].append(item)
+        commands = push_commands(queue_items, self.flush_items)
+        retry_seconds = self.retry_seconds
+        while commands:
+            started = time.perf_counter()
+            try:
+                pipeline = self.redis_server.pipeline(transaction=False)
+                for redis_queue, items in commands:
+                    pipeline.rpush(redis_queue, *items)
+                results = pipeline.execute(raise_on_error=False)
+            except Exception as e:
+                results = [e] * len(commands)
+            pushed_items, commands, retry_error, dropped_items = sort_push_results(commands, results)
+            for _ in range(dropped_items):
+                self._dropped("Redis refused items")
+            if pushed_items:
+                self.pushed_items += pushed_items
+                self.flush_count += 1
+                METRICS.observe("redis_flush_seconds", time.perf_counter() - started)
+                METRICS.inc("redis_pushed_items", pushed_items)
+            if commands:
+                print("[x] Redis output error, retrying in %s seconds. %s" % (retry_seconds, retry_error))
+                time.sleep(retry_seconds)
+                retry_seconds = min(retry_seconds * 2, MAX_RETRY_SECONDS)
+
+    def backlog_size(self):
+        return len(self.backlog) if self.spool is None else len(self.spool)
+
+    def close(self, timeout=10):
+        """ Flushes what is left in the backlog and stops the thread. """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        if self.spool is not None and not self.thread.is_alive():
+            self.spool.close()
+
+
+class DiscardOutput:
+    """ Output of a receiver without Redis, that only receives files. Items are counted and dropped. """
+
+    def __init__(self):
+        self.dropped_items = 0
+
+    def put(self, item, redis_queue=None):
+        self.dropped_items += 1
+        METRICS.inc("redis_dropped_items")
+        if self.dropped_items % 1000 == 1:
+            print("[x] No Redis to put items on, dropped %s items." % self.dropped_items)
+
+    def backlog_size(self):
+        return 0
+
+    def close(self, timeout=10):
+        pass
@@ -0,0 +1,248 @@
+"""
+Table driven Reed Solomon engine.
+
+reedsolo.RSCodec rebuilds its GF(256) tables and generator polynomial every time it is created,
+and does all parity and syndrome math one byte at a time in pure Python.
+This module builds a codec once per parameter set and keeps it in a cache.
+Parity and syndromes are linear in the input bytes, so every (position, byte value) pair is
+precomputed into a table and a block is reduced with one lookup and one XOR per byte.
+When NumPy is installed, whole batches of chunks are encoded and checked with vectorized lookups.
+
+Output is byte for byte compatible with reedsolo.RSCodec(checksum_bytes), which is still used to
+correct chunks that actually contain errors.
+"""
+from reedsolo import RSCodec, ReedSolomonError
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+GF_PRIMITIVE = 0x11d  # Same primitive polynomial and generator as reedsolo's defaults
+GF_GENERATOR = 2
+RS_BLOCK_SIZE = 255  # Max codeword size in GF(256)
+REDUCE_BATCH_BLOCKS = 1024  # Blocks looked up in one vectorized step, bounds the temporary lookup array
+
+GF_EXP = [0] * 512  # Antilog table, doubled so gf_mul never needs a modulo
+GF_LOG = [0] * 256
+
+_x = 1
+for _i in range(255):
+    GF_EXP[_i] = _x
+    GF_LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= GF_PRIMITIVE
+for _i in range(255, 512):
+    GF_EXP[_i] = GF_EXP[_i - 255]
+del _x, _i
+
+# GF_MUL[a][b] == a * b in GF(256)
+GF_MUL = [[0] * 256] + [[0] + [GF_EXP[GF_LOG[a] + GF_LOG[b]] for b in range(1, 256)] for a in range(1, 256)]
+
+_CODEC_CACHE = {}  # (checksum_bytes, block_size): ReedSolomonCodec
+
+
+def gf_mul(a, b):
+    return GF_MUL[a][b]
+
+
+def gf_poly_mul(p, q):
+    result = [0] * (len(p) + len(q) - 1)
+    for i, p_coef in enumerate(p):
+        for j, q_coef in enumerate(q):
+            result[i + j] ^= GF_MUL[p_coef][q_coef]
+    return result
+
+
+def rs_generator_poly(checksum_bytes):
+    """ Product of (x - a^i) for i in 0..checksum_bytes-1, highest degree first. """
+    generator = [1]
+    for i in range(checksum_bytes):
+        generator = gf_poly_mul(generator, [1, GF_EXP[i]])
+    return generator
+
+
+def _pack(values):
+    return int.from_bytes(bytes(values), "big")
+
+
+class ReedSolomonCodec:
+    """
+    Prebuilt codec for one parameter set, get it with get_codec() instead of creating it.
+    Data is split into blocks of block_size - checksum_bytes bytes, each followed by its parity,
+    exactly like reedsolo.RSCodec.
+    """
+
+    def __init__(self, checksum_bytes=4, block_size=RS_BLOCK_SIZE):
+        self.checksum_bytes = checksum_bytes
+        self.block_size = block_size
+        self.data_size = block_size - checksum_bytes
+        self.generator = rs_generator_poly(checksum_bytes)
+
+        # parity_rows[i][byte] is the packed parity of a full size block holding only byte at index i.
+        # syndrome_rows[i][byte] is the packed syndrome vector of byte at index i of a full size codeword.
+        # Shorter blocks use the last len(block) rows, as leading zeros don't change parity or syndromes.
+        parity_basis = self._parity_basis()
+        self.parity_rows = [self._table_row(basis) for basis in parity_basis]
+        syndrome_basis = [[GF_EXP[(j * power) % 255] for j in range(checksum_bytes)]
+                          for power in range(block_size - 1, -1, -1)]
+        self.syndrome_rows = [self._table_row(basis) for basis in syndrome_basis]
+
+        if np is not None:
+            gf_mul_np = np.array(GF_MUL, dtype=np.uint8)
+            # Shape (rows, 256, checksum_bytes) of unpacked parity/syndrome bytes.
+            self.parity_table = gf_mul_np[:, np.array(parity_basis, dtype=np.intp)].transpose(1, 0, 2).copy()
+            self.syndrome_table = gf_mul_np[:, np.array(syndrome_basis, dtype=np.intp)].transpose(1, 0, 2).copy()
+
+        self.rs_codec = RSCodec(checksum_bytes, nsize=block_size)  # Only used for actual error correction
+        self.corrected_chunks = 0  # Chunks that had errors and were corrected
+
+    def _parity_basis(self):
+        """ Remainder of x^(position + checksum_bytes) mod generator, for every message position. """
+        remainder = self.generator[1:]  # x^checksum_bytes mod the monic generator
+        basis = []
+        for _ in range(self.data_size):
+            basis.append(remainder)
+            # Multiply by x and reduce, the coefficient shifted out is fed back through the generator.
+            feedback = remainder[0]
+            remainder = remainder[1:] + [0]
+            if feedback:
+                remainder = [coef ^ GF_MUL[generator_coef][feedback]
+                             for coef, generator_coef in zip(remainder, self.generator[1:])]
+        basis.reverse()  # First message byte has the highest power of x
+        return basis
+
+    @staticmethod
+    def _table_row(basis):
+        return [_pack(values) for values in zip(*(GF_MUL[coef] for coef in basis))]
+
+    def encoded_size(self, data_bytes):
+        """ Size of data_bytes of data once encoded. """
+        return data_bytes + self.checksum_bytes * -(-data_bytes // self.data_size)
+
+    def max_data_size(self, encoded_bytes):
+        """ Most data that encodes to at most encoded_bytes. """
+        full_blocks, remainder = divmod(encoded_bytes, self.block_size)
+        return full_blocks * self.data_size + max(0, remainder - self.checksum_bytes)
+
+    def _split(self, data, block_size):
+        return [data[i:i + block_size] for i in range(0, len(data), block_size)]
+
+    # Single chunk ###########
+    def block_parity(self, block):
+        parity = 0
+        for row, byte in zip(self.parity_rows[self.data_size - len(block):], block):
+            parity ^= row[byte]
+        return parity.to_bytes(self.checksum_bytes, "big")
+
+    def block_syndrome(self, block):
+        """ Packed syndromes of one codeword block, 0 means the block is a valid codeword. """
+        syndrome = 0
+        for row, byte in zip(self.syndrome_rows[self.block_size - len(block):], block):
+            syndrome ^= row[byte]
+        return syndrome
+
+    def encode(self, data):
+        encoded = bytearray()
+        for block in self._split(data, self.data_size):
+            encoded += block
+            encoded += self.block_parity(block)
+        return encoded
+
+    def check(self, data):
+        """ True if every block of the encoded data has all zero syndromes. """
+        for block in self._split(data, self.block_size):
+            if self.block_syndrome(block):
+                return False
+        return True
+
+    def strip(self, data):
+        """ Removes parity from encoded data without checking it. """
+        decoded = bytearray()
+        for block in self._split(data, self.block_size):
+            decoded += block[:-self.checksum_bytes]
+        return decoded
+
+    def decode(self, data):
+        """ Returns the data without parity, raises ReedSolomonError if it can't be corrected. """
+        if self.check(data):
+            return self.strip(data)  # Fast path, no errors, skip the full decode.
+        decoded = self.rs_codec.decode(data)[0]
+        self.corrected_chunks += 1
+        return decoded
+
+    # Batch ###########
+    def _vectorized_reduce(self, blocks, table, full_size):
+        """ XOR reduces table lookups for a list of blocks, returns one row of bytes per block.
+        The lookups of REDUCE_BATCH_BLOCKS blocks at a time are in memory, checksum_bytes times their size. """
+        results = [None] * len(blocks)
+        by_length = {}
+        for index, block in enumerate(blocks):
+            by_length.setdefault(len(block), []).append(index)
+        for length, all_indexes in by_length.items():
+            rows = table[full_size - length:]
+            positions = np.arange(length)
+            for start in range(0, len(all_indexes), REDUCE_BATCH_BLOCKS):
+                indexes = all_indexes[start:start + REDUCE_BATCH_BLOCKS]
+                matrix = np.frombuffer(b"".join(bytes(blocks[i]) for i in indexes), dtype=np.uint8)
+                matrix = matrix.reshape(len(indexes), length)
+                reduced = np.bitwise_xor.reduce(rows[positions, matrix], axis=1)
+                for index, row in zip(indexes, reduced):
+                    results[index] = row
+        return results
+
+    def encode_batch(self, chunks):
+        """ Encodes a sequence of chunks in one call, returns a list of bytearrays. """
+        if np is None:
+            return [self.encode(chunk) for chunk in chunks]
+        split_chunks = [self._split(chunk, self.data_size) for chunk in chunks]
+        blocks = [block for split_chunk in split_chunks for block in split_chunk]
+        parities = iter(self._vectorized_reduce(blocks, self.parity_table, self.data_size))
+        encoded_chunks = []
+        for split_chunk in split_chunks:
+            encoded = bytearray()
+            for block in split_chunk:
+                encoded += block
+                encoded += next(parities).tobytes()
+            encoded_chunks.append(encoded)
+        return encoded_chunks
+
+    def check_batch(self, chunks):
+        """ Returns a list of booleans, True where the encoded chunk has no errors. """
+        if np is None:
+            return [self.check(chunk) for chunk in chunks]
+        split_chunks = [self._split(chunk, self.block_size) for chunk in chunks]
+        blocks = [block for split_chunk in split_chunks for block in split_chunk]
+        block_errors = [syndrome.any() for syndrome in
+                        self._vectorized_reduce(blocks, self.syndrome_table, self.block_size)]
+        valid_chunks = []
+        start = 0
+        for split_chunk in split_chunks:
+            valid_chunks.append(not any(block_errors[start:start + len(split_chunk)]))
+            start += len(split_chunk)
+        return valid_chunks
+
+    def decode_batch(self, chunks):
+        """ Decodes a sequence of encoded chunks, uncorrectable chunks are returned as None. """
+        decoded_chunks = []
+        for chunk, valid in zip(chunks, self.check_batch(chunks)):
+            if valid:
+                decoded_chunks.append(self.strip(chunk))
+                continue
+            try:
+                decoded_chunks.append(self.rs_codec.decode(chunk)[0])
+                self.corrected_chunks += 1
+            except ReedSolomonError:
+                decoded_chunks.append(None)
+        return decoded_chunks
+
+
+def get_codec(checksum_bytes=4, block_size=RS_BLOCK_SIZE):
+    """ Returns a cached codec for the parameter set, building it on first use. """
+    key = (checksum_bytes, block_size)
+    codec = _CODEC_CACHE.get(key)
+    if codec is None:
+        codec = ReedSolomonCodec(checksum_bytes, block_size)
+        _CODEC_CACHE[key] = codec
+    return codec
@@ -0,0 +1,279 @@
+"""
+Append-only spool of items on disk, between Redis and the diode.
+
+The sender popped items from Redis into memory and sent them from there, so a crash lost the items it held,
+and a burst faster than the diode link could only wait in Redis, next to everything else on that instance.
+A Spool keeps them in segment files instead: items are appended to the memory mapped segment being written,
+synced to disk, and taken back in order at the pace of the link. The receiver puts completed items in one
+while Redis is down, instead of dropping them once its in-memory backlog is full.
+
+A segment is a SEGMENT_HEADER and then records: a RECORD_HEADER, the key (the Redis queue on the receiver,
+empty on the sender) and the item. A zeroed record header ends the records of a segment, and so does a record
+that doesn't match its crc32, torn by a crash while it was written. Segments are segment_bytes (sparse files,
+disk blocks are only used as records are written), a larger item gets a segment of its own.
+A record is acknowledged once the item is sent, every datagram of it and its redundancy on the sender, pushed to
+Redis on the receiver. A segment is deleted once every record in it is acknowledged.
+The header of every segment holds the offset up to which its records are acknowledged, so after a restart only
+the records that weren't are taken again. Acknowledgements aren't synced: delivery is at least once, and the
+receiver drops the duplicates it still remembers (dedup_ttl_seconds).
+
+A Spool is not thread safe.
+"""
+import collections
+import mmap
+import os
+import struct
+import zlib
+
+from tools.metrics import METRICS
+
+SEGMENT_MAGIC = b"RDSP"
+SEGMENT_VERSION = 1
+SEGMENT_SUFFIX = ".spool"
+# magic 4s, version B, acknowledged offset Q
+SEGMENT_HEADER = struct.Struct("!4sBxxxQ")
+RECORD_MAGIC = 0x5352
+# magic H, key length H, item length I, crc32 of the key and the item I
+RECORD_HEADER = struct.Struct("!HHII")
+
+
+class Segment:
+    """
+    One memory mapped segment file, a new one when size is given.
+    Records are taken from read_offset, end is where the next record goes, unread is the number of records between.
+    """
+
+    def __init__(self, path, size=0):
+        self.path = path
+        self.file = open(path, "w+b" if size else "r+b")
+        try:
+            if size:
+                os.ftruncate(self.file.fileno(), size)
+            self.map = mmap.mmap(self.file.fileno(), 0)
+        except (OSError, ValueError):
+            self.file.close()
+            raise
+        if size:
+            SEGMENT_HEADER.pack_into(self.map, 0, SEGMENT_MAGIC, SEGMENT_VERSION, SEGMENT_HEADER.size)
+        magic, version, self.acknowledged = SEGMENT_HEADER.unpack_from(self.map)
+        if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+            self.close()
+            raise ValueError("Not a spool segment of version %s" % SEGMENT_VERSION)
+        self.read_offset = self.end = self.acknowledged
+        self.synced = 0
+        self.unread = 0
+        record = self.record(self.end)
+        while record:
+            self.end = record[2]
+            self.unread += 1
+            record = self.record(self.end)
+
+    def record(self, offset):
+        """ (key, item, offset of the next record) of the record at offset, None where the records end. """
+        if offset + RECORD_HEADER.size > len(self.map):
+            return None
+        magic, key_length, item_length, crc = RECORD_HEADER.unpack_from(self.map, offset)
+        key_offset = offset + RECORD_HEADER.size
+        item_offset = key_offset + key_length
+        next_offset = item_offset + item_length
+        if magic != RECORD_MAGIC or next_offset > len(self.map):
+            return None
+        key = self.map[key_offset:item_offset]
+        item = self.map[item_offset:next_offset]
+        if zlib.crc32(item, zlib.crc32(key)) != crc:
+            return None
+        return key, item, next_offset
+
+    def append(self, key, item):
+        """ False if the record doesn't fit. The header goes in last, a torn record reads as the end. """
+        key_offset = self.end + RECORD_HEADER.size
+        item_offset = key_offset + len(key)
+        next_offset = item_offset + len(item)
+        if next_offset > len(self.map):
+            return False
+        self.map[key_offset:item_offset] = key
+        self.map[item_offset:next_offset] = item
+        RECORD_HEADER.pack_into(self.map, self.end, RECORD_MAGIC, len(key), len(item),
+                                zlib.crc32(item, zlib.crc32(key)))
+        self.end = next_offset
+        self.unread += 1
+        return True
+
+    def acknowledge(self, offset):
+        self.acknowledged = offset
+        SEGMENT_HEADER.pack_into(self.map, 0, SEGMENT_MAGIC, SEGMENT_VERSION, offset)
+
+    def sync(self):
+        """ Flushes the records written since the last sync to disk. """
+        start = self.synced - self.synced % mmap.ALLOCATIONGRANULARITY
+        if self.end > start:
+            self.map.flush(start, self.end - start)
+            self.synced = self.end
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class Spool:
+    """
+    Segment files in directory, (key, item) records are put at the end and taken from the start.
+    max_bytes bounds the records kept on disk, 0 doesn't. With sync, put returns once the records are on disk.
+    """
+
+    def __init__(self, directory, segment_bytes=67108864, max_bytes=1073741824, sync=True):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.sync = sync
+        self.segments = collections.deque()  # Oldest first, records are put in the last one
+        self.records = 0  # Records not taken yet
+        self.used_bytes = 0
+        self.taken = collections.deque()  # (segment, end offset) of every taken record not acknowledged yet
+        self.taken_records = 0  # Records taken since the spool was opened
+        self.acknowledged_records = 0
+        self.sending = collections.deque()  # [taken records, sent] in the order they were sent, see sent_callback
+        self.next_segment_nr = 0
+        self._recover()
+        self._start_segment(segment_bytes)
+
+    def __len__(self):
+        return self.records
+
+    def _recover(self):
+        """ Opens the segments left by the last run, their records that weren't acknowledged are taken first. """
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(SEGMENT_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            if os.path.getsize(path) == 0:
+                os.remove(path)  # Created by a run that stopped before it could size it
+                continue
+            try:
+                self.next_segment_nr = max(self.next_segment_nr, int(name[:-len(SEGMENT_SUFFIX)]) + 1)
+                segment = Segment(path)
+            except (OSError, ValueError) as e:
+                print("[x] Can't read spool segment %s, renamed it to %s.bad. %s" % (path, name, e))
+                os.rename(path, path + ".bad")
+                continue
+            if not segment.unread:
+                segment.close()
+                os.remove(path)
+                continue
+            self.segments.append(segment)
+            self.records += segment.unread
+            self.used_bytes += segment.end
+        if self.records:
+            print("[*] Spool %s has %s items from before the restart." % (self.directory, self.records))
+
+    def _start_segment(self, size):
+        path = os.path.join(self.directory, "%016d%s" % (self.next_segment_nr, SEGMENT_SUFFIX))
+        self.next_segment_nr += 1
+        if self.segments and self.sync:
+            self.segments[-1].sync()
+        self.segments.append(Segment(path, size))
+        self.used_bytes += SEGMENT_HEADER.size
+        self._reclaim()
+
+    def _reclaim(self):
+        """ Deletes the oldest segments while every record in them is acknowledged, never the one being written. """
+        while len(self.segments) > 1 and self.segments[0].acknowledged >= self.segments[0].end:
+            segment = self.segments.popleft()
+            self.used_bytes -= segment.end
+            segment.close()
+            os.remove(segment.path)
+            METRICS.inc("spool_segments_reclaimed")
+
+    def full(self):
+        return bool(self.max_bytes) and self.used_bytes >= self.max_bytes
+
+    def put(self, records):
+        """ Appends (key, item) records, keys and items are bytes or str. """
+        segment = self.segments[-1]
+        for key, item in records:
+            if isinstance(key, str):
+                key = key.encode()
+            if isinstance(item, str):
+                item = item.encode()
+            if not segment.append(key, item):
+                self._start_segment(max(self.segment_bytes,
+                                        SEGMENT_HEADER.size + RECORD_HEADER.size + len(key) + len(item)))
+                segment = self.segments[-1]
+                segment.append(key, item)
+            self.used_bytes += RECORD_HEADER.size + len(key) + len(item)
+            self.records += 1
+        if self.sync:
+            segment.sync()
+
+    def take(self, max_records=1):
+        """ Up to max_records (key, item) records, in the order they were put. """
+        records = []
+        for segment in self.segments:
+            while segment.unread and len(records) < max_records:
+                record = segment.record(segment.read_offset)
+                if record is None:
+                    print("[x] Spool segment %s is corrupt at byte %s, skipping %s items." % (
+                        segment.path, segment.read_offset, segment.unread))
+                    METRICS.inc("spool_corrupt_items", segment.unread)
+                    self.records -= segment.unread
+                    segment.end = segment.read_offset
+                    segment.unread = 0
+                    break
+                key, item, segment.read_offset = record
+                segment.unread -= 1
+                self.taken.append((segment, segment.read_offset))
+                records.append((key, item))
+            if len(records) >= max_records:
+                break
+        self.records -= len(records)
+        self.taken_records += len(records)
+        return records
+
+    def acknowledge(self, taken_records):
+        """ The first taken_records records ever taken are done with, in taken order. """
+        while self.acknowledged_records < taken_records and self.taken:
+            segment, offset = self.taken.popleft()
+            segment.acknowledge(offset)
+            self.acknowledged_records += 1
+        self._reclaim()
+
+    def sent_callback(self, taken_records):
+        """
+        Returns a function to call once the records up to the taken_records-th are sent, for senders that
+        finish items out of order. Records are only acknowledged once every record before them is.
+        """
+        entry = [taken_records, False]
+        self.sending.append(entry)
+
+        def sent():
+            entry[1] = True
+            acknowledged = None
+            while self.sending and self.sending[0][1]:
+                acknowledged = self.sending.popleft()[0]
+            if acknowledged is not None:
+                self.acknowledge(acknowledged)
+        return sent
+
+    def close(self):
+        for segment in self.segments:
+            if self.sync:
+                segment.sync()
+            segment.close()
+        self.segments.clear()
+
+
+class PendingSpool(Spool):
+    """ A Spool in place of the pending deque of a sender stream, see stream_scheduler.Stream """
+
+    def append(self, item):
+        self.put([(b"", item)])
+
+    def extend(self, items):
+        self.put((b"", item) for item in items)
+
+    def popleft(self):
+        records = self.take(1)
+        if not records:
+            raise IndexError("pop from an empty spool")
+        return records[0][1]
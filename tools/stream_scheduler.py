@@ -0,0 +1,74 @@
+"""
+Several Redis queues over one diode port.
+
+Every queue is a Stream with its own stream id, carried in the frame header so the receiver can put its items
+on the matching queue. The FairScheduler picks the stream that sends the next item:
+streams with a higher priority go first, streams of the same priority share the link in proportion to their
+weight, and a stream over its own rate limit waits without holding up the others.
+
+Sharing is start time fair queueing on the bytes sent: every stream gets a virtual finish time that grows by
+bytes / weight for everything it sends, and the stream with the lowest start time goes next.
+An idle stream starts at the current virtual time, so it can't save up credit while it has nothing to send.
+"""
+import collections
+
+from tools import transmit
+
+
+class Stream:
+
+    def __init__(self, stream_id, redis_queue, weight=1.0, priority=0, rate_bits=0, burst_bytes=262144):
+        if not 0 <= stream_id <= 0xffff:
+            raise ValueError("Stream id %s is out of range 0-65535" % stream_id)
+        if weight <= 0:
+            raise ValueError("Stream %s weight must be above 0" % stream_id)
+        self.stream_id = stream_id
+        self.redis_queue = redis_queue
+        self.weight = weight
+        self.priority = priority
+        self.token_bucket = transmit.TokenBucket(rate_bits, max(burst_bytes, 1))
+        self.pending = collections.deque()  # Items popped from Redis and not sent yet
+        self.finish_time = 0.0  # Virtual time at which everything this stream sent is paid for
+        self.sent_items = 0
+        self.sent_bytes = 0
+
+
+class FairScheduler:
+
+    def __init__(self, streams):
+        self.streams = sorted(streams, key=lambda stream: -stream.priority)
+        self.virtual_time = 0.0  # Start time of the last scheduled item
+
+    def next_stream(self):
+        """
+        Returns (stream, 0.0) for the stream that sends next.
+        Returns (None, seconds) when every stream with pending items is over its rate limit, seconds is the time
+        until the first of them may send again, and (None, None) when no stream has pending items.
+        """
+        best = None
+        best_start = 0.0
+        wait_seconds = None
+        for stream in self.streams:
+            if best is not None and stream.priority < best.priority:
+                break  # Lower priorities only send when no stream above them can
+            if not stream.pending:
+                continue
+            delay = stream.token_bucket.delay()
+            if delay > 0:
+                wait_seconds = delay if wait_seconds is None else min(wait_seconds, delay)
+                continue
+            start = max(self.virtual_time, stream.finish_time)
+            if best is None or start < best_start:
+                best, best_start = stream, start
+        if best is None:
+            return None, wait_seconds
+        return best, 0.0
+
+    def charge(self, stream, sent_bytes):
+        """ Accounts for an item the stream sent, once its size on the wire is known. """
+        start = max(self.virtual_time, stream.finish_time)
+        self.virtual_time = start
+        stream.finish_time = start + sent_bytes / stream.weight
+        stream.token_bucket.charge(sent_bytes)
+        stream.sent_items += 1
+        stream.sent_bytes += sent_bytes
@@ -0,0 +1,41 @@
+"""
+Hashed timer wheel.
+
+Keys are put in the slot of the tick their deadline falls in, and advancing the wheel only visits the
+slots of the ticks that passed, so adding and expiring is O(1) amortized whatever the number of keys.
+Deadlines further away than one turn of the wheel are put in the last slot and come back early,
+callers check the real deadline of what comes out and add the key again if it was extended.
+"""
+import math
+
+
+class TimerWheel:
+
+    def __init__(self, tick_seconds=0.1, slots=1024, now=0.0):
+        self.tick_seconds = tick_seconds
+        self.slots = [[] for _ in range(slots)]
+        self.current_tick = int(now / tick_seconds)
+        self.keys = 0
+
+    def add(self, key, deadline):
+        ticks_ahead = math.ceil(deadline / self.tick_seconds) - self.current_tick
+        ticks_ahead = min(max(ticks_ahead, 1), len(self.slots) - 1)
+        self.slots[(self.current_tick + ticks_ahead) % len(self.slots)].append(key)
+        self.keys += 1
+
+    def advance(self, now):
+        """ Returns the keys of all ticks up to now. """
+        target_tick = int(now / self.tick_seconds)
+        if target_tick <= self.current_tick:
+            return []
+        due = []
+        # After a long pause every slot is due, there is no need to go round more than once.
+        ticks = min(target_tick - self.current_tick, len(self.slots))
+        for tick in range(target_tick - ticks + 1, target_tick + 1):
+            slot_index = tick % len(self.slots)
+            if self.slots[slot_index]:
+                due += self.slots[slot_index]
+                self.slots[slot_index] = []
+        self.current_tick = target_tick
+        self.keys -= len(due)
+        return due
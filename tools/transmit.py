@@ -0,0 +1,196 @@
+"""
+UDP transmit engine for the sender.
+
+One socket is created and connected once, with a large send buffer and optionally bound to the sending interface.
+Datagrams are sent in batches, with sendmmsg on Linux (through ctypes, one system call per batch)
+and a tight send loop elsewhere. A token bucket paces the batches to a target bit rate, instead of
+sleeping after every datagram.
+A connected UDP socket reports an ICMP port unreachable from the receiver host as ECONNREFUSED on a later send.
+Across a diode nothing can be done about it, the batch it was reported on is counted in refused_packets and dropped.
+"""
+import ctypes
+import ctypes.util
+import errno
+import socket
+import struct
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not on Windows, the MTU is then read from sysfs or left at its default
+
+SIOCGIFMTU = 0x8921
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IOVec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+def _load_sendmmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+_SENDMMSG = _load_sendmmsg()
+
+
+def interface_mtu(interface, default=1500):
+    """ MTU of a network interface, or default if it can't be read. """
+    try:
+        with open("/sys/class/net/%s/mtu" % interface) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        pass
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            request = struct.pack("16si", interface.encode()[:15], 0)
+            return struct.unpack("16si", fcntl.ioctl(probe.fileno(), SIOCGIFMTU, request))[1]
+    except (OSError, ValueError, AttributeError):
+        print("[x] Could not read the MTU of %s, using %s." % (interface, default))
+        return default
+
+
+class TokenBucket:
+    """ Paces bytes to rate_bits per second, allowing bursts of up to burst_bytes. A rate of 0 disables pacing. """
+
+    def __init__(self, rate_bits=0, burst_bytes=262144):
+        self.rate_bytes = rate_bits / 8
+        self.burst_bytes = burst_bytes
+        self.tokens = burst_bytes
+        self.last_refill = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst_bytes, self.tokens + (now - self.last_refill) * self.rate_bytes)
+        self.last_refill = now
+
+    def charge(self, size_bytes):
+        """ Takes size_bytes without blocking, the bucket can go into debt. """
+        if not self.rate_bytes:
+            return
+        self._refill()
+        self.tokens -= size_bytes
+
+    def delay(self):
+        """ Seconds until the bucket is out of debt, 0 if it may send now. """
+        if not self.rate_bytes:
+            return 0.0
+        self._refill()
+        return -self.tokens / self.rate_bytes if self.tokens < 0 else 0.0
+
+    def consume(self, size_bytes):
+        """ Blocks until size_bytes may be sent. """
+        if not self.rate_bytes:
+            return
+        self.charge(size_bytes)
+        if self.tokens < 0:
+            # Sleep off the debt, the refill on the next call accounts for the time slept.
+            time.sleep(-self.tokens / self.rate_bytes)
+
+
+class UdpTransmitter:
+    """
+    Sends datagrams to one receiver through a persistent socket.
+    rate_bits=0 sends as fast as the socket accepts, batch_packets is the max datagrams per system call.
+    """
+
+    def __init__(self, ip, port, interface=None, rate_bits=0, burst_bytes=262144, batch_packets=64,
+                 send_buffer_bytes=8388608, use_sendmmsg=True):
+        self.address = (ip, port)
+        self.batch_packets = batch_packets
+        self.token_bucket = TokenBucket(rate_bits, max(burst_bytes, 1))
+        self.sent_packets = 0
+        self.sent_bytes = 0
+        self.refused_packets = 0  # Dropped on ECONNREFUSED
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer_bytes)
+        if interface:
+            try:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, interface.encode() + b"\0")
+            except (AttributeError, OSError) as e:
+                print("[x] Could not bind to interface %s, sending on default route. %s" % (interface, e))
+        self.socket.connect(self.address)  # Connected socket, the address is not resolved for every datagram
+
+        self.sendmmsg = _SENDMMSG if use_sendmmsg else None
+        if self.sendmmsg:
+            self._messages = (_MMsgHdr * batch_packets)()
+            self._iovecs = (_IOVec * batch_packets)()
+            for message, iovec in zip(self._messages, self._iovecs):
+                message.msg_hdr.msg_iov = ctypes.pointer(iovec)
+                message.msg_hdr.msg_iovlen = 1
+
+    def send(self, datagrams):
+        """ Sends an iterable of datagrams in paced batches. """
+        batch = []
+        for datagram in datagrams:
+            batch.append(datagram)
+            if len(batch) == self.batch_packets:
+                self.send_batch(batch)
+                batch = []
+        if batch:
+            self.send_batch(batch)
+
+    def send_batch(self, batch):
+        """ Sends at most batch_packets datagrams. """
+        batch_bytes = sum(len(datagram) for datagram in batch)
+        self.token_bucket.consume(batch_bytes)
+        try:
+            if self.sendmmsg:
+                self._sendmmsg(batch)
+            else:
+                for datagram in batch:
+                    self.socket.send(datagram)
+        except ConnectionRefusedError:
+            # Datagrams sent before the error are counted as refused too, the kernel doesn't tell how many went out.
+            if not self.refused_packets:
+                print("[x] %s:%s refused datagrams, is the receiver listening? Dropping batches it refuses." %
+                      self.address)
+            self.refused_packets += len(batch)
+            return
+        self.sent_packets += len(batch)
+        self.sent_bytes += batch_bytes
+
+    def _sendmmsg(self, batch):
+        buffers = []  # Keeps the ctypes views alive until the system call returns.
+        for iovec, datagram in zip(self._iovecs, batch):
+            if isinstance(datagram, bytes):
+                buffer = ctypes.c_char_p(datagram)
+            else:
+                if not isinstance(datagram, bytearray):
+                    datagram = bytearray(datagram)
+                buffer = (ctypes.c_char * len(datagram)).from_buffer(datagram)
+            buffers.append(buffer)
+            iovec.iov_base = ctypes.cast(buffer, ctypes.c_void_p)
+            iovec.iov_len = len(datagram)
+        sent = 0
+        while sent < len(batch):
+            result = self.sendmmsg(self.socket.fileno(), ctypes.byref(self._messages[sent]), len(batch) - sent, 0)
+            if result < 0:
+                error = ctypes.get_errno()
+                if error in (errno.EINTR, errno.EAGAIN, errno.ENOBUFS):
+                    time.sleep(0.0001)  # Kernel queue full, give it a moment.
+                    continue
+                raise OSError(error, "sendmmsg: " + errno.errorcode.get(error, str(error)))
+            sent += result
+
+    def close(self):
+        self.socket.close()
@@ -0,0 +1,146 @@
+"""
+Binary frame format used between the sender and the receiver.
+
+Every datagram starts with a fixed size, versioned header packed with struct, followed by the
+Reed Solomon encoded payload. If the erasure coding flag is set, a fixed size extension follows the header.
+
+Header (network byte order):
+    magic H, version B, flags B, integrity B, stream_id H, copy_nr B, redundant_copies B,
+    item_id Q, total_packets I, packet_nr I, chunk_checksum I, datagram_bytes H, sent_ms I
+item_id is the 64 bit digest of the item and chunk_checksum the 32 bit checksum of the chunk before Reed Solomon
+encoding, integrity tells which algorithms made them, see tools/integrity.py
+datagram_bytes is the largest datagram the sender sends, the receiver sizes its buffers to it.
+sent_ms is the sender's wall clock in milliseconds (modulo 2^32) when it started sending the item,
+for end to end latency. It is only meaningful when both clocks are synchronized.
+Flags: FLAG_FEC, the erasure coding extension follows. FLAG_BATCH, the item is a batch of small items.
+Bits 2-4 are the compression codec of the item, see tools/compression.py
+FLAG_FILE, the item is a block or the manifest of a file, see tools/file_transfer.py
+Erasure coding extension:
+    fec_block_packets H, repair_packets_per_block H, item_length Q, chunk_bytes I
+
+unpack_frame drops frames whose packet numbers and erasure coding fields don't fit together, or that claim an item
+larger than MAX_ITEM_BYTES, so a corrupt or hostile header can't make the receiver allocate or index out of bounds.
+
+The old format, a pickled tuple, can still be sent and received during migration, see pack_legacy_frame.
+It should only be accepted from trusted networks as unpickling runs arbitrary code.
+"""
+import pickle
+import struct
+import time
+from collections import namedtuple
+
+from tools.erasure import MAX_BLOCK_PACKETS
+
+MAGIC = 0xD10D
+VERSION = 4
+FLAG_FEC = 0x01
+FLAG_BATCH = 0x02  # The item is several small items packed together, see tools/batching.py
+FLAG_FILE = 0x20  # The item belongs to a file transfer, see tools/file_transfer.py
+
+HEADER = struct.Struct("!HBBBHBBQIIIHI")
+FEC_HEADER = struct.Struct("!HHQI")
+FEC_HEADER_END = HEADER.size + FEC_HEADER.size
+MAX_ITEM_BYTES = 1 << 30  # Above the 512 MB limit of a Redis value
+MAX_DATAGRAM_BYTES = 65535
+
+# Same order as the legacy tuple, so frames can still be indexed the old way.
+Frame = namedtuple("Frame", ["total_packets", "packet_nr", "redundant_copies", "copy_nr", "item_id",
+                             "chunk_checksum", "payload", "fec_info", "stream_id", "flags", "datagram_bytes",
+                             "sent_ms", "integrity"],
+                   defaults=[None, 0, 0, 0, 0, 0])
+_new_frame = tuple.__new__  # Builds a Frame from a tuple without the namedtuple argument handling
+
+
+def timestamp_ms():
+    """ Wall clock in milliseconds, modulo 2^32 to fit the header. """
+    return int(time.time() * 1000) & 0xffffffff
+
+
+def latency_seconds(sent_ms, now_ms=None):
+    """ Seconds since sent_ms, correct across the 2^32 wrap for latencies below 49 days. """
+    if now_ms is None:
+        now_ms = timestamp_ms()
+    return ((now_ms - sent_ms) & 0xffffffff) / 1000
+
+
+def pack_frame(frame):
+    """ Packs a Frame into one datagram. """
+    flags = frame.flags | FLAG_FEC if frame.fec_info else frame.flags
+    header_size = HEADER.size + (FEC_HEADER.size if frame.fec_info else 0)
+    datagram = bytearray(header_size + len(frame.payload))
+    HEADER.pack_into(datagram, 0, MAGIC, VERSION, flags, frame.integrity, frame.stream_id, frame.copy_nr,
+                     frame.redundant_copies, frame.item_id, frame.total_packets, frame.packet_nr,
+                     frame.chunk_checksum, frame.datagram_bytes, frame.sent_ms)
+    if frame.fec_info:
+        FEC_HEADER.pack_into(datagram, HEADER.size, *frame.fec_info)
+    memoryview(datagram)[header_size:] = frame.payload
+    return datagram
+
+
+def pack_legacy_frame(frame):
+    """ Pickled tuple understood by receivers that predate the binary format, with md5 hexdigests.
+    They have no erasure coding, raises ValueError for frames of erasure coded items. """
+    if frame.fec_info:
+        raise ValueError("The legacy format can't carry erasure coded frames, set fec_overhead = 0")
+    return pickle.dumps((frame.total_packets, frame.packet_nr, frame.redundant_copies, frame.copy_nr,
+                         frame.item_id[-6:], frame.chunk_checksum[-2:], frame.payload))
+
+
+def unpack_frame(datagram, accept_legacy=False):
+    """
+    Parses a datagram into a Frame, the payload is a memoryview into the datagram.
+    Binary frames have integer item_id and chunk_checksum, legacy frames keep their md5 hex strings.
+    Returns None for anything that isn't a valid frame.
+    """
+    view = memoryview(datagram)
+    if len(view) >= HEADER.size:
+        (magic, version, flags, integrity, stream_id, copy_nr, redundant_copies, item_id, total_packets, packet_nr,
+         chunk_checksum, datagram_bytes, sent_ms) = HEADER.unpack_from(view)
+        if magic == MAGIC:
+            if version != VERSION:
+                return None
+            if flags & FLAG_FEC:
+                if len(view) < FEC_HEADER_END:
+                    return None
+                fec_info = FEC_HEADER.unpack_from(view, HEADER.size)
+                if not valid_packet_numbers(total_packets, packet_nr, len(view) - FEC_HEADER_END, fec_info):
+                    return None
+                return _new_frame(Frame, (total_packets, packet_nr, redundant_copies, copy_nr, item_id,
+                                          chunk_checksum, view[FEC_HEADER_END:], fec_info, stream_id, flags,
+                                          datagram_bytes, sent_ms, integrity))
+            if not valid_packet_numbers(total_packets, packet_nr, len(view) - HEADER.size):
+                return None
+            return _new_frame(Frame, (total_packets, packet_nr, redundant_copies, copy_nr, item_id, chunk_checksum,
+                                      view[HEADER.size:], None, stream_id, flags, datagram_bytes, sent_ms,
+                                      integrity))
+    if accept_legacy:
+        try:
+            legacy_tuple = pickle.loads(datagram)
+            frame = Frame(*legacy_tuple[:7], fec_info=legacy_tuple[7] if len(legacy_tuple) > 7 else None)
+            if valid_packet_numbers(frame.total_packets, frame.packet_nr, len(frame.payload), frame.fec_info):
+                return frame
+        except Exception:
+            return None
+    return None
+
+
+def valid_packet_numbers(total_packets, packet_nr, payload_bytes, fec_info=None):
+    """
+    True if the packet numbers and the erasure coding fields describe an item the receiver can reassemble.
+    Without erasure coding the item size isn't sent, every packet but the last carries a full chunk,
+    so total_packets * payload_bytes bounds it (a little over, payloads are Reed Solomon encoded).
+    """
+    if packet_nr < 0 or total_packets < 1:
+        return False
+    if not fec_info:
+        return packet_nr < total_packets and total_packets * payload_bytes <= MAX_ITEM_BYTES
+    if len(fec_info) != 4:
+        return False
+    block_packets, repair_count, item_length, chunk_bytes = fec_info
+    if not (1 <= block_packets and 1 <= repair_count and block_packets + repair_count <= MAX_BLOCK_PACKETS
+            and 1 <= chunk_bytes <= MAX_DATAGRAM_BYTES and 1 <= item_length <= MAX_ITEM_BYTES):
+        return False
+    # Every packet but the last is full size
+    if not (total_packets - 1) * chunk_bytes < item_length <= total_packets * chunk_bytes:
+        return False
+    return packet_nr < total_packets + -(-total_packets // block_packets) * repair_count